@@ -0,0 +1,54 @@
+import argparse
+import random
+import sys
+import timeit
+
+import trek
+
+# How long it takes to lay out a sector as it fills up, placing objects
+# the way TrekGame.init used to (draw any position, try again if it's
+# taken) and with trek.free_positions. Run from the top of the tree as
+#   python -m bench.placement
+
+def rejection_positions(rng, positions, count, taken):
+    # The old loop from TrekGame.init
+    used = set([taken])
+    picks = []
+    while len(picks) < count:
+        position = rng.randint(0, positions - 1)
+        if position not in used:
+            used.add(position)
+            picks.append(position)
+    return picks
+
+METHODS = (('rejection', rejection_positions),
+           ('fisher-yates', trek.free_positions))
+
+def bench(place, positions, count, repeat, seed=0):
+    # Microseconds for each layout of count objects
+    rng = random.Random(seed)
+    taken = positions // 2
+    timer = timeit.Timer(lambda: place(rng, positions, count, taken))
+    return min(timer.repeat(3, repeat)) / repeat * 1e6
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compare ways of placing objects in a sector.')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[8, 32],
+                        help='sector widths to try, each sector being square')
+    parser.add_argument('-n', '--repeat', type=int, default=200,
+                        help='layouts timed for each density')
+    args = parser.parse_args(argv)
+    sys.stdout.write('%9s %8s %8s %13s %16s\n' % (
+        'positions', 'objects', 'density', 'rejection us', 'fisher-yates us'))
+    for size in args.sizes:
+        positions = size * size
+        for density in (0.1, 0.25, 0.5, 0.75, 0.9, 0.99):
+            count = min(positions - 1, int(positions * density))
+            times = [bench(place, positions, count, args.repeat)
+                     for name, place in METHODS]
+            sys.stdout.write('%9d %8d %7d%% %13.1f %16.1f\n' % (
+                positions, count, density * 100, times[0], times[1]))
+
+if __name__ == '__main__':
+    main()
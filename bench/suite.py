@@ -0,0 +1,228 @@
+import argparse
+from collections import OrderedDict
+import gc
+import itertools
+import json
+import platform
+import sys
+import time
+
+import trek
+import trek_sim
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 has no tracemalloc, see measure_memory
+    tracemalloc = None
+
+# Seeded benchmarks of the engine's hot paths. Each one is set up from a
+# fixed seed, so runs are repeatable and only the engine changes between
+# them. Run from the top of the tree as
+#   python -m bench.suite --save results.json
+#   python -m bench.suite --baseline results.json --threshold 0.1
+# The second fails if anything has slowed down by more than 10%.
+
+SEED = 1
+
+# Warps 1-8 take the Enterprise every distance it can go inside a sector,
+# 63 is the furthest the helm allows
+WARPS = (1, 2, 3, 4, 5, 6, 7, 8, 63)
+
+def quiet_game(seed=SEED):
+    return trek.TrekGame(max_speed=True, test_mode=True, seed=seed,
+                         sink=trek.NullSink())
+
+def bench_init(seed):
+    game = quiet_game(seed)
+    return lambda: game.init(3, 1, 5, 27)
+
+def bench_srs(seed):
+    game = quiet_game(seed)
+    sector = trek.Sector(game.init(2, 1, 3, 27))
+    return lambda: game.srs(sector, 27)
+
+def bench_helm(warp):
+    # Cycle through the courses from the middle of an empty sector
+    def setup(seed):
+        game = quiet_game(seed)
+        sector = trek.Sector([0] * 64)
+        courses = itertools.cycle(trek_sim.DIRECTIONS)
+        def op():
+            game.helm(None, 0, 3000, sector, 27, 2000.0, next(courses), warp)
+        return op
+    return setup
+
+def bench_phasers(klingons):
+    # Phasers that leave the Klingons standing, so every shot is the same
+    def setup(seed):
+        game = quiet_game(seed)
+        sector = trek.Sector([0] * 64)
+        sector[27] = 4
+        for position in (3, 30, 60)[:klingons]:
+            sector[position] = -200
+        return lambda: game.phasers("Red", 1000, 3000, sector.copy(), 27,
+                                    klingons, 100 * klingons)
+    return setup
+
+def bench_torpedoes(seed):
+    # A torpedo across the sector into a Klingon
+    game = quiet_game(seed)
+    sector = trek.Sector([0] * 64)
+    sector[24] = 4
+    sector[31] = -200
+    direction = [d for d in trek_sim.DIRECTIONS
+                 if 31 in trek.RAYS[24][d][0]][0]
+    return lambda: game.photontorpedoes(10, sector.copy(), 24, 1, direction)
+
+def bench_lrs(seed):
+    game = quiet_game(seed)
+    state = game.new_game()
+    sectors = itertools.cycle(range(64))
+    return lambda: game.lrs(state.galaxy, next(sectors))
+
+def bench_galaxy(seed):
+    return quiet_game(seed).make_galaxy
+
+def bench_new_game(seed):
+    return quiet_game(seed).new_game
+
+def bench_games(seed):
+    # Ten whole games as trek_sim plays them, the same ten every time
+    seeds = range(seed, seed + 10)
+    return lambda: [trek_sim.play(s) for s in seeds]
+
+BENCHMARKS = OrderedDict(
+    [('init', bench_init),
+     ('srs', bench_srs)] +
+    [('helm_warp_%d' % warp, bench_helm(warp)) for warp in WARPS] +
+    [('phasers_%d' % klingons, bench_phasers(klingons))
+     for klingons in (1, 2, 3)] +
+    [('photontorpedoes', bench_torpedoes),
+     ('lrs', bench_lrs),
+     ('make_galaxy', bench_galaxy),
+     ('new_game', bench_new_game),
+     ('games_10', bench_games)])
+
+def measure_speed(op, seconds):
+    # Operations per second, timed in batches until seconds have passed
+    # and keeping the best batch
+    batch = 1
+    best = 0.0
+    spent = 0.0
+    while spent < seconds or best == 0.0:
+        started = time.time()
+        for i in xrange(batch):
+            op()
+        elapsed = time.time() - started
+        spent = spent + elapsed
+        if elapsed < 0.01:
+            # Too quick to time well
+            batch = batch * 2
+        else:
+            best = max(best, batch / elapsed)
+    return best
+
+def measure_memory(op, count=100):
+    # With tracemalloc, the peak bytes allocated per operation. Without it
+    # the nearest we have is the number of objects the collector tracks
+    # (lists, dicts, instances and so on) left behind per operation, with
+    # the collector off so that nothing is freed behind our back
+    if tracemalloc is not None:
+        tracemalloc.start()
+        for i in xrange(count):
+            op()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak / float(count)
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        for i in xrange(count):
+            op()
+        after = len(gc.get_objects())
+    finally:
+        gc.enable()
+    return (after - before) / float(count)
+
+def run(names=None, seconds=0.5, seed=SEED):
+    names = names or list(BENCHMARKS)
+    results = OrderedDict()
+    for name in names:
+        results[name] = OrderedDict([
+            ('ops_per_sec', round(measure_speed(BENCHMARKS[name](seed),
+                                                seconds), 1)),
+            ('memory_per_op', round(measure_memory(BENCHMARKS[name](seed)),
+                                    2))])
+    return OrderedDict([
+        ('python', platform.python_version()),
+        ('memory_unit', 'bytes' if tracemalloc is not None else 'objects'),
+        ('seed', seed),
+        ('benchmarks', results)])
+
+def compare(results, baseline, threshold=0.1):
+    # Benchmarks more than threshold slower than the baseline, as
+    # (name, baseline ops/sec, ops/sec) for each
+    slower = []
+    for name, result in results['benchmarks'].items():
+        before = baseline['benchmarks'].get(name)
+        if before is None:
+            continue
+        if result['ops_per_sec'] < before['ops_per_sec'] * (1 - threshold):
+            slower.append((name, before['ops_per_sec'],
+                           result['ops_per_sec']))
+    return slower
+
+def report(results, out, baseline=None):
+    out.write('%-18s %14s %14s %10s\n' % (
+        'benchmark', 'ops/sec', results['memory_unit'] + '/op', 'change'))
+    for name, result in results['benchmarks'].items():
+        change = ''
+        if baseline is not None and name in baseline['benchmarks']:
+            before = baseline['benchmarks'][name]['ops_per_sec']
+            change = '%+.1f%%' % ((result['ops_per_sec'] / before - 1) * 100)
+        out.write('%-18s %14.1f %14.2f %10s\n' % (
+            name, result['ops_per_sec'], result['memory_per_op'], change))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the trek engine against a baseline.')
+    parser.add_argument('names', nargs='*', metavar='BENCHMARK',
+                        help='benchmarks to run (default: all of %s)'
+                             % ', '.join(BENCHMARKS))
+    parser.add_argument('-t', '--time', type=float, default=0.5,
+                        help='seconds to time each benchmark for')
+    parser.add_argument('-s', '--seed', type=int, default=SEED)
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results to FILE as JSON')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare with results saved earlier')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fraction slower than the baseline that counts '
+                             'as a regression (default: 0.1)')
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('no benchmark called %s' % name)
+    results = run(args.names, args.time, args.seed)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, sys.stdout, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    if baseline is not None:
+        slower = compare(results, baseline, args.threshold)
+        for name, before, after in slower:
+            sys.stdout.write('%s regressed: %.1f ops/sec, was %.1f\n'
+                             % (name, after, before))
+        if slower:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+import argparse
+import sys
+import time
+
+import numpy
+
+import trek_batch
+
+# Game steps per second through trek_batch.TrekVecEnv, with every game
+# given a random command each step and restarted as soon as it is over.
+# Unlike the rest of bench this needs NumPy. Run from the top of the tree as
+#   python -m bench.vecenv -n 100000
+
+# What TrekVecEnv was asked to reach, in game steps per second
+TARGET = 1e6
+
+def random_commands(rng, n):
+    # Commands 0-6 with arguments that are sometimes out of range, so the
+    # checks for bad input are timed along with the moves they allow
+    commands = rng.randint(0, 7, n)
+    args = numpy.empty((n, 2), numpy.int64)
+    args[:, 0] = rng.randint(0, 10, n)
+    args[:, 1] = rng.randint(0, 1000, n)
+    args[commands == 1, 1] = rng.randint(0, 9, (commands == 1).sum())
+    return commands, args
+
+def bench(n, steps, seed=0):
+    # Game steps per second over steps calls to step, best of three
+    rng = numpy.random.RandomState(seed)
+    env = trek_batch.TrekVecEnv(n, rng=rng)
+    moves = [random_commands(rng, n) for i in range(steps)]
+    best = 0.0
+    for attempt in range(3):
+        started = time.time()
+        for commands, args in moves:
+            over = numpy.flatnonzero(env.step(commands, args))
+            if len(over):
+                env.reset(over)
+        best = max(best, n * steps / (time.time() - started))
+    return best
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time TrekVecEnv playing random commands.')
+    parser.add_argument('-n', '--games', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='numbers of games to step at once')
+    parser.add_argument('-s', '--steps', type=int, default=10,
+                        help='steps timed for each number of games')
+    args = parser.parse_args(argv)
+    sys.stdout.write('%8s %14s %10s\n' % ('games', 'steps/sec', 'of target'))
+    for n in args.games:
+        rate = bench(n, args.steps)
+        sys.stdout.write('%8d %14.0f %9.1f%%\n' % (n, rate,
+                                                   rate / TARGET * 100))
+
+if __name__ == '__main__':
+    main()
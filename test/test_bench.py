@@ -0,0 +1,69 @@
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+from StringIO import StringIO
+import unittest
+
+from bench import placement, suite
+
+try:
+    from bench import vecenv
+except ImportError:
+    vecenv = None
+
+def results(**ops):
+    return {'benchmarks': dict((name, {'ops_per_sec': value})
+                               for name, value in ops.items())}
+
+class TestBenchSuite(unittest.TestCase):
+    def test_every_benchmark_runs(self):
+        for name, setup in suite.BENCHMARKS.items():
+            op = setup(suite.SEED)
+            op()
+            op()
+
+    def test_run(self):
+        result = suite.run(['init', 'lrs'], seconds=0.01)
+        self.assertEqual(list(result['benchmarks']), ['init', 'lrs'])
+        self.assertTrue(result['benchmarks']['init']['ops_per_sec'] > 0)
+        self.assertIn(result['memory_unit'], ('bytes', 'objects'))
+
+    def test_compare(self):
+        baseline = results(init=100.0, srs=100.0, lrs=100.0)
+        now = results(init=95.0, srs=80.0, helm_warp_1=5.0)
+        self.assertEqual(suite.compare(now, baseline), [('srs', 100.0, 80.0)])
+        self.assertEqual(suite.compare(now, baseline, threshold=0.25), [])
+
+    def test_save_and_compare(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, 'baseline.json')
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.assertEqual(suite.main(['init', '-t', '0.01', '--save', path]),
+                             0)
+            with open(path) as f:
+                baseline = json.load(f)
+            baseline['benchmarks']['init']['ops_per_sec'] = 1e12
+            with open(path, 'w') as f:
+                json.dump(baseline, f)
+            self.assertEqual(suite.main(['init', '-t', '0.01',
+                                         '--baseline', path]), 1)
+        finally:
+            sys.stdout = stdout
+
+class TestBenchPlacement(unittest.TestCase):
+    def test_methods_agree_on_what_they_pick(self):
+        for name, place in placement.METHODS:
+            picks = place(random.Random(1), 64, 40, 10)
+            self.assertEqual(len(set(picks)), 40)
+            self.assertNotIn(10, picks)
+
+@unittest.skipIf(vecenv is None, "NumPy is not installed")
+class TestBenchVecEnv(unittest.TestCase):
+    def test_bench(self):
+        self.assertTrue(vecenv.bench(20, 3) > 0)
@@ -1,4 +1,8 @@
+import os
+import pstats
+import random
 import sys
+import tempfile
 from contextlib import contextmanager
 from StringIO import StringIO
 import unittest
@@ -129,6 +133,29 @@ class TestTrekGameWeapons(unittest.TestCase):
         self.assertEqual(print_result, expected)
         self.assertEqual(result, (284, 900, after_sector, 1))
 
+    def test_phasers_klingon_index(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True)
+        sector = [0] * 64
+        sector[50] = 4
+        sector[23] = -200
+        sector[0] = -200
+        # Only the Klingons in the index are fired upon
+        result = game.fire_phasers(1300, "Red", 300, 1500, sector, 50, 1,
+                                   [23])
+        self.assertEqual(result, (300, 200, sector, 0,
+                                  [trek.KlingonDestroyed(23)]))
+        self.assertEqual((sector[0], sector[23]), (-200, 0))
+
+    def test_phaser_distances(self):
+        for epos in range(64):
+            for kpos in range(64):
+                z = epos / 8 - kpos / 8
+                y = epos % 8 - kpos % 8
+                dist = 1
+                while (dist + 1) * (dist + 1) < z * z + y * y:
+                    dist = dist + 1
+                self.assertEqual(trek.DISTANCES[epos][kpos], dist)
+
     def test_phasers_0_ksec(self):
         """Phasers will deplete energy when there are no klingons"""
         game = trek.TrekGame(max_speed=True, test_mode=True)
@@ -236,15 +263,37 @@ class TestTrekGameWeapons(unittest.TestCase):
 
 class TestTrekGameGeneral(unittest.TestCase):
     def test_status(self):
-        game = trek.TrekGame(max_speed=True, test_mode=True)
+        game = trek.TrekGame(max_speed=True, test_mode=True, seed=8)
         with captured_output() as (out):
             game.status(1, 2, 3, 4, 5, 6, 7)
             result = out.getvalue().strip()
         expected = 'Stardate:            2\nCondition:           3\nEnergy:   \
            4\nPhoton torpedoes:    5\nShields:             6\nKlingons in \
-galaxy:  7'
+galaxy:  7\nGame seed:           8'
         self.assertEqual(result, expected)
 
+    def test_status_injected_rng(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True,
+                             rng=random.Random(8))
+        with captured_output() as (out):
+            game.status(1, 2, 3, 4, 5, 6, 7)
+            result = out.getvalue().strip()
+        self.assertIsNone(game.seed)
+        self.assertTrue(result.endswith('Klingons in galaxy:  7'))
+
+    def test_seed_reproducible(self):
+        game1 = trek.TrekGame(max_speed=True, test_mode=True, seed=1701)
+        game2 = trek.TrekGame(max_speed=True, test_mode=True, seed=1701)
+        state1 = game1.new_game()
+        state2 = game2.new_game()
+        self.assertEqual(state1.galaxy, state2.galaxy)
+        self.assertEqual(state1.current_sector, state2.current_sector)
+        self.assertEqual(state1.stardate, state2.stardate)
+
+    def test_seed_chosen(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True)
+        self.assertIsNotNone(game.seed)
+
     def test_blurb(self):
         game = trek.TrekGame(max_speed=True, test_mode=True)
         with captured_output() as (out):
@@ -490,6 +539,58 @@ galaxy:  7'
         self.assertEqual(print_result, expected)
         self.assertEqual(result, (2, 3, 7, 6))
 
+    def stepping_helm(self, game, warp, direction, sector, energy, cur_sec,
+                      epos, stardate):
+        # helm's original click-by-click movement, kept to check against
+        horiz = epos / 8
+        vert = epos - horiz * 8
+        hinc, vinc = game.calcvector(direction)
+        energy = energy - warp
+        cur_sec[epos] = 0
+        stardate = stardate + (0.1 * warp)
+        out = False
+        i = 1
+        while i <= warp and out == False:
+            vert = vert + vinc
+            horiz = horiz + hinc
+            if vert < 0 or vert > 7 or horiz < 0 or horiz > 7:
+                out = True
+                sector = game.join(sector + 8 * (horiz / 8) + (vert / 8))
+            else:
+                if cur_sec[vert + 8 * horiz] != 0:
+                    vert = vert - vinc
+                    horiz = horiz - hinc
+                epos = vert + 8 * horiz
+            i = i + 1
+        return (sector, energy, epos, stardate, [])
+
+    def test_helm_matches_stepping(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True)
+        crowded = [\
+        0, 0, 0, 0, 0, 0, 2, 0, \
+        0, 0, 2, 0, 0, 0, 0, 0, \
+        0, 0, 0, 0, 3, 0, 0, 0, \
+        0, 0, 0, 0, 0, 0, 0, 0, \
+        0, 0, 0, 0, 0, 0, 3, 0, \
+        0, 0, -200, 0, 0, 3, 0, 0, \
+        0, 0, 0, 0, 0, 0, 0, 0, \
+        0, 0, 0, 0, 0, 0, 0, 0]
+        for layout in ([0] * 64, crowded):
+            for epos in [i for i in range(64) if layout[i] == 0]:
+                for direction in (1, 2, 3, 4, 6, 7, 8, 9):
+                    for warp in range(1, 64):
+                        expected_sector = list(layout)
+                        expected_sector[epos] = 4
+                        cur_sec = list(expected_sector)
+                        expected = self.stepping_helm(game, warp, direction,
+                                                      9, 100, expected_sector,
+                                                      epos, 1200.0)
+                        result = game.navigate(direction, warp, 9, 100,
+                                               cur_sec, epos, 1200.0)
+                        self.assertEqual(result, expected,
+                                         (epos, direction, warp))
+                        self.assertEqual(cur_sec, expected_sector)
+
     def test_lrs(self):
         game = trek.TrekGame(max_speed=True, test_mode=True)
         galaxy = [\
@@ -551,10 +652,60 @@ galaxy:  7'
         result = game.calcvector(8)
         self.assertEqual(result, (-1, 0))
 
+    def test_rays(self):
+        self.assertEqual(trek.RAYS[50][8], ((42, 34, 26, 18, 10, 2), -8))
+        self.assertEqual(trek.RAYS[50][3], ((59,), 8))
+        self.assertEqual(trek.RAYS[63][9], ((), 1))
+        self.assertEqual(trek.RAYS[0][4], ((), -1))
+        self.assertIsNone(trek.RAYS[0][5])
+
+    def test_rays_match_calcvector(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True)
+        for epos in range(64):
+            for direction in (1, 2, 3, 4, 6, 7, 8, 9):
+                hinc, vinc = game.calcvector(direction)
+                horiz, vert = epos / 8, epos % 8
+                cells = []
+                while True:
+                    horiz, vert = horiz + hinc, vert + vinc
+                    if not (0 <= horiz <= 7 and 0 <= vert <= 7):
+                        break
+                    cells.append(vert + 8 * horiz)
+                offset = 8 * (horiz / 8) + vert / 8
+                self.assertEqual(trek.RAYS[epos][direction],
+                                 (tuple(cells), offset))
+
     def test_join_upper(self):
         game = trek.TrekGame(max_speed=True, test_mode=True)
         result = game.join(100)
-        self.assertEqual(result, (37))
+        self.assertEqual(result, (36))
+
+    def test_neighbours(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True)
+        for sector in range(64):
+            self.assertEqual(trek.NEIGHBOURS[sector],
+                             tuple(game.join(sector + i + j)
+                                   for i in (-8, 0, 8) for j in (-1, 0, 1)))
+        self.assertEqual(trek.NEIGHBOURS[63], (54, 55, 56, 62, 63, 0, 6, 7, 8))
+        self.assertEqual(trek.TORUS_NEIGHBOURS[63],
+                         (54, 55, 48, 62, 63, 56, 6, 7, 0))
+        self.assertEqual(trek.TORUS_NEIGHBOURS[8],
+                         (7, 0, 1, 15, 8, 9, 23, 16, 17))
+
+    def test_helm_torus(self):
+        # Off the right hand edge of the last sector in a row
+        for torus, expected in ((False, 8), (True, 0)):
+            game = trek.TrekGame(max_speed=True, test_mode=True, torus=torus)
+            cur_sec = [0] * 64
+            cur_sec[15] = 4
+            result = game.navigate(6, 2, 7, 100, cur_sec, 15, 1200.0)
+            self.assertEqual(result[0], expected)
+
+    def test_lrs_torus(self):
+        galaxy = range(64)
+        game = trek.TrekGame(max_speed=True, test_mode=True, torus=True)
+        self.assertEqual(game.lrs_frame(galaxy, 0),
+                         "\n063 056 057\n007 000 001\n015 008 009\n\n")
 
     def test_join_middle(self):
         game = trek.TrekGame(max_speed=True, test_mode=True)
@@ -574,3 +725,709 @@ galaxy:  7'
         expected = '1 - Helm\n2 - Long Range Scan\n3 - Phasers\n4 \
 - Photon Torpedoes\n5 - Shields\n6 - Resign'
         self.assertEqual(result, expected)
+
+class TestTrekGameStep(unittest.TestCase):
+    def make_state(self, ksec=1):
+        sector = [\
+        0, 0, 0, 0, 0, 0, 2, 0, \
+        0, 0, 0, 0, 0, 0, 0, 0, \
+        0, 0, 0, 0, 3, 0, 0, -200, \
+        0, 0, 0, 0, 0, 0, 0, 0, \
+        0, 0, 0, 0, 0, 0, 3, 0, \
+        0, 0, 0, 0, 0, 3, 0, 0, \
+        0, 0, 4, 0, 0, 0, 0, 0, \
+        0, 2, 0, 0, 0, 0, 0, 0]
+        if ksec == 0:
+            sector[23] = 0
+        galaxy = [5] * 64
+        galaxy[9] = 100 * ksec + 23
+        return trek.GameState(galaxy=galaxy, sector=9, ent_position=50,
+                              current_sector=sector, stardate=1200.0,
+                              klingons=1, ksec=ksec,
+                              condition=("Red" if ksec else "Green"))
+
+    def test_state_is_slotted(self):
+        state = trek.GameState()
+        self.assertFalse(hasattr(state, '__dict__'))
+        self.assertRaises(AttributeError, setattr, state, 'warp', 1)
+
+    def test_new_game(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True)
+        with captured_output() as (out):
+            state = game.new_game()
+            result = out.getvalue()
+        self.assertEqual(result, '')
+        self.assertEqual(len(state.galaxy), 64)
+        self.assertEqual(state.current_sector[state.ent_position], 4)
+        self.assertEqual(state.klingons,
+                         sum(game.decode(s)[0] for s in state.galaxy))
+        self.assertEqual(state.ksec, game.decode(state.galaxy[state.sector])[0])
+        self.assertEqual((state.energy, state.torpedoes, state.shields),
+                         (3000, 15, 0))
+
+    def test_step_phasers_win(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True)
+        state = self.make_state()
+        with captured_output() as (out):
+            result = game.step(state, 3, (1300,))
+            print_result = out.getvalue()
+        self.assertEqual(print_result, '')
+        self.assertEqual(result, (state, trek.WON))
+        self.assertEqual(state.galaxy[9], 23)
+        self.assertEqual((state.klingons, state.ksec), (0, 0))
+        self.assertEqual((state.energy, state.condition), (1700, "Green"))
+
+    def test_step_helm(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True)
+        state = self.make_state(ksec=0)
+        result = game.step(state, 1, (8, 2))
+        self.assertEqual(result, (state, None))
+        self.assertEqual(state.ent_position, 34)
+        self.assertEqual(state.current_sector[34], 4)
+        self.assertEqual(state.current_sector[50], 0)
+        self.assertEqual(state.energy, 2998)
+
+    def test_step_helm_bad_direction(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True)
+        state = self.make_state(ksec=0)
+        result = game.step(state, 1, (5,))
+        self.assertEqual(result, (state, None))
+        self.assertEqual((state.ent_position, state.energy), (50, 3000))
+
+    def test_step_resign(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True)
+        state = self.make_state(ksec=0)
+        result = game.step(state, 6)
+        self.assertEqual(result, (state, trek.LOST))
+
+class TestTrekGameCompact(unittest.TestCase):
+    galaxy = [\
+    104, 311, 1, 2, 5, 203, 304, 3, 103, 5, 5, 5, 312,\
+    13, 103, 2, 215, 11, 104, 303, 304, 312, 5, 301,\
+    103, 203, 305, 3, 104, 1, 204, 202, 14, 105, 304,\
+    302, 202, 305, 202, 204, 302, 12, 302, 201, 104,\
+    103, 301, 105, 313, 201, 3, 1, 104, 4, 102, 5,\
+    101, 204, 304, 3, 305, 3, 5, 2]
+
+    def test_galaxy_roundtrip(self):
+        galaxy = trek.Galaxy(self.galaxy)
+        self.assertEqual(list(galaxy), self.galaxy)
+        self.assertEqual(galaxy, self.galaxy)
+        self.assertEqual(galaxy.klingons[1], 3)
+        self.assertEqual(galaxy.starbases[1], 1)
+        self.assertEqual(galaxy.stars[1], 1)
+        galaxy[1] = galaxy[1] - 100
+        self.assertEqual(galaxy[1], 211)
+
+    def test_galaxy_lrs(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True)
+        with captured_output() as (out):
+            game.lrs(trek.Galaxy(self.galaxy), 50)
+            result = out.getvalue().strip()
+        expected = "012 302 201\n201 003 001\n204 304 003"
+        self.assertEqual(result, expected)
+
+    def test_sector_roundtrip(self):
+        cells = [0] * 64
+        cells[2], cells[9], cells[20], cells[50] = 2, 3, -200, 4
+        sector = trek.Sector(cells)
+        self.assertEqual(list(sector), cells)
+        self.assertEqual(sector.count(-200), 1)
+        self.assertEqual(len(sector.cells), 64)
+        sector[20] = -150
+        self.assertEqual(sector[20], -150)
+
+    def test_sector_klingon_slots(self):
+        sector = trek.Sector([0] * 64)
+        sector[1] = -200
+        sector[2] = -200
+        sector[1] = 0
+        sector[3] = -180
+        self.assertEqual(list(sector.energies), [180, 200])
+        self.assertEqual((sector[1], sector[2], sector[3]), (0, -200, -180))
+
+    def test_sector_huge_energy(self):
+        # Negative phaser power feeds the Klingons without limit
+        game = trek.TrekGame(max_speed=True, test_mode=True, seed=3)
+        state = game.new_game()
+        while state.ksec == 0:
+            state = game.new_game()
+        klingons = game.find_klingons(state.current_sector)
+        state, outcome = game.step(state, 3, (-10**12,))
+        for i in klingons:
+            self.assertTrue(state.current_sector[i] < -2**31)
+        self.assertEqual(state.current_sector.copy(), state.current_sector)
+        self.assertRaises(ValueError, game.save, state)
+
+    def test_new_game_compact(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True, seed=3)
+        state = game.new_game()
+        self.assertIsInstance(state.galaxy, trek.Galaxy)
+        self.assertIsInstance(state.current_sector, trek.Sector)
+        self.assertEqual(state.klingons, sum(state.galaxy.klingons))
+        # Phasers give the same results on a Sector as on a list
+        cells = list(state.current_sector)
+        with captured_output() as (out):
+            expected = game.phasers("Red", 0, 3000, cells,
+                                    state.ent_position, state.ksec, 1500)
+            result = game.phasers("Red", 0, 3000, state.current_sector,
+                                  state.ent_position, state.ksec, 1500)
+        self.assertEqual(result, expected)
+
+class RecordingSink(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, text):
+        self.writes.append(text)
+
+class TestTrekGameSink(unittest.TestCase):
+    def test_stream_sink(self):
+        out = StringIO()
+        game = trek.TrekGame(max_speed=True, test_mode=True,
+                             sink=trek.StreamSink(out))
+        with captured_output() as (stdout):
+            game.lrs(TestTrekGameCompact.galaxy, 50)
+        self.assertEqual(stdout.getvalue(), "")
+        self.assertEqual(out.getvalue(),
+                         "\n012 302 201\n201 003 001\n204 304 003\n\n")
+
+    def test_null_sink(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True,
+                             sink=trek.NullSink())
+        with captured_output() as (out):
+            game.main(0)
+        self.assertEqual(out.getvalue(), "")
+
+    def test_srs_one_frame(self):
+        sink = RecordingSink()
+        game = trek.TrekGame(max_speed=True, test_mode=True, sink=sink)
+        cur_sec = [0]*64
+        cur_sec[0] = 4
+        cur_sec[9] = -200
+        cur_sec[10] = 2
+        cur_sec[63] = 3
+        self.assertEqual(game.srs(cur_sec, 0), "Red")
+        self.assertEqual(len(sink.writes), 1)
+        rows = sink.writes[0].split("\n")
+        self.assertEqual(rows[0], "")
+        self.assertEqual(rows[1], "-O- " + " ".join([" . "]*7))
+        self.assertEqual(rows[2], " .  >!< <O> " + " ".join([" . "]*5))
+        self.assertEqual(rows[8], " ".join([" . "]*7) + "  * ")
+        self.assertEqual(rows[9:], [""])
+
+    def test_scan_one_frame(self):
+        sink = RecordingSink()
+        game = trek.TrekGame(max_speed=True, test_mode=True, seed=3,
+                             sink=sink)
+        state = game.new_game()
+        game.scan(state)
+        self.assertEqual(len(sink.writes), 1)
+        self.assertIn("Condition:           %s\n" % state.condition,
+                      sink.writes[0])
+        self.assertTrue(sink.writes[0].endswith("Game seed:           3 \n\n"))
+
+class TestTrekGamePacing(unittest.TestCase):
+    def test_virtual_clock(self):
+        clock = trek.VirtualClock()
+        game = trek.TrekGame(test_mode=True, sink=trek.NullSink(),
+                             clock=clock)
+        game.blurb()
+        self.assertEqual(clock.paused, 7.0)
+        game.lrs(TestTrekGameCompact.galaxy, 50)
+        self.assertEqual(clock.paused, 9.0)
+        self.assertEqual(clock.time(), 9.0)
+
+    def test_virtual_clock_max_speed(self):
+        clock = trek.VirtualClock()
+        game = trek.TrekGame(max_speed=True, test_mode=True,
+                             sink=trek.NullSink(), clock=clock)
+        game.blurb()
+        self.assertEqual(clock.paused, 0.0)
+
+    def test_pacer(self):
+        out = StringIO()
+        clock = trek.VirtualClock(100.0)
+        pacer = trek.Pacer(trek.StreamSink(out), clock)
+        game = trek.TrekGame(test_mode=True, sink=pacer, clock=pacer)
+        game.blurb()
+        # Nothing blocked and nothing has gone out yet
+        self.assertEqual(clock.time(), 100.0)
+        self.assertEqual(out.getvalue(), "")
+        self.assertEqual(pacer.deliver(), 101.5)
+        self.assertEqual(out.getvalue(), "\nSpace ... the final frontier.\n")
+        self.assertEqual(pacer.deliver(104.5), None)
+        self.assertTrue(out.getvalue().endswith("in the galaxy.\n"))
+
+    def test_pacer_idle(self):
+        # Pauses from long ago don't hold up new output
+        out = StringIO()
+        clock = trek.VirtualClock()
+        pacer = trek.Pacer(trek.StreamSink(out), clock)
+        pacer.pause(1.0)
+        clock.pause(5.0)
+        pacer.write("hello\n")
+        self.assertEqual(pacer.next_due(), 5.0)
+        pacer.pause(2.0)
+        pacer.write("again\n")
+        pacer.flush()
+        self.assertEqual(out.getvalue(), "hello\nagain\n")
+
+class TestTrekGamePlay(unittest.TestCase):
+    def test_play_matches_main(self):
+        answers = ['0', '2', '5', '100', '1', '8', '1', '6']
+        out = StringIO()
+        game = trek.TrekGame(max_speed=True, seed=5, sink=trek.StreamSink(out))
+        play = game.play()
+        prompts = [next(play)]
+        try:
+            for answer in answers:
+                prompts.append(play.send(answer))
+        except StopIteration:
+            pass
+        self.assertEqual(prompts[:5], ['Command (1-6, 0 for help)? ',
+                                       'Command (1-6, 0 for help)? ',
+                                       'Command (1-6, 0 for help)? ',
+                                       'Energy to shields? ',
+                                       'Command (1-6, 0 for help)? '])
+        feed = iter(answers)
+        keyboard = StringIO()
+        game = trek.TrekGame(max_speed=True, seed=5,
+                             sink=trek.StreamSink(keyboard))
+        game.test_input = lambda prompt, input: next(feed)
+        game.main()
+        self.assertEqual(out.getvalue(), keyboard.getvalue())
+        self.assertTrue(out.getvalue().endswith("relieved of duty.\n"))
+
+class TestTrekGameEvents(unittest.TestCase):
+    commands = [(3, (500,)), (2, ()), (4, (6,)), (7, ()), (5, (100,)),
+                (1, (8, 3)), (1, (5,)), (4, (1,)), (6, ())]
+
+    def test_event_text(self):
+        self.assertEqual(trek.event_text(trek.ShieldsHit(12)),
+                         "Hit on shields:  12  energy units")
+        self.assertEqual(trek.event_text(trek.TorpedoMissed(None)),
+                         "Torpedo missed")
+        self.assertIs(trek.Docked(3).text, None)
+
+    def test_subscribe(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True,
+                             sink=trek.NullSink())
+        heard = game.subscribe([].append)
+        game.tell([trek.RedAlert(), trek.ShieldsHit(40)])
+        game.unsubscribe(heard)
+        game.tell([trek.EnterpriseDead()])
+        self.assertEqual(heard.__self__, [trek.RedAlert(), trek.ShieldsHit(40)])
+
+    def test_step_publishes(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True, seed=1)
+        heard = []
+        game.subscribe(heard.append)
+        state = game.new_game()
+        game.step(state, 6)
+        self.assertEqual(heard, [trek.Resigned(), trek.Relieved()])
+
+    def test_play_and_step_agree(self):
+        for seed in range(20):
+            game = trek.TrekGame(max_speed=True, seed=seed,
+                                 sink=trek.NullSink())
+            played = game.subscribe([].append).__self__
+            play = game.play()
+            next(play)
+            try:
+                for command, args in self.commands:
+                    play.send(command)
+                    for arg in args:
+                        play.send(arg)
+            except StopIteration:
+                pass
+            game = trek.TrekGame(max_speed=True, seed=seed)
+            stepped = game.subscribe([].append).__self__
+            state = game.new_game()
+            for command, args in self.commands:
+                state, outcome = game.step(state, command, args)
+                if outcome is not None:
+                    break
+            self.assertEqual(played, stepped, seed)
+            self.assertIn(played[-1], (trek.Promoted(), trek.Relieved()))
+
+class TestTrekGameSnapshot(unittest.TestCase):
+    commands = [(5, (300,)), (3, (400,)), (1, (8, 9)), (2, ()), (4, (6,)),
+                (1, (3, 20)), (3, (200,)), (1, (4, 9)), (6, ())]
+
+    def play_out(self, game, state):
+        heard = game.subscribe([].append).__self__
+        for command, args in self.commands:
+            state, outcome = game.step(state, command, args)
+            if outcome is not None:
+                break
+        return heard, game.save(state)
+
+    def test_roundtrip(self):
+        game = trek.TrekGame(max_speed=True, seed=11)
+        state = game.new_game()
+        data = game.save(state)
+        self.assertEqual(len(data), trek.SNAPSHOT.size)
+        restored = trek.TrekGame(max_speed=True)
+        loaded = restored.load(data)
+        self.assertEqual(restored.seed, 11)
+        for name in trek.GameState.__slots__:
+            self.assertEqual(getattr(loaded, name), getattr(state, name), name)
+        self.assertEqual(restored.save(loaded), data)
+
+    def test_restore_carries_on(self):
+        for seed in range(10):
+            game = trek.TrekGame(max_speed=True, seed=seed)
+            state = game.new_game()
+            game.step(state, 5, (500,))
+            data = game.save(state)
+            restored = trek.TrekGame(max_speed=True, rng=random.Random())
+            self.assertEqual(self.play_out(restored, restored.load(data)),
+                             self.play_out(game, state))
+
+    def test_list_state(self):
+        game = trek.TrekGame(max_speed=True, seed=2)
+        state = game.new_game()
+        state.galaxy = list(state.galaxy)
+        state.current_sector = list(state.current_sector)
+        self.assertEqual(game.load(game.save(state)).current_sector,
+                         state.current_sector)
+
+    def test_bad_snapshot(self):
+        game = trek.TrekGame(max_speed=True, seed=2)
+        data = game.save(game.new_game())
+        self.assertRaises(ValueError, game.load, 'XXXX' + data[4:])
+
+    def test_only_classic_games(self):
+        data = trek.TrekGame(max_speed=True, seed=21).save(
+            trek.TrekGame(max_speed=True, seed=21).new_game())
+        for options in ({'galaxy_size': (32, 32)}, {'sector_size': (4, 4)},
+                        {'torus': True}, {'sector_cache': 8}):
+            game = trek.TrekGame(max_speed=True, seed=21, **options)
+            self.assertRaises(ValueError, game.save, game.new_game())
+            self.assertRaises(ValueError, game.load, data)
+
+    def test_snapshot_file(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            games = [trek.TrekGame(max_speed=True, seed=seed)
+                     for seed in range(3)]
+            saved = [game.save(game.new_game()) for game in games]
+            with trek.SnapshotFile(path, 3) as snapshots:
+                for i in range(3):
+                    snapshots[i] = saved[i]
+            self.assertEqual(os.path.getsize(path), 3 * trek.SNAPSHOT.size)
+            with trek.SnapshotFile(path) as snapshots:
+                self.assertEqual(len(snapshots), 3)
+                self.assertEqual(snapshots[-1], saved[2])
+                game = trek.TrekGame(max_speed=True)
+                state = game.load(snapshots.map, trek.SNAPSHOT.size)
+                self.assertEqual(game.seed, 1)
+                self.assertEqual(game.save(state), saved[1])
+                self.assertRaises(IndexError, snapshots.__getitem__, 3)
+        finally:
+            os.remove(path)
+
+class TestTrekGameCondition(unittest.TestCase):
+    def test_ksec_not_map(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True)
+        sector = [0] * 64
+        sector[20] = -200
+        self.assertEqual(game.scan_condition(sector, 40), "Red")
+        self.assertEqual(game.scan_condition(sector, 40, 1), "Red")
+        self.assertEqual(game.scan_condition(sector, 40, 0), "Green")
+        sector[39] = 2
+        self.assertEqual(game.scan_condition(sector, 40, 1), "Docked")
+
+    def test_ksec_matches_map(self):
+        # The Klingon count kept as the game goes on always agrees with
+        # what a full scan of the map would say
+        for seed in range(30):
+            game = trek.TrekGame(max_speed=True, seed=seed)
+            state = game.new_game()
+            policy = random.Random(seed)
+            for i in range(200):
+                command = policy.choice((1, 1, 3, 4, 5))
+                args = (policy.choice((1, 2, 3, 4, 6, 7, 8, 9)),
+                        policy.randint(1, 10))
+                if command in (3, 5):
+                    args = (policy.randint(1, 400),)
+                state, outcome = game.step(state, command, args)
+                if outcome is not None:
+                    break
+                self.assertEqual(state.ksec, len([i for i in state.current_sector
+                                                  if i < 0]))
+                self.assertEqual(state.condition,
+                                 game.scan_condition(state.current_sector,
+                                                     state.ent_position))
+
+class TestTrekGameGeometry(unittest.TestCase):
+    def test_classic_tables(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True)
+        self.assertIs(game.geometry.rays, trek.RAYS)
+        self.assertIs(game.neighbours, trek.NEIGHBOURS)
+        self.assertIs(game.geometry, trek.geometry())
+
+    def test_small_sectors(self):
+        self.assertRaises(ValueError, trek.geometry, (8, 8), (3, 3))
+        self.assertRaises(ValueError, trek.geometry, (0, 8))
+
+    def test_sector_size(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True, seed=1,
+                             galaxy_size=(5, 7), sector_size=(4, 6))
+        state = game.new_game()
+        self.assertEqual(len(state.galaxy), 35)
+        self.assertEqual(len(state.current_sector), 24)
+        rows = game.srs_frame(state.current_sector).split("\n")[1:-1]
+        self.assertEqual([len(row) for row in rows], [23] * 4)
+        self.assertEqual(game.join(35), 0)
+        self.assertRaises(ValueError, game.save, state)
+
+    def test_large_galaxy(self):
+        # A million sectors, generated as the Enterprise gets to them
+        game = trek.TrekGame(max_speed=True, test_mode=True, seed=13,
+                             galaxy_size=(1024, 1024))
+        state = game.new_game()
+        self.assertIsInstance(state.galaxy, trek.LazyGalaxy)
+        self.assertEqual(state.klingons, state.galaxy.total_klingons())
+        sectors = set([state.sector])
+        for i in range(20):
+            state.energy = 3000
+            state, outcome = game.step(state, 1, (6, 40))
+            sectors.add(state.sector)
+        self.assertTrue(len(sectors) > 1)
+        for sector in (0, 1048575, 524288):
+            state.current_sector[state.ent_position] = 0
+            game.arrive(state, sector)
+            self.assertEqual(state.ksec, state.galaxy[sector] / 100)
+            self.assertEqual(len(state.klingon_positions), state.ksec)
+        self.assertEqual(state.galaxy.changed, {})
+
+    def test_lazy_galaxy(self):
+        galaxy = trek.LazyGalaxy(5000, 99)
+        self.assertEqual(list(galaxy), list(trek.LazyGalaxy(5000, 99)))
+        self.assertEqual(galaxy.total_klingons(), sum(s / 100 for s in galaxy))
+        klingons = galaxy.total_klingons()
+        for i in range(5000):
+            if galaxy[i] >= 100:
+                break
+        galaxy[i] = galaxy[i] - 100
+        self.assertEqual(galaxy.total_klingons(), klingons - 1)
+        self.assertEqual(galaxy[-5000], galaxy[0])
+        self.assertRaises(IndexError, galaxy.__getitem__, 5000)
+
+    def layouts(self, sector_cache):
+        # The sector map as we leave it and as we find it on coming back
+        game = trek.TrekGame(max_speed=True, test_mode=True, seed=5,
+                             sector_cache=sector_cache)
+        state = game.new_game()
+        first = state.sector
+        state.current_sector[state.ent_position] = 0
+        left = list(state.current_sector)
+        game.arrive(state, (first + 1) % 64)
+        state.current_sector[state.ent_position] = 0
+        game.arrive(state, first)
+        state.current_sector[state.ent_position] = 0
+        return left, list(state.current_sector)
+
+    def test_sector_cache(self):
+        left, found = self.layouts(2)
+        self.assertEqual(left, found)
+        # Leaving the second sector pushed the first out
+        left, found = self.layouts(1)
+        self.assertNotEqual(left, found)
+        left, found = self.layouts(0)
+        self.assertNotEqual(left, found)
+
+    def test_sector_cache_bounded(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True, seed=5,
+                             sector_cache=3)
+        state = game.new_game()
+        for sector in range(10):
+            state.current_sector[state.ent_position] = 0
+            game.arrive(state, sector)
+        self.assertEqual(list(game.layouts), [6, 7, 8])
+
+class TestTrekGamePlacement(unittest.TestCase):
+    def test_free_positions(self):
+        rng = random.Random(1)
+        for count in range(64):
+            picks = trek.free_positions(rng, 64, count, 20)
+            self.assertEqual(len(set(picks)), count)
+            self.assertNotIn(20, picks)
+            self.assertTrue(all(0 <= p < 64 for p in picks))
+
+    def test_free_positions_full(self):
+        picks = trek.free_positions(random.Random(2), 64, 63, 63)
+        self.assertEqual(sorted(picks), range(63))
+        self.assertRaises(ValueError, trek.free_positions, random.Random(2),
+                          64, 64, 0)
+
+    def test_free_positions_draws(self):
+        # One draw for each object, however full the sector gets
+        rng = random.Random(3)
+        trek.free_positions(rng, 1024, 1000, 5)
+        expected = random.Random(3)
+        for i in range(1000):
+            expected.random()
+        self.assertEqual(rng.getstate(), expected.getstate())
+
+    def test_free_positions_reproducible(self):
+        self.assertEqual(trek.free_positions(random.Random(4), 64, 9, 0),
+                         trek.free_positions(random.Random(4), 64, 9, 0))
+
+    def test_init_dense(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True, seed=5,
+                             sector_size=(2, 5))
+        result = game.init(3, 1, 5, 0)
+        self.assertEqual(sorted(result), [-200] * 3 + [2] + [3] * 5 + [4])
+
+class TestTrekGamePool(unittest.TestCase):
+    def test_take_started_game(self):
+        pool = trek.StartPool(4, start=False)
+        pool.ready.put(pool.make())
+        game = trek.TrekGame(max_speed=True, test_mode=True, pool=pool)
+        state = game.new_game()
+        # Just as if the game had been started from the seed it was given
+        fresh = trek.TrekGame(max_speed=True, test_mode=True, seed=game.seed)
+        self.assertEqual(state.galaxy, fresh.new_game().galaxy)
+        self.assertEqual(game.rng.getstate(), fresh.rng.getstate())
+        self.assertEqual(pool.stats(), {'hits': 1, 'misses': 0, 'ready': 0,
+                                        'size': 4})
+
+    def test_dry_pool(self):
+        pool = trek.StartPool(4, start=False)
+        game = trek.TrekGame(max_speed=True, test_mode=True, pool=pool)
+        seed = game.seed
+        self.assertEqual(game.new_game().galaxy,
+                         trek.TrekGame(seed=seed).new_game().galaxy)
+        self.assertEqual(game.seed, seed)
+        self.assertEqual((pool.hits, pool.misses), (0, 1))
+
+    def test_seeded_game_ignores_pool(self):
+        pool = trek.StartPool(4, start=False)
+        pool.ready.put(pool.make())
+        game = trek.TrekGame(max_speed=True, test_mode=True, seed=5, pool=pool)
+        self.assertEqual(game.new_game().galaxy,
+                         trek.TrekGame(seed=5).new_game().galaxy)
+        self.assertEqual(game.seed, 5)
+        rng = random.Random(6)
+        game = trek.TrekGame(max_speed=True, test_mode=True, rng=rng,
+                             pool=pool)
+        self.assertEqual(game.new_game().galaxy,
+                         trek.TrekGame(rng=random.Random(6)).new_game().galaxy)
+        self.assertEqual(pool.stats(), {'hits': 0, 'misses': 0, 'ready': 1,
+                                        'size': 4})
+
+    def test_fill(self):
+        pool = trek.StartPool(3)
+        try:
+            starts = [pool.ready.get(timeout=5) for i in range(5)]
+        finally:
+            pool.stop()
+        self.assertEqual(len(set(start[0] for start in starts)), 5)
+        self.assertTrue(pool.thread is None)
+
+    def test_geometry_must_match(self):
+        pool = trek.StartPool(start=False, torus=True)
+        self.assertRaises(ValueError, trek.TrekGame, pool=pool)
+        trek.TrekGame(torus=True, pool=pool)
+
+class TestTrekGameProfile(unittest.TestCase):
+    def test_autoplay(self):
+        self.assertEqual(trek.autoplay(4), trek.autoplay(4))
+        self.assertEqual(trek.autoplay(4, max_commands=2), 2)
+
+    def test_profile(self):
+        folder = tempfile.mkdtemp()
+        out = os.path.join(folder, 'profile')
+        report = StringIO()
+        try:
+            trek.profile(5, out=out, report=report)
+            stats = pstats.Stats(out + '.pstats')
+            self.assertIn('navigate', [f[2] for f in stats.stats])
+            with open(out + '.folded') as f:
+                for line in f:
+                    stack, count = line.rsplit(' ', 1)
+                    self.assertTrue(int(count) > 0)
+        finally:
+            for name in os.listdir(folder):
+                os.remove(os.path.join(folder, name))
+            os.rmdir(folder)
+        self.assertIn('5 games', report.getvalue())
+
+    def test_profile_no_games(self):
+        # --profile 0 profiles nothing rather than starting a game
+        folder = tempfile.mkdtemp()
+        out = os.path.join(folder, 'profile')
+        try:
+            with captured_output() as (report):
+                trek.main(['--profile', '0', '--out', out])
+            self.assertTrue(os.path.exists(out + '.pstats'))
+        finally:
+            for name in os.listdir(folder):
+                os.remove(os.path.join(folder, name))
+            os.rmdir(folder)
+        self.assertIn('0 games, 0 commands', report.getvalue())
+
+    def test_sampler_names(self):
+        sampler = trek.Sampler()
+        sampler.sample(None, sys._getframe())
+        stack = list(sampler.stacks)[0]
+        self.assertEqual(stack[-1], 'test_trek.py:test_sampler_names')
+        sampler.stacks[('TrekGame.play', 'TrekGame.scan')] = 3
+        self.assertEqual(sampler.by_method(),
+                         {'TrekGame.play': 3, 'TrekGame.scan': 3})
+
+class TestTrekGameScript(unittest.TestCase):
+    def output(self, script, echo=False, seed=3):
+        sink = RecordingSink()
+        game = trek.TrekGame(max_speed=True, seed=seed, sink=sink)
+        game.main(script=script, echo=echo)
+        return ''.join(sink.writes)
+
+    def answered(self, answers, seed=3):
+        # The same game with its prompts answered one at a time
+        sink = RecordingSink()
+        play = trek.TrekGame(max_speed=True, seed=seed, sink=sink).play()
+        next(play)
+        try:
+            for answer in answers:
+                play.send(answer)
+        except StopIteration:
+            pass
+        return ''.join(sink.writes)
+
+    def test_read_script(self):
+        self.assertEqual(list(trek.read_script("1 8 3; 3 500;4 6 # fire\n")),
+                         [[1, 8, 3], [3, 500], [4, 6]])
+        self.assertEqual(list(trek.read_script(["2\n", "\n", "5 100; 0\n"])),
+                         [[2], [5, 100], [0]])
+        self.assertRaises(ValueError, list, trek.read_script("1 north"))
+
+    def test_same_as_answering(self):
+        self.assertEqual(self.output("2; 1 8 3; 5 100; 0; 6"),
+                         self.answered(['2', '1', '8', '3', '5', '100', '0',
+                                        '6']))
+
+    def test_file(self):
+        script = StringIO("2\n0\n6\n")
+        self.assertEqual(self.output(script),
+                         self.answered(['2', '0', '6']))
+
+    def test_echo(self):
+        output = self.output("1 8 3", echo=True)
+        self.assertIn("Command (1-6, 0 for help)? 1\n"
+                      "Course direction(1-9)? 8\nWarp (1-63)? 3\n", output)
+
+    def test_extra_arguments_ignored(self):
+        # A bad course asks for no warp
+        self.assertEqual(self.output("1 5 3; 0"), self.output("1 5; 0"))
+
+    def test_missing_arguments(self):
+        self.assertRaises(ValueError, self.output, "1 8; 2")
+
+    def test_stops_with_script(self):
+        output = self.output("0")
+        self.assertTrue(output.endswith("6 - Resign\n"))
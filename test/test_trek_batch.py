@@ -0,0 +1,202 @@
+import unittest
+
+import trek
+
+try:
+    import numpy
+    import trek_batch
+except ImportError:
+    numpy = None
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestGenerateGalaxies(unittest.TestCase):
+    def test_shape(self):
+        galaxies, klingons = trek_batch.generate_galaxies(5, seed=1)
+        self.assertEqual(galaxies.shape, (5, 64))
+        self.assertEqual(galaxies.dtype, trek_batch.SECTOR_DTYPE)
+        self.assertEqual(klingons.shape, (5,))
+
+    def test_ranges(self):
+        galaxies, klingons = trek_batch.generate_galaxies(200, seed=2)
+        self.assertEqual(galaxies['klingons'].min(), 0)
+        self.assertEqual(galaxies['klingons'].max(), 3)
+        self.assertEqual(galaxies['starbases'].max(), 1)
+        self.assertEqual(galaxies['stars'].min(), 1)
+        self.assertEqual(galaxies['stars'].max(), 5)
+        self.assertEqual(klingons.tolist(),
+                         galaxies['klingons'].sum(axis=1).tolist())
+
+    def test_distribution(self):
+        galaxies, klingons = trek_batch.generate_galaxies(2000, seed=3)
+        self.assertAlmostEqual((galaxies['klingons'] > 0).mean(), 0.7, 2)
+        self.assertAlmostEqual(galaxies['starbases'].mean(), 0.12, 2)
+        self.assertAlmostEqual(galaxies['stars'].mean(), 3.0, 1)
+        self.assertAlmostEqual(klingons.mean(), 64 * 0.7 * 2, 0)
+
+    def test_seed_reproducible(self):
+        first = trek_batch.generate_galaxies(3, seed=4)
+        second = trek_batch.generate_galaxies(3, seed=4)
+        self.assertTrue((first[0] == second[0]).all())
+
+    def test_encode(self):
+        galaxies, klingons = trek_batch.generate_galaxies(3, seed=5)
+        packed = trek_batch.encode(galaxies)
+        game = trek.TrekGame(max_speed=True, test_mode=True)
+        for i in range(3):
+            for j in range(64):
+                sector = galaxies[i, j]
+                self.assertEqual(game.decode(int(packed[i, j])),
+                                 (sector['klingons'], sector['starbases'],
+                                  sector['stars']))
+
+    def test_new_game(self):
+        galaxies, klingons = trek_batch.generate_galaxies(1, seed=6)
+        galaxy = trek_batch.encode(galaxies)[0].tolist()
+        game = trek.TrekGame(max_speed=True, test_mode=True, seed=6)
+        state = game.new_game(galaxy)
+        self.assertEqual(state.galaxy, galaxy)
+        self.assertEqual(state.klingons, klingons[0])
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestTrekVecEnv(unittest.TestCase):
+    def make_state(self):
+        sector = [\
+        0, 0, 0, 0, 0, 0, 2, 0, \
+        0, 0, 2, 0, 0, 0, 0, 0, \
+        0, 0, 0, 0, 3, 0, 0, -200, \
+        0, 0, 0, 0, 0, 0, 0, 0, \
+        0, 0, 0, 0, 0, 0, 3, 0, \
+        0, 0, -200, 0, 0, 3, 0, 0, \
+        0, 0, 4, 0, 0, 0, 0, 0, \
+        0, 0, 0, 0, 0, 0, 0, 0]
+        galaxy = [5] * 64
+        galaxy[9] = 223
+        return trek.GameState(galaxy=galaxy, sector=9, ent_position=50,
+                              current_sector=sector, stardate=1200.0,
+                              klingons=3, ksec=2, condition="Red",
+                              klingon_positions=[23, 42])
+
+    def make_env(self, n=4):
+        env = trek_batch.TrekVecEnv(n, seed=1)
+        # Keep the Klingons from firing back so results are predictable
+        env.klingons_attack = lambda indices: None
+        for i in range(n):
+            env.set_state(i, self.make_state())
+        return env
+
+    def check_against_game(self, commands, args):
+        env = self.make_env(len(commands))
+        env.step(commands, args)
+        game = trek.TrekGame(max_speed=True, test_mode=True, seed=1)
+        game.klingons_attack = lambda state: None
+        for i, command in enumerate(commands):
+            state = self.make_state()
+            game.step(state, command, tuple(args[i]))
+            result = env.get_state(i)
+            for name in trek.GameState.__slots__:
+                self.assertEqual(getattr(result, name), getattr(state, name),
+                                 (command, args[i], name))
+
+    def test_reset(self):
+        env = trek_batch.TrekVecEnv(50, seed=2)
+        self.assertTrue((env.energy == 3000).all())
+        self.assertTrue((env.current_sector[numpy.arange(50),
+                                            env.ent_position] == 4).all())
+        self.assertTrue((env.outcome() == trek_batch.PLAYING).all())
+        game = trek.TrekGame(max_speed=True, test_mode=True)
+        for i in range(50):
+            state = env.get_state(i)
+            klingons, bases, stars = game.decode(state.galaxy[state.sector])
+            self.assertEqual(state.current_sector.count(-200), klingons)
+            self.assertEqual(state.current_sector.count(2), bases)
+            self.assertEqual(state.current_sector.count(3), stars)
+            self.assertEqual(state.ksec, klingons)
+
+    def test_reset_layout(self):
+        # Objects fall on every cell other than the Enterprise's equally
+        # often, and a full sector still fits
+        env = trek_batch.TrekVecEnv(4000, seed=3)
+        objects = ((env.current_sector != 0)
+                   & (env.current_sector != 4)).sum(axis=0)
+        self.assertTrue(objects.min() > 0.8 * objects.mean())
+        self.assertTrue(objects.max() < 1.2 * objects.mean())
+        env.galaxy[0, 5] = 999
+        env.enter_sector(numpy.array([0]), numpy.array([5]))
+        self.assertEqual(sorted(env.current_sector[0]).count(0), 64 - 28)
+
+    def test_helm(self):
+        self.check_against_game([1] * 8, [[8, 1], [8, 3], [9, 2], [6, 4],
+                                          [4, 2], [7, 64], [5, 1], [3, 1]])
+
+    def test_helm_leave_sector(self):
+        env = self.make_env(1)
+        env.step([1], [[6, 8]])
+        state = env.get_state(0)
+        self.assertEqual(state.sector, 10)
+        self.assertEqual(state.stardate, 1200.8)
+        self.assertEqual(state.current_sector[state.ent_position], 4)
+        self.assertEqual(state.ksec, 0)
+
+    def test_phasers(self):
+        self.check_against_game([3] * 4, [[300, 0], [1000, 0], [5000, 0],
+                                          [-40, 0]])
+
+    def test_phasers_huge(self):
+        # Negative power feeds the Klingons far past what 32 bits hold
+        self.check_against_game([3] * 2, [[-3 * 10**10, 0],
+                                          [-3 * 10**17, 0]])
+
+    def test_photontorpedoes(self):
+        self.check_against_game([4] * 6, [[8, 0], [9, 0], [7, 0], [2, 0],
+                                          [5, 0], [1, 0]])
+
+    def test_shields_and_resign(self):
+        self.check_against_game([5, 5, 5, 6, 2, 0],
+                                [[500, 0], [-5, 0], [4000, 0], [0, 0],
+                                 [0, 0], [0, 0]])
+
+    def test_game_over_ignores_commands(self):
+        env = self.make_env(2)
+        outcome = env.step([6, 2])
+        self.assertEqual(outcome.tolist(), [trek_batch.LOST,
+                                            trek_batch.PLAYING])
+        env.step([5, 5], [[100, 0], [100, 0]])
+        self.assertEqual(env.shields.tolist(), [0, 100])
+        env.reset([0])
+        self.assertEqual(env.outcome().tolist(), [trek_batch.PLAYING] * 2)
+
+    def test_lrs(self):
+        env = self.make_env(1)
+        env.galaxy[0] = [\
+        104, 311, 1, 2, 5, 203, 304, 3, 103, 5, 5, 5, 312,\
+        13, 103, 2, 215, 11, 104, 303, 304, 312, 5, 301,\
+        103, 203, 305, 3, 104, 1, 204, 202, 14, 105, 304,\
+        302, 202, 305, 202, 204, 302, 12, 302, 201, 104,\
+        103, 301, 105, 313, 201, 3, 1, 104, 4, 102, 5,\
+        101, 204, 304, 3, 305, 3, 5, 2]
+        env.sector[0] = 50
+        self.assertEqual(env.lrs()[0].tolist(), [[12, 302, 201],
+                                                 [201, 3, 1],
+                                                 [204, 304, 3]])
+
+    def test_lrs_matches_game(self):
+        for torus in (False, True):
+            env = trek_batch.TrekVecEnv(64, seed=3, torus=torus)
+            env.sector[:] = range(64)
+            game = trek.TrekGame(max_speed=True, test_mode=True, torus=torus)
+            for i, scan in enumerate(env.lrs()):
+                rows = ["%03d %03d %03d" % tuple(row) for row in scan]
+                self.assertEqual(game.lrs_frame(env.galaxy[i], i),
+                                 "\n" + "\n".join(rows) + "\n\n")
+
+    def test_helm_torus(self):
+        env = self.make_env(1)
+        env.neighbours = trek_batch.TORUS_NEIGHBOURS
+        env.sector[0] = 15
+        env.step([1], [[6, 8]])
+        self.assertEqual(env.sector[0], 8)
+
+    def test_distances(self):
+        self.assertEqual(trek_batch.DISTANCES[50, 23], 6)
+        self.assertEqual(trek_batch.DISTANCES[0, 63], 9)
+        self.assertEqual(trek_batch.DISTANCES[9, 9], 1)
@@ -0,0 +1,115 @@
+import threading
+import time
+import urllib2
+import unittest
+
+import trek
+import trek_metrics
+
+def play(game, metrics, answers):
+    # Answer the game's prompts in turn until it ends or we run out
+    play = metrics.measure(game.play(), game)
+    next(play)
+    try:
+        for answer in answers:
+            play.send(answer)
+    except StopIteration:
+        pass
+
+class TestHistogram(unittest.TestCase):
+    def test_observe(self):
+        histogram = trek_metrics.Histogram()
+        for value in (0.00005, 0.0001, 0.003, 100):
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 4)
+        self.assertEqual(snapshot['buckets'][0], 2)
+        self.assertEqual(snapshot['buckets'][5], 1)
+        self.assertEqual(snapshot['buckets'][-1], 1)
+
+class TestThreadTime(unittest.TestCase):
+    @unittest.skipIf(trek_metrics.thread_time is time.clock,
+                     "no per-thread processor time here")
+    def test_other_threads_not_counted(self):
+        # A busy thread, like a StartPool filling up, while we sleep
+        def spin():
+            started = time.time()
+            while time.time() - started < 0.3:
+                pass
+        busy = threading.Thread(target=spin)
+        before = trek_metrics.thread_time()
+        busy.start()
+        busy.join()
+        self.assertTrue(trek_metrics.thread_time() - before < 0.1)
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = trek_metrics.Metrics()
+        self.clock = trek.VirtualClock()
+        self.game = trek.TrekGame(seed=3, sink=trek.NullSink(),
+                                  clock=self.clock)
+
+    def test_commands(self):
+        play(self.game, self.metrics, ['0', '2', '0', '6'])
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(sorted(snapshot['commands']),
+                         ['help', 'lrs', 'resign'])
+        self.assertEqual(snapshot['commands']['help']['calls'], 2)
+        self.assertEqual(snapshot['commands']['help']['wall']['count'], 2)
+        self.assertEqual(snapshot['counters']['games_started'], 1)
+        self.assertEqual(snapshot['counters']['games_lost'], 1)
+
+    def test_pacing(self):
+        # A long range scan pauses, but a virtual clock never blocks
+        play(self.game, self.metrics, ['2', '6'])
+        lrs = self.metrics.snapshot()['commands']['lrs']
+        self.assertEqual(lrs['paced'], trek.LRS_PAUSE)
+        self.assertTrue(lrs['slept'] < 0.1)
+        self.assertEqual(lrs['logic'], lrs['wall']['sum'] - lrs['slept'])
+
+    def test_arguments_not_timed_apart(self):
+        # Helm asks twice but is one command
+        play(self.game, self.metrics, ['1', '4', '1', '6'])
+        commands = self.metrics.snapshot()['commands']
+        self.assertEqual(commands['helm']['calls'], 1)
+
+    def test_game_counters(self):
+        self.metrics.event(trek.KlingonDestroyed(3))
+        self.metrics.event(trek.ShieldsHit(40))
+        self.metrics.event(trek.Docked(12))
+        counters = self.metrics.snapshot()['counters']
+        self.assertEqual((counters['klingons_destroyed'],
+                          counters['shield_hits'], counters['dockings']),
+                         (1, 1, 1))
+
+    def test_prometheus(self):
+        self.metrics.observe(1, 0.002, 0.001, 0.5, 0.0)
+        self.metrics.observe(1, 0.2, 0.1)
+        text = self.metrics.prometheus()
+        self.assertIn('trek_commands_total{command="helm"} 2\n', text)
+        self.assertIn('trek_command_wall_seconds_bucket'
+                      '{command="helm",le="0.0025"} 1\n', text)
+        self.assertIn('trek_command_wall_seconds_bucket'
+                      '{command="helm",le="+Inf"} 2\n', text)
+        self.assertIn('trek_command_paced_seconds_total{command="helm"} 0.5\n',
+                      text)
+        self.assertIn('# TYPE trek_dockings_total counter\n', text)
+
+    def test_serve(self):
+        self.metrics.observe(2, 0.001, 0.001)
+        server = self.metrics.serve(port=0)
+        try:
+            url = 'http://127.0.0.1:%d' % server.server_address[1]
+            self.assertEqual(urllib2.urlopen(url + '/metrics').read(),
+                             self.metrics.prometheus())
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen, url + '/')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_main(self):
+        game = trek.TrekGame(max_speed=True, test_mode=True, seed=3,
+                             sink=trek.NullSink(), metrics=self.metrics)
+        game.main(test_arg=0)
+        self.assertEqual(self.metrics.snapshot()['commands']['help']['calls'],
+                         1)
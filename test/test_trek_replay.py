@@ -0,0 +1,136 @@
+import random
+from StringIO import StringIO
+import unittest
+
+import trek
+import trek_replay
+
+class TestCommandLog(unittest.TestCase):
+    def test_varint(self):
+        for n in (0, 1, -1, 63, -64, 64, 127, 128, 3000, -3000, 2**40):
+            out = []
+            trek_replay.put_varint(out, n)
+            self.assertEqual(trek_replay.get_varint(out, 0), (n, len(out)))
+
+    def test_pack_roundtrip(self):
+        log = trek_replay.CommandLog(2**32 - 1)
+        for command, args in [(1, (8, 3)), (1, (5,)), (3, (-7,)), (0, ()),
+                              (-4, ()), (1000, ()), (5, (100000,))]:
+            log.add(command, args)
+        state = trek.GameState(sector=63, ent_position=9, stardate=1234.5,
+                               klingons=12)
+        log.finish(state, trek.LOST)
+        data = log.pack()
+        self.assertEqual(trek_replay.CommandLog.unpack(data), log)
+        # A few bytes a command on top of the header and final state
+        self.assertEqual(len(data), 63 + 15)
+
+    def test_unpack_bad(self):
+        log = trek_replay.record(3)
+        data = log.pack()
+        self.assertRaises(trek_replay.LogError, trek_replay.CommandLog.unpack,
+                          'XXXX' + data[4:])
+        self.assertRaises(trek_replay.LogError, trek_replay.CommandLog.unpack,
+                          data[:-1])
+        self.assertRaises(trek_replay.LogError, trek_replay.CommandLog.unpack,
+                          data + '\0')
+
+    def test_no_seed(self):
+        self.assertRaises(trek_replay.LogError, trek_replay.CommandLog, None)
+
+class TestReplay(unittest.TestCase):
+    def test_record_replay(self):
+        for seed in range(10):
+            log = trek_replay.record(seed)
+            self.assertTrue(trek_replay.verify(log))
+            log = trek_replay.CommandLog.unpack(log.pack())
+            self.assertTrue(trek_replay.verify(log))
+
+    def test_advisor_seeded_apart(self):
+        # The policy's draws don't shadow the game's
+        rng = trek.advisor_rng(5)
+        game = random.Random(5)
+        self.assertNotEqual([rng.random() for i in range(5)],
+                            [game.random() for i in range(5)])
+
+    def test_tampered(self):
+        log = trek_replay.record(5)
+        log.commands.insert(0, (5, (100,)))
+        self.assertFalse(trek_replay.verify(log))
+
+    def test_other_version(self):
+        log = trek_replay.record(5)
+        log.version = trek.VERSION + 1
+        self.assertRaises(trek_replay.LogError, trek_replay.verify, log)
+
+    def test_recorded_play(self):
+        game = trek.TrekGame(max_speed=True, seed=3, sink=trek.NullSink())
+        played = game.subscribe([].append).__self__
+        log = trek_replay.CommandLog(3)
+        play = trek_replay.RecordedPlay(game.play(), log, game)
+        next(play)
+        try:
+            for answer in ['2', '5', '200', '1', '6', '2', '4', '3', '6']:
+                play.send(answer)
+        except StopIteration:
+            pass
+        self.assertEqual(log.commands, [(2, ()), (5, (200,)), (1, (6, 2)),
+                                        (4, (3,)), (6, ())])
+        # Replaying the log goes just the same way
+        game = trek.TrekGame(max_speed=True, seed=3)
+        replayed = game.subscribe([].append).__self__
+        state = game.new_game()
+        for command, args in log.commands:
+            state, outcome = game.step(state, command, args)
+        self.assertEqual(replayed, played)
+
+    def test_big_galaxy(self):
+        # The log keeps the shape of the galaxy, so sectors past 255 pack
+        # and the game replays in the galaxy it was played in
+        options = {'galaxy_size': (32, 32), 'sector_size': (8, 8),
+                   'torus': True, 'sector_cache': 4}
+        log = trek_replay.record(3, options=options)
+        self.assertTrue(log.final[4] > 255)
+        log = trek_replay.CommandLog.unpack(log.pack())
+        self.assertEqual(log.options, options)
+        self.assertTrue(trek_replay.verify(log))
+
+    def test_recorded_play_verifies(self):
+        game = trek.TrekGame(max_speed=True, seed=3, sink=trek.NullSink())
+        log = trek_replay.CommandLog(3)
+        play = trek_replay.RecordedPlay(game.play(), log, game)
+        next(play)
+        self.assertRaises(StopIteration, lambda: [play.send(answer) for answer
+                                                  in ['2', '5', '200', '6']])
+        self.assertEqual(log.final[-1], trek.LOST)
+        log = trek_replay.CommandLog.unpack(log.pack())
+        self.assertEqual(log.commands, [(2, ()), (5, (200,)), (6, ())])
+        self.assertTrue(trek_replay.verify(log))
+
+    def test_recorded_play_pool(self):
+        # A pooled start is logged under the seed it came from
+        pool = trek.StartPool(4, start=False)
+        pool.ready.put(pool.make())
+        game = trek.TrekGame(max_speed=True, sink=trek.NullSink(), pool=pool)
+        log = trek_replay.CommandLog(game.seed)
+        play = trek_replay.RecordedPlay(game.play(), log, game)
+        next(play)
+        self.assertRaises(StopIteration, lambda: [play.send(answer) for answer
+                                                  in ['1', '6', '3', '6']])
+        self.assertEqual(log.seed, game.seed)
+        self.assertTrue(trek_replay.verify(log))
+
+    def test_recorded_play_other_galaxy(self):
+        game = trek.TrekGame(max_speed=True, seed=3, sink=trek.NullSink(),
+                             galaxy_size=(32, 32))
+        self.assertRaises(trek_replay.LogError, trek_replay.RecordedPlay,
+                          game.play(), trek_replay.CommandLog(3), game)
+
+    def test_log_file(self):
+        logs = [trek_replay.record(seed) for seed in range(5)]
+        out = StringIO()
+        trek_replay.write_logs(logs, out)
+        self.assertEqual(list(trek_replay.read_logs(StringIO(out.getvalue()))),
+                         logs)
+        self.assertRaises(trek_replay.LogError, list,
+                          trek_replay.read_logs(StringIO(out.getvalue()[:-1])))
@@ -0,0 +1,89 @@
+import socket
+import threading
+import unittest
+
+import trek
+import trek_server
+
+def read_until(sock, ending):
+    data = ''
+    while not data.endswith(ending):
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data = data + chunk
+    return data
+
+class TestTrekServer(unittest.TestCase):
+    def setUp(self):
+        self.pool = trek.StartPool(8)
+        self.server = trek_server.TrekServer('127.0.0.1', 0, idle_timeout=0.5,
+                                             max_speed=True, pool=self.pool)
+        self.thread = threading.Thread(target=self.server.serve,
+                                       kwargs={'poll': 0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+        self.server.shutdown()
+        self.pool.stop()
+
+    def connect(self):
+        sock = socket.create_connection(('127.0.0.1', self.server.port))
+        sock.settimeout(5)
+        return sock
+
+    def test_resign(self):
+        sock = self.connect()
+        self.assertIn("Klingons in galaxy:",
+                      read_until(sock, 'Command (1-6, 0 for help)? '))
+        sock.sendall('6\r\n')
+        self.assertTrue(read_until(sock, 'duty.\n').endswith(
+            "\nYou are relieved of duty.\n"))
+        self.assertEqual(sock.recv(4096), '')
+
+    def test_bad_answer_asks_again(self):
+        sock = self.connect()
+        read_until(sock, '? ')
+        sock.sendall('warp\n')
+        self.assertEqual(read_until(sock, '? '), 'Command (1-6, 0 for help)? ')
+        sock.sendall('0\n')
+        self.assertIn("6 - Resign", read_until(sock, '? '))
+
+    def test_sessions_are_separate(self):
+        first = self.connect()
+        second = self.connect()
+        read_until(first, '? ')
+        read_until(second, '? ')
+        first.sendall('6\n')
+        read_until(first, 'duty.\n')
+        second.sendall('0\n')
+        self.assertIn("1 - Helm", read_until(second, '? '))
+
+    def test_idle_timeout(self):
+        sock = self.connect()
+        read_until(sock, '? ')
+        self.assertEqual(read_until(sock, 'Goodbye.\n'),
+                         "\nIdle too long, captain. Goodbye.\n")
+
+    def test_load_test(self):
+        result = trek_server.load_test(5, port=self.server.port, commands=3)
+        self.assertEqual(result['completed'], 5)
+        self.assertEqual(result['errors'], 0)
+        # A player can be shot down before giving all their commands
+        self.assertTrue(5 <= result['commands'] <= 15)
+
+    def test_sector_cache(self):
+        self.server.sector_cache = 4
+        sock = self.connect()
+        read_until(sock, '? ')
+        games = [session.game for session in self.server.map.values()
+                 if isinstance(session, trek_server.TrekSession)]
+        self.assertEqual([game.sector_cache for game in games], [4])
+
+    def test_pool(self):
+        sock = self.connect()
+        read_until(sock, '? ')
+        stats = self.pool.stats()
+        self.assertEqual(stats['hits'] + stats['misses'], 1)
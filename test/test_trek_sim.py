@@ -0,0 +1,143 @@
+import json
+from StringIO import StringIO
+import unittest
+
+import trek
+import trek_sim
+
+def resign_policy(game, state):
+    return (6, ())
+
+class TestTrekSim(unittest.TestCase):
+    def test_play_reproducible(self):
+        self.assertEqual(trek_sim.play(42), trek_sim.play(42))
+
+    def test_play_record(self):
+        record = trek_sim.play(42)
+        self.assertEqual(sorted(record), sorted(trek_sim.FIELDS))
+        self.assertEqual(record['seed'], 42)
+        self.assertIn(record['result'], (trek.WON, trek.LOST, 'unfinished'))
+
+    def test_play_policy(self):
+        record = trek_sim.play(7, resign_policy)
+        self.assertEqual(record['result'], trek.LOST)
+        self.assertEqual(record['commands'], 1)
+
+    def test_play_max_commands(self):
+        record = trek_sim.play(7, lambda game, state: (0, ()), max_commands=5)
+        self.assertEqual(record['commands'], 5)
+
+    def test_load_policy(self):
+        self.assertIs(trek_sim.load_policy('trek_sim:random_policy'),
+                      trek_sim.random_policy)
+
+    def test_simulate_processes(self):
+        records = list(trek_sim.simulate(6, first_seed=10, processes=2))
+        self.assertEqual(sorted(r['seed'] for r in records), range(10, 16))
+        self.assertEqual(sorted(records), sorted(trek_sim.play(s)
+                                                 for s in range(10, 16)))
+
+    def test_write_jsonl(self):
+        out = StringIO()
+        trek_sim.write_jsonl(trek_sim.simulate(3, processes=1), out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([json.loads(l)['seed'] for l in lines], [0, 1, 2])
+
+    def test_write_csv(self):
+        out = StringIO()
+        trek_sim.write_csv(trek_sim.simulate(2, processes=1), out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'seed,result,stardate,commands,energy')
+        self.assertEqual(len(lines), 3)
+
+def empty_state(game, sector=10, epos=27):
+    # A quiet galaxy with the Enterprise alone in an empty sector
+    state = trek.GameState(galaxy=trek.Galaxy([1] * 64), sector=sector,
+                           ent_position=epos, shields=200, klingons=1,
+                           current_sector=trek.Sector([0] * 64))
+    state.current_sector[epos] = 4
+    return state
+
+class TestAutopilot(unittest.TestCase):
+    def setUp(self):
+        self.game = trek.TrekGame(max_speed=True, test_mode=True)
+        self.pilot = trek_sim.Autopilot()
+
+    def test_wins(self):
+        record = trek_sim.play(0, trek_sim.Autopilot())
+        self.assertEqual(record['result'], trek.WON)
+        self.assertEqual(record, trek_sim.play(0, trek_sim.Autopilot()))
+
+    def test_load_policy(self):
+        self.assertIsInstance(trek_sim.load_policy('trek_sim:Autopilot'),
+                              trek_sim.Autopilot)
+
+    def test_scans_first(self):
+        state = empty_state(self.game)
+        self.assertEqual(self.pilot(self.game, state), (2, ()))
+        self.assertEqual(sorted(self.pilot.known),
+                         sorted(self.game.neighbours[10]))
+
+    def test_plan_wraps(self):
+        # The galaxy is joined end to end, so 0 is next to 63
+        self.pilot.known = {63: 1, 0: 101}
+        self.assertEqual(self.pilot.plan(self.game, 63, 'klingons'), [63, 0])
+        torus = trek.TrekGame(max_speed=True, test_mode=True, torus=True)
+        self.pilot.reset(None)
+        self.pilot.known = {7: 1, 0: 101}
+        self.assertEqual(self.pilot.plan(torus, 7, 'klingons'), [7, 0])
+
+    def test_plan_cached(self):
+        self.pilot.known = {10: 1, 11: 1, 12: 201}
+        route = self.pilot.plan(self.game, 10, 'klingons')
+        self.assertEqual(route, [10, 11, 12])
+        self.assertIs(self.pilot.plan(self.game, 10, 'klingons'), route)
+        self.pilot.learn(11, 1)
+        self.assertIs(self.pilot.plan(self.game, 10, 'klingons'), route)
+        self.pilot.learn(12, 1)
+        self.assertIsNone(self.pilot.plan(self.game, 10, 'klingons'))
+
+    def test_heads_for_klingons(self):
+        state = empty_state(self.game)
+        self.pilot(self.game, state)
+        self.pilot.learn(11, 101)
+        command, (direction, warp) = self.pilot(self.game, state)
+        self.assertEqual(command, 1)
+        state, outcome = self.game.step(state, command, (direction, warp))
+        self.assertEqual(state.sector, 11)
+
+    def test_torpedo(self):
+        state = empty_state(self.game)
+        state.current_sector[31] = -200
+        state.ksec = 1
+        command, (direction,) = self.pilot(self.game, state)
+        self.assertEqual(command, 4)
+        self.assertIn(31, trek.RAYS[27][direction][0])
+
+    def test_phasers_finish_every_klingon(self):
+        state = empty_state(self.game)
+        state.torpedoes = 0
+        state.klingons = 2
+        for position in (0, 45):
+            state.current_sector[position] = -200
+        state.ksec = 2
+        state.galaxy[10] = 201
+        state.klingon_positions = [0, 45]
+        command, args = self.pilot(self.game, state)
+        self.assertEqual(command, 3)
+        state, outcome = self.game.step(state, command, args)
+        self.assertEqual(outcome, trek.WON)
+
+    def test_docks(self):
+        state = empty_state(self.game)
+        state.energy = 500
+        state.current_sector[60] = 2
+        state.galaxy[10] = 11
+        self.assertEqual(self.pilot(self.game, state), (2, ()))
+        for i in range(3):
+            command, args = self.pilot(self.game, state)
+            self.assertEqual(command, 1)
+            state, outcome = self.game.step(state, command, args)
+            if state.condition == "Docked":
+                break
+        self.assertEqual(state.energy, 3000)
@@ -1,66 +1,857 @@
+import argparse
+from binascii import unhexlify
+from collections import Counter, deque, namedtuple, OrderedDict
+import cProfile
+import inspect
+import mmap
+import os
+import pstats
+import Queue
 import random
+import signal
+import struct
+import sys
+import threading
 import time
 
+# Outcomes returned by TrekGame.step once a game is over
+WON = "won"
+LOST = "lost"
+
+# Bumped whenever a change means recorded games would play out differently
+# 2: wrapping off the top end of the galaxy lands on sector 0, not 1
+# 3: sectors are laid out by free_positions
+VERSION = 3
+
+# Events. Everything that happens in a game is published as one of these,
+# with the text the captain sees, if any, as a format string of its fields
+
+def event(name, fields, text=None):
+    cls = namedtuple(name, fields)
+    cls.text = text
+    return cls
+
+def event_text(event):
+    return event.text % event._asdict()
+
+KlingonDestroyed = event('KlingonDestroyed', 'position', "Klingon destroyed!")
+ShieldsHit = event('ShieldsHit', 'damage',
+                   "Hit on shields:  %(damage)s  energy units")
+NotEnoughEnergy = event('NotEnoughEnergy', '', "Not enough energy, Captain!")
+StarbaseDestroyed = event('StarbaseDestroyed', 'position', "Starbase destroyed")
+# position is the star hit, or None if the torpedo left the sector
+TorpedoMissed = event('TorpedoMissed', 'position', "Torpedo missed")
+NoTorpedoes = event('NoTorpedoes', '', "No photon torpedoes left, captain!")
+NotLogical = event('NotLogical', '', "Your command is not logical, Captain.")
+LowEnergy = event('LowEnergy', 'energy',
+                  "Too little energy left. Only  %(energy)s  units remain")
+EnginesOverloaded = event('EnginesOverloaded', 'warp',
+                          "The engines canna take it, captain!")
+BadCourse = event('BadCourse', 'direction',
+                  "That's not a direction the Enterprise can go in, captain!")
+Docked = event('Docked', 'sector')
+RedAlert = event('RedAlert', '', "Red alert - Klingons attacking!")
+EnterpriseDead = event('EnterpriseDead', '', "Enterprise dead in space")
+UnknownCommand = event('UnknownCommand', 'command',
+                       "Command not recognised captain")
+Resigned = event('Resigned', '')
+Promoted = event('Promoted', '',
+                 "\nYou have successfully completed your mission!\n"
+                 "The federation has been saved.\n"
+                 "You have been promoted to Admiral Kirk.")
+Relieved = event('Relieved', '', "\nYou are relieved of duty.")
+
+def course_vector(direction):
+    # Convert numeric keypad directions to that of the original game
+    # NK 7 = 7
+    # NK 4 = 6
+    # NK 1 = 5
+    # NK 2 = 4
+    # NK 3 = 3
+    # NK 6 = 2
+    # NK 9 = 1
+    # NK 8 = 0
+    # This could be rather more elegant if I didn't bother doing this!
+    # However, I'm trying to stay true to the spirit of the original
+    # BASIC listing ...
+    if direction == 4:
+        direction = 6
+    elif direction == 1:
+        direction = 5
+    elif direction == 2:
+        direction = 4
+    elif direction == 6:
+        direction = 2
+    elif direction == 9:
+        direction = 1
+    elif direction == 8:
+        direction = 0
+    # Work out the direction increment vector
+    # hinc = horizontal increment
+    # vinc = vertical increment
+    if direction < 2 or direction > 6:
+        hinc = -1
+    elif direction > 2 and direction < 6:
+        hinc = 1
+    else:
+        hinc = 0
+    if direction < 4 and direction > 0:
+        vinc = 1
+    elif direction > 4:
+        vinc = -1
+    else:
+        vinc = 0
+    return(hinc,vinc)
+
+def trace_ray(epos, direction, rows=8, columns=8):
+    # Follow a course from position epos to the edge of a sector of rows by
+    # columns positions. Returns the positions passed through, in order,
+    # and the step into the next sector on flying off the edge, as
+    # 8*rows+columns for a step of rows and columns each -1, 0 or 1. In
+    # the usual 8 by 8 galaxy that is the change in sector number
+    hinc,vinc=course_vector(direction)
+    horiz=epos/columns
+    vert=epos-horiz*columns
+    cells=[]
+    while True:
+        vert = vert + vinc
+        horiz = horiz + hinc
+        if vert < 0 or vert >= columns or horiz < 0 or horiz >= rows:
+            return(tuple(cells),8*(horiz/rows)+(vert/columns))
+        cells.append(vert+columns*horiz)
+
+def make_rays(rows=8, columns=8):
+    return([[trace_ray(epos, direction, rows, columns)
+             if direction not in (0, 5) else None
+             for direction in range(10)] for epos in range(rows*columns)])
+
+# Every course the Enterprise or a torpedo can take, indexed as
+# RAYS[epos][direction]. Directions 0 and 5 are not courses and are None
+RAYS = make_rays()
+
+def neighbours(sector, torus=False, rows=8, columns=8):
+    # The nine sectors around and including sector in a galaxy of rows by
+    # columns sectors, in the order a long range scan shows them. The
+    # galaxy is joined end to end, so stepping right from the last sector
+    # in a row lands on the first of the next; on a torus each row and
+    # column wraps round on itself instead
+    around=[]
+    for i in (-1,0,1):
+        for j in (-1,0,1):
+            if torus:
+                around.append((sector/columns+i)%rows*columns
+                              +(sector%columns+j)%columns)
+            else:
+                around.append((sector+columns*i+j)%(rows*columns))
+    return(tuple(around))
+
+# The neighbours of every sector, NEIGHBOURS[sector][3*rows+columns+4] for
+# a step of rows and columns, each -1, 0 or 1
+NEIGHBOURS = [neighbours(sector) for sector in range(64)]
+TORUS_NEIGHBOURS = [neighbours(sector, True) for sector in range(64)]
+
+# Where each step into the next sector, as found by trace_ray, falls in a
+# sector's neighbours
+EXITS = dict((8*rows+columns, 3*rows+columns+4)
+             for rows in (-1,0,1) for columns in (-1,0,1))
+
+def phaser_distance(epos, kpos, columns=8):
+    # Work out the distance from a Klingon to the Enterprise, as used to
+    # weaken phaser fire. It is one less than the square root rounded up,
+    # but never less than 1
+    # Work out the horizontal and vertical displacement of both
+    horiz=epos/columns
+    vert=epos-(columns*horiz)
+    horizk=kpos/columns
+    vertk=kpos-(columns*horizk)
+    z=horiz-horizk
+    y=vert-vertk
+    dist=1
+    while ((dist+1)*(dist+1))<(z*z+y*y):
+        dist=dist+1
+    return(dist)
+
+def make_distances(rows=8, columns=8):
+    positions=range(rows*columns)
+    return([[phaser_distance(epos, kpos, columns) for kpos in positions]
+            for epos in positions])
+
+# Phaser distances between every pair of positions in a sector, indexed
+# as DISTANCES[epos][kpos]
+DISTANCES = make_distances()
+
+def free_positions(rng, positions, count, taken):
+    # Pick count different positions out of range(positions), leaving out
+    # taken, with one draw from rng for each. These are the first count
+    # steps of a Fisher-Yates shuffle of the positions with taken swapped
+    # to the end, keeping only the entries that have been swapped, so it
+    # never has to try again however full the sector and takes the same
+    # time however big it is
+    last=positions-1
+    if count > last:
+        raise ValueError('no room for %d objects in the sector' % count)
+    swapped={}
+    if taken != last:
+        swapped[taken]=last
+    picks=[]
+    random=rng.random
+    for i in range(count):
+        # Any of the positions not picked yet, much as random.choice would
+        j=i+int(random()*(last-i))
+        picks.append(swapped.get(j,j))
+        swapped[j]=swapped.get(i,i)
+    return(picks)
+
+class Neighbours(object):
+    # Works out NEIGHBOURS for galaxies too big to keep a table for
+    __slots__ = ('torus', 'rows', 'columns')
+
+    def __init__(self, torus, rows, columns):
+        self.torus = torus
+        self.rows = rows
+        self.columns = columns
+
+    def __len__(self):
+        return self.rows*self.columns
+
+    def __getitem__(self, sector):
+        return neighbours(sector, self.torus, self.rows, self.columns)
+
+# Galaxies with more sectors than this are laid out lazily, see LazyGalaxy
+EAGER_SECTORS = 4096
+
+class Geometry(object):
+    """The shape of the galaxy and its sectors, with the tables built for it.
+
+    The galaxy is galaxy_rows by galaxy_columns sectors and each sector
+    sector_rows by sector_columns positions, numbered along the rows.
+    rays, distances and neighbours are RAYS, DISTANCES and NEIGHBOURS (or
+    TORUS_NEIGHBOURS) for that shape. Use geometry() to share them.
+    """
+    __slots__ = ('galaxy_rows', 'galaxy_columns', 'sector_rows',
+                 'sector_columns', 'torus', 'sectors', 'positions', 'rays',
+                 'distances', 'neighbours')
+
+    def __init__(self, galaxy_rows=8, galaxy_columns=8, sector_rows=8,
+                 sector_columns=8, torus=False):
+        if min(galaxy_rows, galaxy_columns, sector_rows, sector_columns) < 1:
+            raise ValueError('the galaxy and its sectors need at least one row '
+                             'and column')
+        if sector_rows*sector_columns < 10:
+            # Room for three Klingons, a starbase, five stars and us
+            raise ValueError('sectors need at least 10 positions')
+        self.galaxy_rows = galaxy_rows
+        self.galaxy_columns = galaxy_columns
+        self.sector_rows = sector_rows
+        self.sector_columns = sector_columns
+        self.torus = torus
+        self.sectors = galaxy_rows*galaxy_columns
+        self.positions = sector_rows*sector_columns
+        if (sector_rows, sector_columns) == (8, 8):
+            self.rays = RAYS
+            self.distances = DISTANCES
+        else:
+            self.rays = make_rays(sector_rows, sector_columns)
+            self.distances = make_distances(sector_rows, sector_columns)
+        if (galaxy_rows, galaxy_columns) == (8, 8):
+            if torus:
+                self.neighbours = TORUS_NEIGHBOURS
+            else:
+                self.neighbours = NEIGHBOURS
+        elif self.sectors <= EAGER_SECTORS:
+            self.neighbours = [neighbours(sector, torus, galaxy_rows,
+                                          galaxy_columns)
+                               for sector in range(self.sectors)]
+        else:
+            self.neighbours = Neighbours(torus, galaxy_rows, galaxy_columns)
+
+    def is_classic(self):
+        # The original 8 by 8 galaxy of 8 by 8 sectors
+        return((self.galaxy_rows, self.galaxy_columns, self.sector_rows,
+                self.sector_columns) == (8, 8, 8, 8))
+
+GEOMETRIES = {}
+
+def geometry(galaxy_size=(8, 8), sector_size=(8, 8), torus=False):
+    # The Geometry for galaxies of galaxy_size (rows, columns) sectors, each
+    # of sector_size positions, shared between games
+    key = (tuple(galaxy_size), tuple(sector_size), bool(torus))
+    if key not in GEOMETRIES:
+        GEOMETRIES[key] = Geometry(*(key[0]+key[1]+key[2:]))
+    return GEOMETRIES[key]
+
+# Output sinks. The game builds each screen up as a string and hands the
+# whole frame to a sink in one write, so the same game can talk to a
+# terminal, a file, a network connection or nothing at all
+
+class StdoutSink(object):
+    # Look up sys.stdout on every write so that swapping it still works
+    def write(self, text):
+        sys.stdout.write(text)
+
+class StreamSink(object):
+    # Any file-like object, e.g. an open file or a StringIO
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        self.stream.write(text)
+
+class SocketSink(object):
+    # A connected socket
+    def __init__(self, sock):
+        self.sock = sock
+
+    def write(self, text):
+        self.sock.sendall(text)
+
+class NullSink(object):
+    # Throw the output away, e.g. for headless games
+    def write(self, text):
+        pass
+
+# Clocks. The dramatic pauses go through a clock rather than straight to
+# time.sleep, so a game need not block the thread it runs on
+
+class SleepClock(object):
+    # Real time; pausing blocks the thread. Fine for one player at a terminal
+    def time(self):
+        return time.time()
+
+    def pause(self, seconds):
+        time.sleep(seconds)
+
+class VirtualClock(object):
+    # Simulated time which passes instantly, adding up how long the game
+    # would have paused for
+    def __init__(self, now=0.0):
+        self.now = now
+        self.paused = 0.0
+
+    def time(self):
+        return self.now
+
+    def pause(self, seconds):
+        self.now = self.now + seconds
+        self.paused = self.paused + seconds
+
+class Pacer(object):
+    # Both a clock and a sink. Pausing never blocks; instead the output
+    # written after a pause is queued, stamped with the time it is due, and
+    # handed on to the real sink by deliver() once that time has come. An
+    # event loop can run many games on one thread this way, calling deliver
+    # whenever next_due() comes round
+    def __init__(self, sink, clock=None):
+        if clock is None:
+            clock = SleepClock()
+        self.sink = sink
+        self.clock = clock
+        self.due = 0.0
+        self.queue = deque()
+
+    def time(self):
+        return self.clock.time()
+
+    def pause(self, seconds):
+        self.due = max(self.due, self.time()) + seconds
+
+    def write(self, text):
+        self.due = max(self.due, self.time())
+        self.queue.append((self.due, text))
+
+    def next_due(self):
+        # When the next piece of output is due, or None if nothing is queued
+        if self.queue:
+            return self.queue[0][0]
+        return None
+
+    def deliver(self, now=None):
+        # Write out everything that is due by now
+        if now is None:
+            now = self.time()
+        queue = self.queue
+        while queue and queue[0][0] <= now:
+            self.sink.write(queue.popleft()[1])
+        return self.next_due()
+
+    def flush(self):
+        # Write out everything at once, ignoring the pauses
+        while self.queue:
+            self.sink.write(self.queue.popleft()[1])
+
+class Galaxy(object):
+    """The galaxy as three byte planes: klingons, starbases and stars.
+
+    Indexing reads and writes the hundreds/tens/units numbers TrekGame
+    has always used, so a Galaxy can stand in for the galaxy list.
+    """
+    __slots__ = ('klingons', 'starbases', 'stars')
+
+    def __init__(self, galaxy=()):
+        self.klingons = bytearray()
+        self.starbases = bytearray()
+        self.stars = bytearray()
+        for value in galaxy:
+            self.klingons.append(value/100)
+            self.starbases.append(value/10%10)
+            self.stars.append(value%10)
+
+    def __len__(self):
+        return len(self.stars)
+
+    def __getitem__(self, i):
+        return self.klingons[i]*100+self.starbases[i]*10+self.stars[i]
+
+    def __setitem__(self, i, value):
+        self.klingons[i] = value/100
+        self.starbases[i] = value/10%10
+        self.stars[i] = value%10
+
+    def __iter__(self):
+        for i in range (0,len(self.stars)):
+            yield self[i]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Galaxy(%r)' % list(self)
+
+    def total_klingons(self):
+        return sum(self.klingons)
+
+# LazyGalaxy turns random bytes into sector contents with these tables,
+# giving close to the odds TrekGame.make_galaxy uses: no Klingons 30% of
+# the time and otherwise 1-3, a starbase 12% of the time and 1-5 stars
+KLINGON_ODDS = '\0'*77+'\1'*60+'\2'*60+'\3'*59
+STARBASE_ODDS = '\1'*31+'\0'*225
+STAR_ODDS = '\1'*52+'\2'*51+'\3'*51+'\4'*51+'\5'*51
+
+class LazyGalaxy(object):
+    """A galaxy too big to lay out up front.
+
+    Sectors are generated in blocks from the galaxy's seed whenever they
+    are needed, so the same sector always comes out the same, and only
+    the sectors that have changed since are stored along with a few
+    recently used blocks. Indexing reads and writes the same numbers as
+    Galaxy.
+    """
+    __slots__ = ('size', 'seed', 'changed', 'blocks')
+
+    # Sectors generated together, and how many blocks to keep
+    BLOCK = 4096
+    KEEP = 8
+
+    def __init__(self, size, seed):
+        self.size = size
+        self.seed = seed
+        self.changed = {}
+        self.blocks = OrderedDict()
+
+    def __len__(self):
+        return self.size
+
+    def generate(self, block):
+        # Klingons, starbases and stars for each sector in a block, as
+        # strings of one character per sector
+        n = min(self.BLOCK, self.size-block*self.BLOCK)
+        bits = random.Random((self.seed << 32) | block).getrandbits(24*n)
+        data = unhexlify('%0*x' % (6*n, bits))
+        return (data[:n].translate(KLINGON_ODDS),
+                data[n:2*n].translate(STARBASE_ODDS),
+                data[2*n:].translate(STAR_ODDS))
+
+    def block(self, block):
+        blocks = self.blocks
+        if block in blocks:
+            data = blocks.pop(block)
+        else:
+            data = self.generate(block)
+            if len(blocks) >= self.KEEP:
+                blocks.popitem(last=False)
+        blocks[block] = data
+        return data
+
+    def index(self, i):
+        if i < 0:
+            i = i+self.size
+        if not 0 <= i < self.size:
+            raise IndexError('sector out of range')
+        return i
+
+    def __getitem__(self, i):
+        i = self.index(i)
+        if i in self.changed:
+            return self.changed[i]
+        klingons, starbases, stars = self.block(i/self.BLOCK)
+        i = i%self.BLOCK
+        return ord(klingons[i])*100+ord(starbases[i])*10+ord(stars[i])
+
+    def __setitem__(self, i, value):
+        self.changed[self.index(i)] = value
+
+    def __iter__(self):
+        for i in xrange(self.size):
+            yield self[i]
+
+    def __eq__(self, other):
+        if isinstance(other, LazyGalaxy):
+            return ((self.size, self.seed, self.changed) ==
+                    (other.size, other.seed, other.changed))
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'LazyGalaxy(%d, %d)' % (self.size, self.seed)
+
+    def total_klingons(self):
+        # Generates every block, but keeps none of them
+        total = 0
+        for block in xrange((self.size+self.BLOCK-1)/self.BLOCK):
+            klingons = self.generate(block)[0]
+            total = (total+klingons.count('\1')+2*klingons.count('\2')
+                     +3*klingons.count('\3'))
+        # Allow for the sectors where Klingons have been destroyed
+        for i in self.changed:
+            klingons = self.block(i/self.BLOCK)[0]
+            total = total+self.changed[i]/100-ord(klingons[i%self.BLOCK])
+        return total
+
+# Sector cells holding this value or more are Klingons; the rest of the
+# value picks out the Klingon's energy in Sector.energies
+KLINGON = 8
+
+class Sector(object):
+    """A sector map as one byte per position plus the Klingons' energies.
+
+    Cells hold 0 (empty), 2 (starbase), 3 (star), 4 (Enterprise) or
+    KLINGON plus an index into energies. Indexing reads and writes the
+    usual encoding with negative Klingon energy, so a Sector can stand in
+    for the current sector list.
+    """
+    __slots__ = ('cells', 'energies')
+
+    def __init__(self, sector=()):
+        self.cells = bytearray(len(sector))
+        self.energies = []
+        for i in range (0,len(sector)):
+            if sector[i]:
+                self[i] = sector[i]
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __getitem__(self, i):
+        cell = self.cells[i]
+        if cell >= KLINGON:
+            return -self.energies[cell-KLINGON]
+        return cell
+
+    def __setitem__(self, i, value):
+        cell = self.cells[i]
+        if cell >= KLINGON:
+            if value < 0:
+                # A Klingon has been hit but survives
+                self.energies[cell-KLINGON] = -value
+                return
+            # Free the Klingon's energy slot
+            self.energies[cell-KLINGON] = 0
+        if value < 0:
+            # A Klingon arrives. Reuse a free energy slot if there is one
+            if 0 in self.energies:
+                slot = self.energies.index(0)
+                self.energies[slot] = -value
+            else:
+                slot = len(self.energies)
+                self.energies.append(-value)
+            value = KLINGON+slot
+        self.cells[i] = value
+
+    def __iter__(self):
+        for i in range (0,len(self.cells)):
+            yield self[i]
+
+    def count(self, value):
+        return list(self).count(value)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Sector(%r)' % list(self)
+
+    def copy(self):
+        sector = Sector()
+        sector.cells = bytearray(self.cells)
+        sector.energies = list(self.energies)
+        return sector
+
+# How long the scans used to take to print, a line every 0.2 seconds
+SRS_PAUSE = 1.6
+LRS_PAUSE = 2.0
+
+def srs_symbol(value):
+    # What each sector map value looks like on the short range scan
+    if value < 0:
+        return(">!<")
+    elif value == 0:
+        return(" . ")
+    elif value == 2:
+        return("<O>")
+    elif value == 3:
+        return(" * ")
+    return("-O-")
+
+class GameState(object):
+    """Everything about a game in progress that changes between commands.
+
+    galaxy and current_sector may be lists or the more compact Galaxy
+    and Sector; either way they read and write the same encodings: one
+    klingons/starbases/stars number per sector and one 0/2/3/4 or
+    negative Klingon energy value per position. ksec is the number of
+    Klingons left in the current sector and klingon_positions, if not
+    None, lists where they are in ascending order.
+    """
+    __slots__ = ('energy', 'torpedoes', 'shields', 'galaxy', 'sector',
+                 'ent_position', 'current_sector', 'stardate', 'klingons',
+                 'ksec', 'condition', 'klingon_positions')
+
+    def __init__(self, energy=3000, torpedoes=15, shields=0, galaxy=None,
+                 sector=0, ent_position=0, current_sector=None, stardate=0.0,
+                 klingons=0, ksec=0, condition="Green",
+                 klingon_positions=None):
+        self.energy = energy
+        self.torpedoes = torpedoes
+        self.shields = shields
+        self.galaxy = galaxy
+        self.sector = sector
+        self.ent_position = ent_position
+        self.current_sector = current_sector
+        self.stardate = stardate
+        self.klingons = klingons
+        self.ksec = ksec
+        self.condition = condition
+        self.klingon_positions = klingon_positions
+
+# A snapshot of a game is one fixed-size record: the ship, the galaxy's
+# three planes, the current sector's cells and Klingon energies, the game
+# seed and the full state of the random number generator. Most of it is
+# the generator; Python's Mersenne Twister keeps 625 words
+SNAPSHOT_MAGIC = 'TRKS'
+SNAPSHOT_FORMAT = 1
+SECTOR_KLINGONS = 9
+RNG_WORDS = 625
+SNAPSHOT = struct.Struct('<4sBH' 'iHiBBdHBB' '64s64s64s64s' '%di' '?Q'
+                         '%dI' '?d' % (SECTOR_KLINGONS, RNG_WORDS))
+
+CONDITIONS = ("Green", "Red", "Docked")
+
+class SnapshotFile(object):
+    """A file of fixed-size game snapshots, memory-mapped.
+
+    Snapshots are numbered from 0; reading one returns the record for
+    TrekGame.load and assigning one writes a record from TrekGame.save
+    straight into the map.
+    """
+    def __init__(self, path, count=None):
+        # With count, make a new file with room for that many snapshots
+        if count is not None:
+            with open(path, 'wb') as f:
+                f.truncate(count*SNAPSHOT.size)
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        if len(self.map) % SNAPSHOT.size:
+            self.close()
+            raise ValueError('%s is not a snapshot file' % path)
+
+    def __len__(self):
+        return len(self.map)/SNAPSHOT.size
+
+    def offset(self, i):
+        if i < 0:
+            i = i+len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('snapshot index out of range')
+        return i*SNAPSHOT.size
+
+    def __getitem__(self, i):
+        offset = self.offset(i)
+        return self.map[offset:offset+SNAPSHOT.size]
+
+    def __setitem__(self, i, data):
+        if len(data) != SNAPSHOT.size:
+            raise ValueError('snapshots are %d bytes' % SNAPSHOT.size)
+        offset = self.offset(i)
+        self.map[offset:offset+SNAPSHOT.size] = data
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 class TrekGame(object):
-    def __init__(self, max_speed=False, test_mode=False):
+    def __init__(self, max_speed=False, test_mode=False, seed=None, rng=None,
+                 sink=None, clock=None, torus=False, galaxy_size=(8, 8),
+                 sector_size=(8, 8), sector_cache=0, pool=None, metrics=None):
         self.second_coefficient = 1.0
         self.test_mode = test_mode
+        # The galaxy is galaxy_size (rows, columns) sectors of sector_size
+        # positions, joined end to end unless it is a torus
+        self.geometry = geometry(galaxy_size, sector_size, torus)
+        self.neighbours = self.geometry.neighbours
+        # The layouts of the last sector_cache sectors we left, so that
+        # going back finds everything where it was. With none kept each
+        # visit lays the sector out afresh, as the game always has
+        self.sector_cache = sector_cache
+        self.layouts = OrderedDict()
+        # Games started ahead of time, see StartPool
+        if pool is not None and pool.geometry is not self.geometry:
+            raise ValueError('the pool starts games in a different galaxy')
+        self.pool = pool
+        # Everything the game prints goes through the sink
+        if sink is None:
+            sink = StdoutSink()
+        self.sink = sink
+        # and every pause through the clock
+        if clock is None:
+            clock = SleepClock()
+        self.clock = clock
+        # Anyone who wants to hear about events as they happen
+        self.listeners = []
+        # Somewhere to record how long each command takes, such as a
+        # trek_metrics.Metrics. None measures nothing
+        self.metrics = metrics
+        # The game play() is playing, for wrappers such as
+        # trek_replay.RecordedPlay to see how it ended
+        self.state = None
+        # Each game draws from its own random number generator so that games
+        # can be replayed from their seed and run side by side in threads.
+        # An injected generator has no seed we can report.
+        if rng is None:
+            if seed is None:
+                seed = random.randint(0, 2**32-1)
+            else:
+                # Games given a seed play from it, so a pooled start
+                # from some other seed is no use to them
+                self.pool = None
+            rng = random.Random(seed)
+        else:
+            # Nor is one to a game drawing from a generator of its own
+            self.pool = None
+        self.seed = seed
+        self.rng = rng
         if max_speed:
             self.make_max_speed()
 
     def make_max_speed(self):
         self.second_coefficient = 0
 
+    def write(self, text):
+        self.sink.write(text)
+
+    def subscribe(self, listener):
+        # listener is called with each event the game publishes
+        self.listeners.append(listener)
+        return(listener)
+
+    def unsubscribe(self, listener):
+        self.listeners.remove(listener)
+
+    def publish(self, events):
+        for listener in self.listeners:
+            for event in events:
+                listener(event)
+
+    def tell(self, events):
+        # Publish events and show the captain the ones with something to say
+        self.publish(events)
+        self.write("".join([event_text(event)+"\n" for event in events
+                            if event.text is not None]))
+
+    def pause(self, seconds):
+        if self.second_coefficient:
+            self.clock.pause(seconds * self.second_coefficient)
+
     def test_input(self, prompt, input):
         if self.test_mode:
             return input
         else:
             return raw_input(prompt)
 
-    def main(self, test_arg=None):
+    def main(self, test_arg=None, script=None, echo=False):
+        # Play from the keyboard. In test mode test_arg answers the first
+        # prompt and the game stops after one command. Given a script, see
+        # read_script, play that instead
+        game=self.play(one_pass=test_arg is not None)
+        if self.metrics is not None:
+            game=self.metrics.measure(game, self)
+        if script is not None:
+            self.run_script(game, script, echo)
+            return
+        answer=test_arg
+        try:
+            prompt=next(game)
+            while True:
+                prompt=game.send(self.test_input(prompt, answer))
+                answer=None
+        except StopIteration:
+            pass
+
+    def run_script(self, game, script, echo=False):
+        # Feed each command in script, with its arguments, to game as it
+        # asks for them. Arguments the game doesn't ask for, such as a
+        # direction when there are no torpedoes left, are passed over.
+        # With echo the prompts and answers are shown as if typed. The game
+        # stops where the script does
+        try:
+            prompt=next(game)
+            for words in read_script(script):
+                for i in range(0,len(words)):
+                    if i > 0 and prompt.startswith('Command'):
+                        break
+                    if echo:
+                        self.write('%s%d\n' % (prompt,words[i]))
+                    prompt=game.send(str(words[i]))
+                if not prompt.startswith('Command'):
+                    raise ValueError('%r needs more arguments, %s'
+                                     % (' '.join(map(str,words)),prompt))
+            game.close()
+        except StopIteration:
+            pass
+
+    def play(self, one_pass=False):
+        # The game itself, as a generator so that it never has to wait for
+        # the keyboard. It yields each prompt and expects the captain's
+        # answer to be sent back, which lets one thread run many games
         self.blurb()
-        # Set up a random stardate
-        stardate=float(random.randrange(1000,1500,1))
-        # Enterprise starts with 3,000 units of energy, 15 torpedoes and 1,000
-        # units of energy in its shields
-        energy=3000
-        torpedoes=15
-        shields=0
-        # No klingons around ... yet!
-        klingons = 0
-        # The galaxy is divided into 64 sectors. Each sectoris represented by one 
-        # element in the galaxy list. The galaxy list contains a three digit number
-        # Hundreds = number of klingons in the sector
-        # Tens = number of starbases
-        # Units = number of stars
-        galaxy=[]
-        # Initialise the galaxy list
-        for i in range (0,64):
-            x=y=0
-            z=random.randint(1,5)
-            if random.randint(1,10)<8:
-                x=random.randint(1,3)
-            if random.randint(1,100)>88:
-                y=1
-            galaxy.append(x*100+y*10+z)
-            # Keep a record of how many klingons are left to be destroyed
-            klingons=klingons+x
-        # Choose the starting sector and position for the Enterprise
-        sector = random.randint(0,63)
-        ent_position = random.randint(0,63)
-        # Set up current sector and decode it
-        # x = klingons; y = starbases; z = stars
-        x,y,z=self.decode(galaxy[sector])
-        # Set up the current sector map
-        # Each sector has 64 positions in which a klingon, starbase, star 
-        # or the Enterprise may be located in
-        current_sector=self.init(x,y,z,ent_position)
+        state=self.state=self.new_game()
         # Perform a short range scan
-        condition=self.srs(current_sector,ent_position)
-        self.status(sector,stardate,condition,energy,torpedoes,shields,klingons)
+        self.scan(state)
         # Keep going until we have destroyed all the klingons or we run out of
         # energy or we quit
-        while klingons > 0 and energy > 0: 
+        while self.outcome(state) is None:
             # Command
             # 1 = Helm
             # 2 = Long range scan
@@ -68,130 +859,424 @@ class TrekGame(object):
             # 4 = Photon torpedoes
             # 5 = Shields
             # 6 = Resign
-            command=int(self.test_input('Command (1-6, 0 for help)? ', test_arg))
+            command=int((yield 'Command (1-6, 0 for help)? '))
             if command == 0:
                 self.showhelp()
             elif command == 1:
-                new_sector,energy,ent_position,stardate=self.helm(galaxy,sector,
-                energy,current_sector,ent_position,stardate)
-                # If we're still in the same sector as before, draw the Enterprise
-                if sector == new_sector:
-                    current_sector[ent_position]=4
-                else:
-                # Else set up the Enterprise in the new sector
-                    sector = new_sector
-                    ent_position = random.randint(0,63)
-                    x,y,z=self.decode(galaxy[sector])
-                    current_sector=self.init(x,y,z,ent_position)
+                direction=int((yield 'Course direction(1-9)? '))
+                warp=None
+                if direction >=1 and direction <=9 and direction !=5:
+                    # How far do we need to move?
+                    warp=int((yield 'Warp (1-63)? '))
+                new_sector,state.energy,state.ent_position,state.stardate,events=(
+                self.navigate(direction,warp,state.sector,state.energy,
+                state.current_sector,state.ent_position,state.stardate))
+                self.tell(events)
+                self.arrive(state,new_sector)
                 # Perform a short range scan after every movement
-                condition=self.srs(current_sector,ent_position)
-                if condition == "Docked":
-                    # Reset energy, torpedoes and shields
-                    energy=3000
-                    torpedoes=15
-                    shields=0
-                self.status(sector,stardate,condition,energy,torpedoes,shields,klingons)
+                state.condition=self.scan_condition(state.current_sector,
+                state.ent_position,state.ksec)
+                if state.condition == "Docked":
+                    self.dock(state)
+                self.show_scan(state)
             elif command == 2:
-                self.lrs(galaxy,sector)
+                self.lrs(state.galaxy,state.sector)
             elif command == 3:
-                shields,energy,current_sector,ks=self.phasers(condition,shields,energy,
-                current_sector,ent_position,x)
-                if ks < x:
-                    # (x-ks) Klingons have been destroyed-update galaxy map
-                    galaxy[sector]=galaxy[sector]-(100*(x-ks))
-                    # update total klingons
-                    klingons=klingons-(x-ks)
-                    # update sector klingons
-                    x=ks
+                power=int((yield 'Phaser energy? '))
+                fired=power <= state.energy
+                state.shields,state.energy,state.current_sector,ks,events=(
+                self.fire_phasers(power,state.condition,state.shields,
+                state.energy,state.current_sector,state.ent_position,state.ksec,
+                state.klingon_positions))
+                self.tell(events)
+                if fired:
+                    self.pause(0.2*len(events))
+                self.klingons_destroyed(state,ks)
                 # Do we still have shields left?
-                if shields < 0:
-                    print "Enterprise dead in space"
-                    energy = 0
+                if state.shields < 0:
+                    self.tell([EnterpriseDead()])
+                    state.energy = 0
                 else:
-                    condition=self.srs(current_sector,ent_position)
-                    self.status(sector,stardate,condition,energy,torpedoes,
-                    shields,klingons)
+                    self.scan(state)
             elif command == 4:
-                torpedoes,current_sector,ks=self.photontorpedoes(torpedoes,
-                current_sector,ent_position,x)
-                # A Klingon has been destroyed-update galaxy map
-                if ks < x:
-                    galaxy[sector]=galaxy[sector]-100
-                    # update total klingons
-                    klingons=klingons-(x-ks)
-                    # update sector klingons
-                    x=ks
-                condition=self.srs(current_sector,ent_position)
-                self.status(sector,stardate,condition,energy,torpedoes,shields,klingons)
+                direction=None
+                if state.torpedoes >= 1:
+                    direction=int((yield 'Fire in direction(1-4,6-9)? '))
+                left,state.current_sector,ks,events=self.fire_torpedo(
+                direction,state.torpedoes,state.current_sector,
+                state.ent_position,state.ksec)
+                if left < state.torpedoes:
+                    self.pause(0.2)
+                self.tell(events)
+                state.torpedoes=left
+                self.klingons_destroyed(state,ks)
+                self.scan(state)
             elif command == 5:
-                energy,shields=self.addshields(energy,shields)
-                condition=self.srs(current_sector,ent_position)
-                self.status(sector,stardate,condition,energy,torpedoes,shields,klingons)
+                power=int((yield 'Energy to shields? '))
+                state.energy,state.shields=self.transfer_shields(power,
+                state.energy,state.shields)
+                self.scan(state)
             elif command == 6:
                 # Set quit condition by making energy = 0
-                energy = 0
+                state.energy = 0
+                self.publish([Resigned()])
             else:
-                print "Command not recognised captain"
+                self.tell([UnknownCommand(command)])
             # After a command has been issued and condition is Red, a klingon may
             # fire randomly on the enterprise!
-            if condition == "Red" and command != 0:
-                if random.randint(1,9)<6:
-                    print "Red alert - Klingons attacking!"
-                    time.sleep(0.5 * self.second_coefficient)
-                    damage=x*random.randint(1,50)
-                    shields=shields-damage
-                    print "Hit on shields: ",damage," energy units"
+            if state.condition == "Red" and command != 0:
+                damage=self.klingons_attack(state)
+                if damage is not None:
+                    self.tell([RedAlert()])
+                    self.pause(0.5)
+                    self.tell([ShieldsHit(damage)])
                     # Do we still have shields left?
-                    if shields < 0:
-                        print "Enterprise dead in space"
-                        energy = 0
+                    if state.shields < 0:
+                        self.tell([EnterpriseDead()])
                     else:
-                        condition=self.srs(current_sector,ent_position)
-                        self.status(sector,stardate,condition,energy,torpedoes,
-                        shields,klingons)
-            if test_arg is not None:
+                        self.scan(state)
+            if one_pass:
                 break # bail out of loop after one pass during testing
         # If we get here we've won if no klingons are left, but lost otherwise
-        if klingons == 0:
+        if state.klingons == 0:
             self.promotion()
         else:
             self.lose()
-        
+
+    def new_game(self, galaxy=None):
+        # Take a game that's already been started if there is one ready.
+        # It carries on from its own seed, just as if we'd started it here.
+        # Only games that chose their own seed have a pool, see __init__
+        if galaxy is None and self.pool is not None:
+            start=self.pool.take()
+            if start is not None:
+                self.seed,state,rng_state=start
+                self.rng.setstate(rng_state)
+                self.layouts.clear()
+                return(state)
+        # Set up a random stardate
+        stardate=float(self.rng.randrange(1000,1500,1))
+        # A ready-made galaxy, e.g. from trek_batch.generate_galaxies, saves
+        # generating one here
+        if galaxy is None:
+            if self.geometry.sectors <= EAGER_SECTORS:
+                galaxy=self.make_galaxy()
+            else:
+                # Too big to lay out, so each sector is only worked out
+                # when we get to it
+                galaxy=LazyGalaxy(self.geometry.sectors,self.rng.getrandbits(64))
+        # Keep the galaxy compact, a byte per sector for each of klingons,
+        # starbases and stars
+        if not isinstance(galaxy,LazyGalaxy):
+            galaxy=Galaxy(galaxy)
+        self.layouts.clear()
+        # Keep a record of how many klingons are left to be destroyed
+        klingons=galaxy.total_klingons()
+        # Enterprise starts with 3,000 units of energy, 15 torpedoes and no
+        # energy in its shields
+        state=GameState(galaxy=galaxy,stardate=stardate,klingons=klingons)
+        # Choose the starting sector and position for the Enterprise
+        self.enter_sector(state,self.rng.randint(0,self.geometry.sectors-1))
+        state.condition=self.scan_condition(state.current_sector,
+        state.ent_position,state.ksec)
+        return(state)
+
+    def make_galaxy(self):
+        # The galaxy is divided into sectors, 64 of them unless the geometry
+        # says otherwise. Each sectoris represented by one 
+        # element in the galaxy list. The galaxy list contains a three digit number
+        # Hundreds = number of klingons in the sector
+        # Tens = number of starbases
+        # Units = number of stars
+        galaxy=[]
+        # Initialise the galaxy list
+        for i in range (0,self.geometry.sectors):
+            x=y=0
+            z=self.rng.randint(1,5)
+            if self.rng.randint(1,10)<8:
+                x=self.rng.randint(1,3)
+            if self.rng.randint(1,100)>88:
+                y=1
+            galaxy.append(x*100+y*10+z)
+        return(galaxy)
+
+    def step(self, state, command, args=()):
+        """Apply one command to state without prompting, printing or pausing.
+
+        args holds the numbers the command would otherwise prompt for:
+        (direction, warp) for helm, (energy,) for phasers and shields and
+        (direction,) for photon torpedoes. state is updated in place and
+        returned along with the outcome - WON, LOST or None if the game
+        is still in progress.
+        """
+        # Commands that stop asking questions part way through, such as
+        # helm with an impossible course, may be given fewer arguments
+        args=tuple(args)+(None,None)
+        if command == 1:
+            direction,warp=args[:2]
+            new_sector,state.energy,state.ent_position,state.stardate,events=\
+            self.navigate(direction,warp,state.sector,state.energy,
+            state.current_sector,state.ent_position,state.stardate)
+            self.publish(events)
+            self.arrive(state,new_sector)
+            state.condition=self.scan_condition(state.current_sector,
+            state.ent_position,state.ksec)
+            if state.condition == "Docked":
+                self.dock(state)
+        elif command == 3:
+            state.shields,state.energy,state.current_sector,ks,events=\
+            self.fire_phasers(args[0],state.condition,state.shields,state.energy,
+            state.current_sector,state.ent_position,state.ksec,
+            state.klingon_positions)
+            self.publish(events)
+            self.klingons_destroyed(state,ks)
+            if state.shields < 0:
+                self.publish([EnterpriseDead()])
+                state.energy = 0
+            else:
+                state.condition=self.scan_condition(state.current_sector,
+                state.ent_position,state.ksec)
+        elif command == 4:
+            state.torpedoes,state.current_sector,ks,events=self.fire_torpedo(
+            args[0],state.torpedoes,state.current_sector,state.ent_position,
+            state.ksec)
+            self.publish(events)
+            self.klingons_destroyed(state,ks)
+            state.condition=self.scan_condition(state.current_sector,
+            state.ent_position,state.ksec)
+        elif command == 5:
+            state.energy,state.shields=self.transfer_shields(args[0],
+            state.energy,state.shields)
+        elif command == 6:
+            state.energy = 0
+            self.publish([Resigned()])
+        elif command not in (0,2):
+            self.publish([UnknownCommand(command)])
+        # Commands 0 (help), 2 (long range scan) and anything unrecognised
+        # leave the game as it is, but the Klingons still get their turn
+        if state.condition == "Red" and command != 0:
+            damage=self.klingons_attack(state)
+            if damage is not None:
+                self.publish([RedAlert(),ShieldsHit(damage)])
+                if state.shields < 0:
+                    self.publish([EnterpriseDead()])
+        outcome=self.outcome(state)
+        if outcome == WON:
+            self.publish([Promoted()])
+        elif outcome == LOST:
+            self.publish([Relieved()])
+        return(state,outcome)
+
+    def outcome(self, state):
+        # The game is over once all the klingons are destroyed or the
+        # Enterprise runs out of energy
+        if state.klingons == 0:
+            return(WON)
+        if state.energy <= 0:
+            return(LOST)
+        return(None)
+
+    def check_snapshots(self):
+        # A snapshot holds the classic galaxy, not joined into a torus and
+        # with no sector layouts kept, so only a game like that can be
+        # saved or loaded and carry on just as it would have
+        if not self.geometry.is_classic() or self.geometry.torus:
+            raise ValueError('only the 8 by 8 galaxy can be saved')
+        if self.sector_cache:
+            raise ValueError('games that keep sector layouts cannot be saved')
+
+    def save(self, state):
+        # Pack the game into one SNAPSHOT record
+        self.check_snapshots()
+        galaxy=state.galaxy
+        if not isinstance(galaxy, Galaxy):
+            galaxy=Galaxy(galaxy)
+        sector=state.current_sector
+        if not isinstance(sector, Sector):
+            sector=Sector(sector)
+        energies=list(sector.energies)
+        if len(energies) > SECTOR_KLINGONS:
+            raise ValueError('too many Klingons in the sector to save')
+        energies=energies+[0]*(SECTOR_KLINGONS-len(energies))
+        version,words,gauss=self.rng.getstate()
+        try:
+            return(SNAPSHOT.pack(SNAPSHOT_MAGIC,SNAPSHOT_FORMAT,VERSION,
+            state.energy,state.torpedoes,state.shields,state.sector,
+            state.ent_position,state.stardate,state.klingons,state.ksec,
+            CONDITIONS.index(state.condition),str(galaxy.klingons),
+            str(galaxy.starbases),str(galaxy.stars),str(sector.cells),
+            *(energies+[self.seed is not None,self.seed or 0]+list(words)+
+              [gauss is not None,gauss or 0.0])))
+        except struct.error:
+            # Energies pumped up past what a record holds, e.g. by firing
+            # negative phaser power
+            raise ValueError('game values too large to save')
+
+    def load(self, data, offset=0):
+        # Unpack a record from save, e.g. from a SnapshotFile or its map at
+        # offset, putting the generator back as it was. Returns the state
+        self.check_snapshots()
+        fields=SNAPSHOT.unpack_from(data,offset)
+        magic,format,version=fields[:3]
+        if magic != SNAPSHOT_MAGIC or format != SNAPSHOT_FORMAT:
+            raise ValueError('not a trek snapshot')
+        if version != VERSION:
+            raise ValueError('snapshot is from version %d of the game' % version)
+        energy,torpedoes,shields,sector,ent_position,stardate,klingons,ksec,\
+        condition=fields[3:12]
+        galaxy=Galaxy()
+        galaxy.klingons,galaxy.starbases,galaxy.stars=[bytearray(plane)
+        for plane in fields[12:15]]
+        current_sector=Sector()
+        current_sector.cells=bytearray(fields[15])
+        energies=list(fields[16:16+SECTOR_KLINGONS])
+        while energies and energies[-1] == 0:
+            energies.pop()
+        current_sector.energies=energies
+        i=16+SECTOR_KLINGONS
+        has_seed,seed=fields[i:i+2]
+        words=fields[i+2:i+2+RNG_WORDS]
+        has_gauss,gauss=fields[i+2+RNG_WORDS:]
+        self.seed=seed if has_seed else None
+        self.layouts.clear()
+        self.rng.setstate((random.Random.VERSION,words,
+        gauss if has_gauss else None))
+        return(GameState(energy=energy,torpedoes=torpedoes,shields=shields,
+        galaxy=galaxy,sector=sector,ent_position=ent_position,
+        current_sector=current_sector,stardate=stardate,klingons=klingons,
+        ksec=ksec,condition=CONDITIONS[condition],
+        klingon_positions=self.find_klingons(current_sector)))
+
+    def enter_sector(self, state, sector):
+        # Set up the Enterprise at a random position in a new sector
+        positions=self.geometry.positions
+        state.sector=sector
+        state.ent_position=self.rng.randint(0,positions-1)
+        # x = klingons; y = starbases; z = stars
+        x,y,z=self.decode(state.galaxy[sector])
+        state.ksec=x
+        layout=self.layouts.pop(sector,None)
+        if layout is None:
+            # Set up the current sector map
+            # Each sector has 64 positions in which a klingon, starbase, star 
+            # or the Enterprise may be located in
+            current_sector=self.init(x,y,z,state.ent_position)
+            # And keep it compact, a byte per position
+            current_sector=Sector(current_sector)
+        else:
+            # We've been here before, and everything is where we left it
+            current_sector=layout
+            while current_sector[state.ent_position] != 0:
+                state.ent_position=self.rng.randint(0,positions-1)
+            current_sector[state.ent_position]=4
+        state.klingon_positions=self.find_klingons(current_sector)
+        state.current_sector=current_sector
+
+    def arrive(self, state, new_sector):
+        # If we're still in the same sector as before, draw the Enterprise
+        if state.sector == new_sector:
+            state.current_sector[state.ent_position]=4
+        else:
+            # Else remember the sector we're leaving (navigate has already
+            # taken the Enterprise out of it) and set up the new one
+            self.keep_layout(state.sector,state.current_sector)
+            self.enter_sector(state,new_sector)
+
+    def keep_layout(self, sector, current_sector):
+        # Keep the layout of a sector in the cache, dropping the one left
+        # longest ago if it is full
+        if self.sector_cache > 0:
+            self.layouts[sector]=current_sector
+            while len(self.layouts) > self.sector_cache:
+                self.layouts.popitem(last=False)
+
+    def dock(self, state):
+        # Reset energy, torpedoes and shields
+        state.energy=3000
+        state.torpedoes=15
+        state.shields=0
+        self.publish([Docked(state.sector)])
+
+    def klingons_destroyed(self, state, ks):
+        if ks < state.ksec:
+            # (ksec-ks) Klingons have been destroyed-update galaxy map
+            state.galaxy[state.sector]=state.galaxy[state.sector]-(100*(state.ksec-ks))
+            # update total klingons
+            state.klingons=state.klingons-(state.ksec-ks)
+            # update sector klingons
+            state.ksec=ks
+            if state.klingon_positions is not None:
+                state.klingon_positions=[i for i in state.klingon_positions
+                                         if state.current_sector[i]<0]
+
+    def find_klingons(self, sector):
+        # Positions of all the Klingons in a sector, in ascending order
+        return([i for i in range (0,self.geometry.positions) if sector[i]<0])
+
+    def klingons_attack(self, state):
+        # The klingons in this sector may fire randomly on the enterprise.
+        # Returns the damage done to the shields, or None if they held fire
+        if self.rng.randint(1,9)<6:
+            damage=state.ksec*self.rng.randint(1,50)
+            state.shields=state.shields-damage
+            # Do we still have shields left?
+            if state.shields < 0:
+                state.energy = 0
+            return(damage)
+        return(None)
+
+    def scan(self, state):
+        # Short range scan followed by the status report, as one frame
+        state.condition=self.scan_condition(state.current_sector,
+        state.ent_position,state.ksec)
+        self.show_scan(state)
+
+    def show_scan(self, state):
+        self.write(self.srs_frame(state.current_sector)+self.status_frame(
+        state.stardate,state.condition,state.energy,state.torpedoes,
+        state.shields,state.klingons))
+        self.pause(SRS_PAUSE+self.status_pause())
+
     def status(self,sector,stardate,condition,energy,torpedoes,shields,klingons):
-        time.sleep(0.2 * self.second_coefficient)
-        print "\nStardate:           ",stardate 
-        time.sleep(0.2 * self.second_coefficient)
-        print "Condition:          ",condition
-        time.sleep(0.2 * self.second_coefficient)
-        print "Energy:             ",energy
-        time.sleep(0.2 * self.second_coefficient)
-        print "Photon torpedoes:   ",torpedoes
-        time.sleep(0.2 * self.second_coefficient)
-        print "Shields:            ",shields 
-        time.sleep(0.2 * self.second_coefficient)
-        print "Klingons in galaxy: ",klingons, "\n"
-        time.sleep(0.2 * self.second_coefficient)
-     
+        self.write(self.status_frame(stardate,condition,energy,torpedoes,
+        shields,klingons))
+        self.pause(self.status_pause())
+
+    def status_frame(self,stardate,condition,energy,torpedoes,shields,klingons):
+        frame=("\nStardate:            %s\n" % stardate +
+               "Condition:           %s\n" % condition +
+               "Energy:              %s\n" % energy +
+               "Photon torpedoes:    %s\n" % torpedoes +
+               "Shields:             %s\n" % shields)
+        if self.seed is None:
+            return(frame+"Klingons in galaxy:  %s \n\n" % klingons)
+        return(frame+"Klingons in galaxy:  %s\n" % klingons +
+               "Game seed:           %s \n\n" % self.seed)
+
+    def status_pause(self):
+        # The status report used to appear a line at a time, 0.2s apart
+        if self.seed is None:
+            return(1.4)
+        return(1.6)
+
     def blurb(self):
-        print "\nSpace ... the final frontier."
-        time.sleep(1.5 * self.second_coefficient)
-        print "These are the voyages of the starship Enterprise"
-        print "Its five year mission ..."
-        time.sleep(1.5 * self.second_coefficient)
-        print "... to boldly go where no-one has gone before"
-        time.sleep(1.5 * self.second_coefficient)
-        print "You are Captain Kirk."
-        print "Your mission is to destroy all of the Klingons in the galaxy."
-        time.sleep(2.5 * self.second_coefficient)
-           
+        self.write("\nSpace ... the final frontier.\n")
+        self.pause(1.5)
+        self.write("These are the voyages of the starship Enterprise\n"
+                   "Its five year mission ...\n")
+        self.pause(1.5)
+        self.write("... to boldly go where no-one has gone before\n")
+        self.pause(1.5)
+        self.write("You are Captain Kirk.\n"
+                   "Your mission is to destroy all of the Klingons in the galaxy.\n")
+        self.pause(2.5)
+
     def promotion(self):
-        print "\nYou have successfully completed your mission!"
-        print "The federation has been saved."
-        print "You have been promoted to Admiral Kirk."
-        
+        self.tell([Promoted()])
+
     def lose(self):
-        print "\nYou are relieved of duty."
-        
+        self.tell([Relieved()])
+
     def decode(self, sector):
         # Hundreds = klingons, tens = starbases, units = stars
         klingons=sector/100
@@ -200,66 +1285,61 @@ class TrekGame(object):
         return(klingons,starbases,stars)
 
     def init(self,klingons,bases,stars,eposition):
+        last=self.geometry.positions-1
         current_sector=[]
-        for j in range (0,64):
+        for j in range (0,last+1):
             current_sector.append(0)
         # A value of 4 in the sector map indicates the Enterprise's position
         current_sector[eposition]=4
+        # Pick a different empty position for everything else in one go
+        picks=free_positions(self.rng,last+1,stars+bases+klingons,eposition)
         # Add in the stars (value = 3)
-        while stars > 0:
-            position = random.randint(0,63)
-            if current_sector[position]==0:
-                current_sector[position]=3
-                stars=stars-1
+        for position in picks[:stars]:
+            current_sector[position]=3
         # Add in the starbases (value = 2)
-        while bases > 0:
-            position=random.randint(0,63)
-            if current_sector[position]==0:
-                current_sector[position]=2
-                bases=bases-1
+        for position in picks[stars:stars+bases]:
+            current_sector[position]=2
         # Add in the klingons (value = -200)
-        while klingons > 0:
-            position=random.randint(0,63)
-            if current_sector[position]==0:
-                current_sector[position]=-200
-                klingons=klingons-1
+        for position in picks[stars+bases:]:
+            current_sector[position]=-200
         return(current_sector)
         
     def srs(self,current_sector,ent_pos):
-        # Print out sector map
+        self.write(self.srs_frame(current_sector))
+        self.pause(SRS_PAUSE)
+        return(self.scan_condition(current_sector,ent_pos))
+
+    def srs_frame(self,current_sector):
+        # Draw the sector map
         # Key: >!< = Klingon
         #      <O> = Starbase
         #       *  = Star
         #      -O- = Enterprise
-        klingons=False
-        for i in range (0,64):
-            if i%8 == 0:
-                print
-                time.sleep(0.2 * self.second_coefficient)
-            if current_sector[i]<0:
-                klingons=True
-                print ">!<",
-            elif current_sector[i]==0:
-                print " . ",
-            elif current_sector[i]==2:
-                print "<O>",
-            elif current_sector[i]==3:
-                print " * ",
-            else:
-                print "-O-",
-        print
-        # Work out condition
-        if klingons == False:
-            condition="Green"
+        columns=self.geometry.sector_columns
+        rows=[]
+        for i in range (0,self.geometry.positions,columns):
+            rows.append(" ".join([srs_symbol(current_sector[j])
+                                  for j in range(i,i+columns)]))
+        return("\n"+"\n".join(rows)+"\n")
+
+    def scan_condition(self,current_sector,ent_pos,ksec=None):
+        # Work out condition. ksec, the number of Klingons left in the
+        # sector, saves looking for them all over the map
+        if ksec is None:
+            red=min(current_sector) < 0
         else:
+            red=ksec > 0
+        if red:
             condition="Red"
+        else:
+            condition="Green"
         # But docked status overrides Red/Green
         port=ent_pos-1
         starboard=ent_pos+1
         if port >= 0:
             if current_sector[port]==2:
                 condition="Docked"
-        if starboard <= 63:
+        if starboard < self.geometry.positions:
             if current_sector[starboard]==2:
                 condition="Docked"
         # Return condition status
@@ -267,16 +1347,20 @@ class TrekGame(object):
         
     def helm(self,galaxy,sector,energy,cur_sec,epos,stardate, test_direction=None, test_warp=None):
         direction=int(self.test_input('Course direction(1-9)? ', test_direction))
+        warp=None
         if direction >=1 and direction <=9 and direction !=5:
-            # Work out the horizontal and vertical co-ordinates
-            # of the Enterprise in the current sector
-            # 0,0 is top left and 7,7 is bottom right
-            horiz=epos/8
-            vert=epos-horiz*8
-            # And calculate the direction component of our course vector
-            hinc,vinc=self.calcvector(direction)
             # How far do we need to move?
             warp=int(self.test_input('Warp (1-63)? ', test_warp))
+        sector,energy,epos,stardate,events=self.navigate(direction,warp,
+        sector,energy,cur_sec,epos,stardate)
+        self.tell(events)
+        return(sector,energy,epos,stardate)
+
+    def navigate(self,direction,warp,sector,energy,cur_sec,epos,stardate):
+        # Move the Enterprise without prompting. Returns the same values as
+        # helm plus a list of events
+        events=[]
+        if direction >=1 and direction <=9 and direction !=5:
             # If warp selected is in legal range move Enterprise
             if warp >= 1 and warp <= 63:
                 # Check there is sufficient energy
@@ -287,54 +1371,60 @@ class TrekGame(object):
                     cur_sec[epos] = 0
                     # Calculate the new stardate
                     stardate = stardate + (0.1*warp)
-                    # For the moment, assume movement leaves us in original sector
-                    out = False
-                    # Move the Enterprise warp units in the specified direction
-                    i=1
-                    while i <= warp and out == False:
-                        # Calculate the movement vector
-                        vert = vert + vinc
-                        horiz = horiz + hinc
-                        # Are we in the original sector still?
-                        if vert < 0 or vert > 7 or horiz < 0 or horiz > 7:
-                            out=True
-                            # Calculate new sector and join ends of the galaxy
-                            sector=self.join(sector+8*(horiz/8)+(vert/8))
-                        else:
-                            # If we are in the original sector we can't go through
-                            # solid objects! So reset course postion 1 click
-                            # Inefficient - does this for warp steps even if we
-                            # can't move.
-                            if cur_sec[vert+8*horiz] != 0:
-                                vert=vert-vinc
-                                horiz=horiz-hinc
-                            # Put the Enterprise in the new position
-                            epos=vert+8*horiz
-                        i=i+1
+                    # The positions along our course to the edge of the sector
+                    cells,offset=self.geometry.rays[epos][direction]
+                    # Move the Enterprise warp units in the specified direction,
+                    # but we can't go through solid objects! So stop 1 click
+                    # short of the first one in our way
+                    for i in range (0,min(warp,len(cells))):
+                        if cur_sec[cells[i]] != 0:
+                            break
+                        # Put the Enterprise in the new position
+                        epos=cells[i]
+                    else:
+                        # Did we go off the edge of the sector?
+                        if warp > len(cells):
+                            # Into the neighbouring sector we're heading for
+                            sector=self.neighbours[sector][EXITS[offset]]
                 else:
-                    print "Too little energy left. Only ",energy," units remain"
+                    events.append(LowEnergy(energy))
             else:
-                print "The engines canna take it, captain!"
+                events.append(EnginesOverloaded(warp))
         else:
-            print "That's not a direction the Enterprise can go in, captain!"
-        return(sector,energy,epos,stardate)
-        
+            events.append(BadCourse(direction))
+        return(sector,energy,epos,stardate,events)
+
     def lrs(self, galaxy,sector):
-        # Print out the klingons/starbase/stars values from the
+        self.write(self.lrs_frame(galaxy,sector))
+        self.pause(LRS_PAUSE)
+
+    def lrs_frame(self, galaxy,sector):
+        # Show the klingons/starbase/stars values from the
         # neighbouring eight sectors (and this one)
-        time.sleep(0.2 * self.second_coefficient)
-        print
-        for i in range (-8,9,8):
-            for j in range (-1,2):
-                # Join the ends of the galaxy together
-                sec=self.join(sector+j+i)
-                print "%03d" % galaxy[sec],
-                time.sleep(0.2 * self.second_coefficient)
-            print
-        print
-        
-    def phasers(self, condition,shields,energy,sector,epos,ksec, test_arg=None):
+        around=self.neighbours[sector]
+        rows=[]
+        for i in range (0,9,3):
+            rows.append(" ".join(["%03d" % galaxy[around[j]]
+                                  for j in range (i,i+3)]))
+        return("\n"+"\n".join(rows)+"\n\n")
+
+    def phasers(self, condition,shields,energy,sector,epos,ksec, test_arg=None,
+                klingons=None):
         power=int(self.test_input('Phaser energy? ', test_arg))
+        fired=power <= energy
+        shields,energy,sector,ksec,events=self.fire_phasers(power,condition,
+        shields,energy,sector,epos,ksec,klingons)
+        self.tell(events)
+        if fired:
+            self.pause(0.2*len(events))
+        return(shields,energy,sector,ksec)
+
+    def fire_phasers(self,power,condition,shields,energy,sector,epos,ksec,
+                     klingons=None):
+        # Fire the phasers without prompting. Returns the same values as
+        # phasers plus a list of events. klingons lists the positions of
+        # the Klingons in the sector, if already known
+        events=[]
         if power <= energy:
             # Reduce available energy by amount directed to phaser banks
             energy=energy-power
@@ -342,159 +1432,379 @@ class TrekGame(object):
             # any present! Space can do funny things to the mind ...
             if ksec > 0:
                 power=power/ksec
-                # Work out the vertical and horizotal displacement of Enterprise
-                horiz=epos/8
-                vert=epos-(8*horiz)
-                # Check all of the 64 positions in the sector for Klingons
-                for i in range (0,64):
-                    if sector[i]<0:
-                        # We have a Klingon!
-                        # Work out its horizontal and vertical displacement
-                        horizk=i/8
-                        vertk=i-(8*horizk)
-                        # Work out distance from Klingon to Enterprise
-                        z=horiz-horizk
-                        y=vert-vertk
-                        dist=1
-                        while ((dist+1)*(dist+1))<(z*z+y*y):
-                            dist=dist+1
-                        # Klingon energy is negative, so add on the phaser power
-                        # corrected for distance
-                        sector[i]=sector[i]+int(power/dist)
-                        if sector[i]>=0:
-                            # Set this part of space to be empty
-                            sector[i]=0
-                            # Decrement sector klingons
-                            ksec=ksec-1
-                            print "Klingon destroyed!"
-                            time.sleep(0.2 * self.second_coefficient)
-                        else:
-                            # We have a hit on Enterprise's shields if not docked
-                            if condition != "Docked":
-                                damage=int(power/dist)
-                                shields=shields-damage
-                                print "Hit on shields: ",damage," energy units"
-                                time.sleep(0.2 * self.second_coefficient)
+                if klingons is None:
+                    klingons=self.find_klingons(sector)
+                # Distances from the Enterprise to every position
+                distances=self.geometry.distances[epos]
+                for i in klingons:
+                    # We have a Klingon!
+                    dist=distances[i]
+                    # Klingon energy is negative, so add on the phaser power
+                    # corrected for distance
+                    kenergy=sector[i]+int(power/dist)
+                    if kenergy>=0:
+                        # Set this part of space to be empty
+                        sector[i]=0
+                        # Decrement sector klingons
+                        ksec=ksec-1
+                        events.append(KlingonDestroyed(i))
+                    else:
+                        sector[i]=kenergy
+                        # We have a hit on Enterprise's shields if not docked
+                        if condition != "Docked":
+                            damage=int(power/dist)
+                            shields=shields-damage
+                            events.append(ShieldsHit(damage))
         else:
-            print "Not enough energy, Captain!"
-        return(shields,energy,sector,ksec)
-        
+            events.append(NotEnoughEnergy())
+        return(shields,energy,sector,ksec,events)
+
     def photontorpedoes(self, torpedoes,sector,epos,ksec, test_arg=None):
-        if torpedoes < 1:
-            print "No photon torpedoes left, captain!"
-        else:
+        direction=None
+        if torpedoes >= 1:
             direction=int(self.test_input('Fire in direction(1-4,6-9)? ', test_arg))
-            if direction >=1 and direction <=9 and direction !=5:
-                time.sleep(0.2 * self.second_coefficient)
-                # Work out the horizontal and vertical co-ordinates
-                # of the Enterprise in the current sector
-                # 0,0 is top left and 7,7 is bottom right
-                horiz=epos/8
-                vert=epos-horiz*8
-                # And calculate the direction to fire the torpedo
-                hinc,vinc=self.calcvector(direction)
-                # A torpedo only works in the current sector and stops moving
-                # when we hit something solid
-                out = False
-                while out == False:
-                     # Calculate the movement vector
-                    vert = vert + vinc
-                    horiz = horiz + hinc
-                    # Is the torpedo still in the sector?
-                    if vert < 0 or vert > 7 or horiz < 0 or horiz > 7:
-                        out=True
-                        print "Torpedo missed"
-                    else:
-                        # Have we hit an object?
-                        if sector[vert+8*horiz] == 2:
-                            # Oh dear - taking out a starbase ends the game
-                            out=True
-                            sector[vert+8*horiz] = 0
-                            energy=0
-                            print "Starbase destroyed"
-                        elif sector[vert+8*horiz] == 3:
-                            # Shooting a torpedo into a star has no effect
-                            out=True
-                            print "Torpedo missed"
-                        elif sector[vert+8*horiz] < 0:
-                            # Hit and destroyed a Klingon!
-                            out=True
-                            sector[vert+8*horiz] = 0
-                            ksec = ksec - 1
-                            print "Klingon destroyed!"
-                # One fewer torpedo
-                torpedoes = torpedoes-1
+        left,sector,ksec,events=self.fire_torpedo(direction,torpedoes,sector,
+        epos,ksec)
+        if left < torpedoes:
+            self.pause(0.2)
+        self.tell(events)
+        return(left,sector,ksec)
+
+    def fire_torpedo(self,direction,torpedoes,sector,epos,ksec):
+        # Fire a photon torpedo without prompting. Returns the same values
+        # as photontorpedoes plus a list of events
+        events=[]
+        if torpedoes < 1:
+            events.append(NoTorpedoes())
+        elif direction >=1 and direction <=9 and direction !=5:
+            # A torpedo only works in the current sector and stops moving
+            # when we hit something solid
+            for i in self.geometry.rays[epos][direction][0]:
+                # Have we hit an object?
+                if sector[i] == 2:
+                    # Oh dear - taking out a starbase ends the game
+                    sector[i] = 0
+                    energy=0
+                    events.append(StarbaseDestroyed(i))
+                    break
+                elif sector[i] == 3:
+                    # Shooting a torpedo into a star has no effect
+                    events.append(TorpedoMissed(i))
+                    break
+                elif sector[i] < 0:
+                    # Hit and destroyed a Klingon!
+                    sector[i] = 0
+                    ksec = ksec - 1
+                    events.append(KlingonDestroyed(i))
+                    break
             else:
-                print "Your command is not logical, Captain."
-        return(torpedoes,sector,ksec)
+                # The torpedo left the sector
+                events.append(TorpedoMissed(None))
+            # One fewer torpedo
+            torpedoes = torpedoes-1
+        else:
+            events.append(NotLogical())
+        return(torpedoes,sector,ksec,events)
 
     def addshields(self, energy,shields, test_arg=None):
         # Add energy to shields
         power=int(self.test_input('Energy to shields? ', test_arg))
+        return(self.transfer_shields(power,energy,shields))
+
+    def transfer_shields(self,power,energy,shields):
         if ((power > 0) and (energy >= power)):
             energy = energy - power
             shields = shields + power
         return (energy,shields)
 
     def calcvector(self, direction):
-        # Convert numeric keypad directions to that of the original game
-        # NK 7 = 7
-        # NK 4 = 6
-        # NK 1 = 5
-        # NK 2 = 4
-        # NK 3 = 3
-        # NK 6 = 2
-        # NK 9 = 1
-        # NK 8 = 0
-        # This could be rather more elegant if I didn't bother doing this!
-        # However, I'm trying to stay true to the spirit of the original
-        # BASIC listing ...
-        if direction == 4:
-            direction = 6
-        elif direction == 1:
-            direction = 5
-        elif direction == 2:
-            direction = 4
-        elif direction == 6:
-            direction = 2
-        elif direction == 9:
-            direction = 1
-        elif direction == 8:
-            direction = 0
-        # Work out the direction increment vector
-        # hinc = horizontal increment
-        # vinc = vertical increment
-        if direction < 2 or direction > 6:
-            hinc = -1
-        elif direction > 2 and direction < 6:
-            hinc = 1
-        else:
-            hinc = 0
-        if direction < 4 and direction > 0:
-            vinc = 1
-        elif direction > 4:
-            vinc = -1
-        else:
-            vinc = 0
-        return(hinc,vinc)
+        return(course_vector(direction))
         
     def join(self, sector):
         # Join the ends of the galaxy together
+        sectors = self.geometry.sectors
         if sector < 0:
-            sector = sector + 64
-        if sector > 63:
-            sector = sector - 63
+            sector = sector + sectors
+        if sector >= sectors:
+            sector = sector - sectors
         return(sector)
 
     def showhelp(self):
         # Print out the command help
-        print "1 - Helm"
-        print "2 - Long Range Scan"
-        print "3 - Phasers"
-        print "4 - Photon Torpedoes"
-        print "5 - Shields"
-        print "6 - Resign"
+        self.write("1 - Helm\n"
+                   "2 - Long Range Scan\n"
+                   "3 - Phasers\n"
+                   "4 - Photon Torpedoes\n"
+                   "5 - Shields\n"
+                   "6 - Resign\n")
     
+class StartPool(object):
+    """New games started ahead of time on a background thread.
+
+    Keeps up to size games, each the (seed, state, generator state) left
+    by TrekGame(seed=seed, **options).new_game(), where options give the
+    galaxy's shape. A TrekGame given the pool but no seed or generator
+    takes one of these instead of starting from scratch, and only
+    generates its own when the pool has run dry. hits and misses count
+    how often each happened.
+    """
+
+    def __init__(self, size=64, start=True, **options):
+        self.options = options
+        self.geometry = geometry(options.get('galaxy_size', (8, 8)),
+                                 options.get('sector_size', (8, 8)),
+                                 options.get('torus', False))
+        self.ready = Queue.Queue(size)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        if start:
+            self.start()
+
+    def make(self):
+        game = TrekGame(max_speed=True, test_mode=True, sink=NullSink(),
+                        **self.options)
+        state = game.new_game()
+        return (game.seed, state, game.rng.getstate())
+
+    def fill(self):
+        # Keep the pool topped up until stopped. The GIL means this takes
+        # turns with the games being played, so it's best done while the
+        # players are quiet
+        while self.running:
+            start = self.make()
+            while self.running:
+                try:
+                    self.ready.put(start, timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+
+    def start(self):
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self.fill,
+                                           name='trek start pool')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def take(self):
+        # A started game, or None if there isn't one ready
+        try:
+            start = self.ready.get_nowait()
+        except Queue.Empty:
+            with self.lock:
+                self.misses = self.misses + 1
+            return None
+        with self.lock:
+            self.hits = self.hits + 1
+        return start
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'ready': self.ready.qsize(),
+                'size': self.ready.maxsize}
+
+def read_script(script):
+    # The commands in a script such as "1 8 3; 3 500; 4 6", each as a list
+    # of its number and then its arguments. Commands are separated by
+    # semicolons or new lines, and anything after a # is a comment. script
+    # may be a string, or a file or any other iterable of lines, which is
+    # read as the commands are wanted
+    if isinstance(script, basestring):
+        script=[script]
+    for line in script:
+        for command in line.split('#')[0].split(';'):
+            words=command.split()
+            if words:
+                yield([int(word) for word in words])
+
+def advisor_rng(seed):
+    # A generator for the computer to choose its commands from when it plays
+    # the game with this seed. Seeds from 2**64 up are never game seeds, so
+    # its draws have nothing to do with the game's own
+    return(random.Random(seed+2**64))
+
+# Playing whole games unattended, for profiling
+
+def autoplay_answer(prompt, rng):
+    # Answer any prompt with something a captain might say: mostly flying
+    # about and fighting, with the odd scan and shield top-up
+    if prompt.startswith('Command'):
+        return rng.choice('1111222333344455')
+    if prompt.startswith('Course'):
+        return str(rng.choice((1, 2, 3, 4, 6, 7, 8, 9)))
+    if prompt.startswith('Warp'):
+        return str(rng.randint(1, 8))
+    if prompt.startswith('Phaser'):
+        return str(rng.randint(100, 600))
+    if prompt.startswith('Energy'):
+        return str(rng.randint(50, 300))
+    return str(rng.choice((1, 2, 3, 4, 6, 7, 8, 9)))
+
+def autoplay(seed, max_commands=1000):
+    # Play the game with this seed right through at max speed, answering
+    # from a generator of our own, seeded apart by advisor_rng, so the
+    # game's draws stay its own and our answers don't follow them.
+    # Resigns after max_commands commands. Returns how many commands we
+    # gave, not counting that resignation
+    game=TrekGame(max_speed=True, seed=seed, sink=NullSink())
+    rng=advisor_rng(seed)
+    play=game.play()
+    commands=0
+    try:
+        prompt=next(play)
+        while True:
+            if prompt.startswith('Command'):
+                if commands >= max_commands:
+                    prompt=play.send('6')
+                    continue
+                commands=commands+1
+            prompt=play.send(autoplay_answer(prompt, rng))
+    except StopIteration:
+        pass
+    return(commands)
+
+def frame_names():
+    # Names for the code of every method of the classes here, such as
+    # TrekGame.navigate, so profiles group by method
+    names={}
+    for name, cls in globals().items():
+        if inspect.isclass(cls) and cls.__module__ == __name__:
+            for attr, function in cls.__dict__.items():
+                if inspect.isfunction(function):
+                    names[function.func_code]=cls.__name__+'.'+attr
+    return(names)
+
+def frame_name(code, names):
+    name=names.get(code)
+    if name is None:
+        name='%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+    return(name)
+
+class Sampler(object):
+    # A sampling profiler. Every interval seconds of processor time the
+    # stack is recorded, outermost frame first, and counted
+    def __init__(self, interval=0.001):
+        self.interval=interval
+        self.names=frame_names()
+        self.stacks=Counter()
+
+    def sample(self, signum, frame):
+        # Stacks start from the game being played, leaving out the
+        # profiler that is playing it
+        stack=[]
+        while frame is not None and frame.f_code is not autoplay.func_code:
+            stack.append(frame_name(frame.f_code, self.names))
+            frame=frame.f_back
+        stack.reverse()
+        self.stacks[tuple(stack)]+=1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def write_collapsed(self, out):
+        # One line per stack, as flamegraph.pl and speedscope read them
+        for stack, count in sorted(self.stacks.items()):
+            out.write('%s %d\n' % (';'.join(stack), count))
+
+    def by_method(self):
+        # Samples in which each method was running or waiting on a call,
+        # for our own classes only
+        methods=Counter()
+        ours=set(self.names.values())
+        for stack, count in self.stacks.items():
+            for name in set(stack) & ours:
+                methods[name]+=count
+        return(methods)
+
+def profile(games, seed=0, out='trek-profile', interval=0.001,
+            max_commands=1000, report=None):
+    # Play games seeded seed, seed+1, ... under cProfile, writing out.pstats,
+    # then play them again under the Sampler, writing out.folded. Each
+    # profiler gets the same games to itself. The report goes to standard
+    # output unless given somewhere else
+    if report is None:
+        report=sys.stdout
+    seeds=range(seed, seed+games)
+    profiler=cProfile.Profile()
+    profiler.enable()
+    for s in seeds:
+        autoplay(s, max_commands)
+    profiler.disable()
+    profiler.dump_stats(out+'.pstats')
+    sampler=Sampler(interval)
+    sampler.start()
+    try:
+        commands=sum(autoplay(s, max_commands) for s in seeds)
+    finally:
+        sampler.stop()
+    with open(out+'.folded', 'w') as f:
+        sampler.write_collapsed(f)
+    report.write('%d games, %d commands\n\n' % (games, commands))
+    stats=pstats.Stats(profiler, stream=report)
+    stats.sort_stats('cumulative').print_stats(
+        os.path.splitext(os.path.basename(__file__))[0]+r'\.py', 20)
+    methods=sampler.by_method()
+    total=sum(sampler.stacks.values()) or 1
+    report.write('Samples by method (%d in all)\n' % total)
+    for name, count in methods.most_common(20):
+        report.write('%6.1f%%  %s\n' % (100.0*count/total, name))
+    report.write('\nWrote %s.pstats and %s.folded\n' % (out, out))
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='Star Trek, as played in '
+                                   'Tiny Basic.')
+    parser.add_argument('--profile', type=int, metavar='GAMES',
+                        help='instead of playing, profile this many seeded '
+                             'games played by the computer at max speed')
+    parser.add_argument('--seed', type=int,
+                        help='seed of the game, or of the first profiled game')
+    parser.add_argument('--script', metavar='FILE',
+                        help="play the commands in FILE ('-' for standard "
+                             "input), such as 1 8 3; 3 500; 4 6")
+    parser.add_argument('--echo', action='store_true',
+                        help='show the prompts and answers from the script')
+    parser.add_argument('--max-speed', action='store_true',
+                        help='no dramatic pauses')
+    parser.add_argument('--sector-cache', type=int, default=0,
+                        metavar='SECTORS',
+                        help='remember how the last SECTORS sectors left were '
+                             'laid out, so going back finds them the same')
+    parser.add_argument('--out', default='trek-profile',
+                        help='where to write the profiles, as OUT.pstats '
+                             'and OUT.folded')
+    parser.add_argument('--interval', type=float, default=0.001,
+                        help='seconds of processor time between samples')
+    args=parser.parse_args(argv)
+    if args.profile is not None and args.profile < 0:
+        parser.error('--profile needs a number of games')
+    if args.profile is not None:
+        profile(args.profile, args.seed or 0, args.out, args.interval)
+        return
+    game = TrekGame(max_speed=args.max_speed, seed=args.seed,
+                    sector_cache=args.sector_cache)
+    if args.script is None:
+        game.main()
+    elif args.script == '-':
+        game.main(script=sys.stdin, echo=args.echo)
+    else:
+        with open(args.script) as script:
+            game.main(script=script, echo=args.echo)
+
 if __name__ == '__main__':
-    game = TrekGame()
-    game.main()
+    main()
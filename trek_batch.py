@@ -0,0 +1,372 @@
+"""Batch versions of the trek engine built on NumPy.
+
+Unlike trek itself these need NumPy installed.
+"""
+import numpy
+
+import trek
+
+# One galaxy sector: how many klingons, starbases and stars it holds
+SECTOR_DTYPE = numpy.dtype([('klingons', numpy.uint8),
+                            ('starbases', numpy.uint8),
+                            ('stars', numpy.uint8)])
+
+# Every possible galaxy sector, one for each number a sector is drawn as:
+# the number's digits in bases 5, 10, 3 and 100 give four independent
+# uniform numbers for the stars, whether there are Klingons, how many and
+# whether there is a starbase
+SECTOR_DRAWS = 5 * 10 * 3 * 100
+
+def make_sectors():
+    draw, stars = numpy.divmod(numpy.arange(SECTOR_DRAWS), 5)
+    draw, present = numpy.divmod(draw, 10)
+    starbase, klingons = numpy.divmod(draw, 3)
+    sectors = numpy.empty(SECTOR_DRAWS, SECTOR_DTYPE)
+    sectors['stars'] = stars + 1
+    sectors['klingons'] = (present < 7) * (klingons + 1)
+    sectors['starbases'] = starbase >= 88
+    return sectors
+
+def draw_sectors(count, rng):
+    # count galaxies of sectors as indices into SECTORS
+    return rng.randint(0, SECTOR_DRAWS, (count, 64), dtype=numpy.uint16)
+
+def generate_galaxies(count, seed=None, rng=None):
+    """Generate count galaxies at once.
+
+    Returns a (count, 64) array of SECTOR_DTYPE and the number of
+    Klingons in each galaxy. Each sector follows the same odds as
+    TrekGame.make_galaxy: 1-5 stars, 1-3 Klingons 70% of the time and a
+    starbase 12% of the time. rng may be a numpy.random.RandomState to
+    draw from instead of seeding a new one.
+    """
+    if rng is None:
+        rng = numpy.random.RandomState(seed)
+    galaxies = SECTORS[draw_sectors(count, rng)]
+    klingons = galaxies['klingons'].sum(axis=1, dtype=numpy.int64)
+    return galaxies, klingons
+
+def encode(galaxies):
+    # Pack sectors into the hundreds/tens/units numbers TrekGame uses
+    packed = galaxies['klingons'].astype(numpy.int16) * 100
+    packed += galaxies['starbases'] * 10
+    packed += galaxies['stars']
+    return packed
+
+SECTORS = make_sectors()
+# The same sectors packed, with the Klingons in each above them, for
+# TrekVecEnv.reset. The low 16 bits are the packed sector, and a galaxy's
+# packed sectors add up to less than 2**16, so adding up a galaxy and
+# shifting gives its Klingons
+PACKED_SECTORS = (encode(SECTORS).astype(numpy.int32)
+                  + (SECTORS['klingons'].astype(numpy.int32) << 16))
+
+# Course vectors (horizontal, vertical increments) for keypad directions,
+# as given by trek.course_vector. 0 and 5 are not valid directions
+VECTORS = numpy.array([trek.course_vector(d) for d in range(10)])
+VALID_DIRECTION = numpy.array([d not in (0, 5) for d in range(10)])
+
+# Phaser distance between every pair of positions, indexed by [epos, kpos]
+DISTANCES = numpy.array(trek.DISTANCES)
+
+# The nine sectors around each sector, as trek.NEIGHBOURS and
+# trek.TORUS_NEIGHBOURS, indexed by [sector, 3 * rows + columns + 4]
+NEIGHBOURS = numpy.array(trek.NEIGHBOURS)
+TORUS_NEIGHBOURS = numpy.array(trek.TORUS_NEIGHBOURS)
+
+# What goes on the cells TrekVecEnv.enter_sector picks, for each number
+# of stars and starbases: the stars, then the starbases, then Klingons, up
+# to the 27 objects a sector's digits can ask for
+KINDS = numpy.array([[3] * stars + [2] * bases + [-200] * (27 - stars - bases)
+                     for stars in range(10) for bases in range(10)])
+
+# Outcomes returned by TrekVecEnv.step for each game
+PLAYING, WON, LOST = 0, 1, 2
+
+# Condition codes held by TrekVecEnv and the names TrekGame uses for them
+GREEN, RED, DOCKED = 0, 1, 2
+CONDITIONS = ("Green", "Red", "Docked")
+
+class TrekVecEnv(object):
+    """n games of trek held as arrays and played in lockstep.
+
+    step applies one command to every game at once with the same rules
+    as TrekGame.step. Each game's current sector is a row of 64 values
+    in the usual 0/2/3/4/negative Klingon energy encoding and its galaxy
+    a row of 64 hundreds/tens/units numbers. Games that are over ignore
+    further commands until they are reset.
+    """
+    def __init__(self, n, seed=None, rng=None, torus=False):
+        if rng is None:
+            rng = numpy.random.RandomState(seed)
+        self.n = n
+        self.rng = rng
+        if torus:
+            self.neighbours = TORUS_NEIGHBOURS
+        else:
+            self.neighbours = NEIGHBOURS
+        self.galaxy = numpy.zeros((n, 64), numpy.int16)
+        self.current_sector = numpy.zeros((n, 64), numpy.int64)
+        self.energy = numpy.zeros(n, numpy.int64)
+        self.shields = numpy.zeros(n, numpy.int64)
+        self.torpedoes = numpy.zeros(n, numpy.int64)
+        self.sector = numpy.zeros(n, numpy.int64)
+        self.ent_position = numpy.zeros(n, numpy.int64)
+        self.stardate = numpy.zeros(n, numpy.float64)
+        self.klingons = numpy.zeros(n, numpy.int64)
+        self.ksec = numpy.zeros(n, numpy.int64)
+        self.condition = numpy.zeros(n, numpy.int8)
+        self.reset()
+
+    def reset(self, indices=None):
+        # Start new games in the given slots, or in all of them
+        if indices is None:
+            indices = numpy.arange(self.n)
+        indices = numpy.asarray(indices)
+        # generate_galaxies, going straight to the packed sectors
+        packed = PACKED_SECTORS.take(draw_sectors(len(indices), self.rng))
+        self.galaxy[indices] = packed
+        self.klingons[indices] = packed.sum(axis=1, dtype=numpy.int64) >> 16
+        self.stardate[indices] = self.rng.randint(1000, 1500, len(indices))
+        self.dock(indices)
+        self.enter_sector(indices, self.rng.randint(0, 64, len(indices)))
+        self.scan_condition(indices)
+
+    def outcome(self):
+        return numpy.where(self.klingons == 0, WON,
+                           numpy.where(self.energy <= 0, LOST, PLAYING))
+
+    def step(self, commands, args=None):
+        """Apply commands[i] to game i and return every game's outcome.
+
+        args is an (n, 2) array holding what each command would prompt
+        for, as in TrekGame.step; unused columns are ignored.
+        """
+        commands = numpy.asarray(commands)
+        if args is None:
+            args = numpy.zeros((self.n, 2), numpy.int64)
+        args = numpy.asarray(args, numpy.int64)
+        playing = self.outcome() == PLAYING
+        for command, apply in ((1, self.helm), (3, self.phasers),
+                               (4, self.photontorpedoes),
+                               (5, self.addshields)):
+            indices = numpy.flatnonzero(playing & (commands == command))
+            if len(indices):
+                apply(indices, args[indices])
+        self.energy[playing & (commands == 6)] = 0
+        # Commands other than help give the Klingons their turn
+        indices = numpy.flatnonzero(playing & (commands != 0)
+                                    & (self.condition == RED))
+        if len(indices):
+            self.klingons_attack(indices)
+        return self.outcome()
+
+    def lrs(self):
+        # The long range scan of every game: an (n, 3, 3) array of the
+        # galaxy numbers around each game's current sector
+        around = self.neighbours[self.sector]
+        scan = self.galaxy[numpy.arange(self.n)[:, None], around]
+        return scan.reshape(self.n, 3, 3)
+
+    def helm(self, indices, args):
+        direction, warp = args[:, 0], args[:, 1]
+        ok = (VALID_DIRECTION[direction.clip(0, 9)]
+              & (direction >= 1) & (direction <= 9)
+              & (warp >= 1) & (warp <= 63) & (warp <= self.energy[indices]))
+        moving = indices[ok]
+        warp = warp[ok]
+        self.energy[moving] -= warp
+        self.stardate[moving] += 0.1 * warp
+        epos = self.ent_position[moving]
+        self.current_sector[moving, epos] = 0
+        hinc, vinc = VECTORS[direction[ok]].T
+        horiz, vert = epos // 8, epos % 8
+        new_sector = self.sector[moving].copy()
+        going = numpy.ones(len(moving), bool)
+        # The Enterprise stops short of the first object in its path, or
+        # leaves the sector. That takes at most eight clicks at any warp
+        for click in range(1, 9):
+            going &= click <= warp
+            h, v = horiz + hinc, vert + vinc
+            out = going & ((v < 0) | (v > 7) | (h < 0) | (h > 7))
+            new_sector[out] = self.neighbours[new_sector[out],
+                                              3 * (h[out] // 8) + v[out] // 8
+                                              + 4]
+            inside = going & ~out
+            cell = (v + 8 * h).clip(0, 63)
+            clear = inside & (self.current_sector[moving, cell] == 0)
+            horiz[clear], vert[clear] = h[clear], v[clear]
+            going = clear
+        self.ent_position[moving] = vert + 8 * horiz
+        # Draw the Enterprise if we're still in the same sector, or set it
+        # up in the new one
+        left = new_sector != self.sector[moving]
+        stayed = indices[~numpy.in1d(indices, moving[left])]
+        self.current_sector[stayed, self.ent_position[stayed]] = 4
+        if left.any():
+            self.enter_sector(moving[left], new_sector[left])
+        self.scan_condition(indices)
+        self.dock(indices[self.condition[indices] == DOCKED])
+
+    def phasers(self, indices, args):
+        power = args[:, 0]
+        fire = power <= self.energy[indices]
+        indices, power = indices[fire], power[fire]
+        self.energy[indices] -= power
+        aimed = self.ksec[indices] > 0
+        indices, power = indices[aimed], power[aimed]
+        # Phaser power is shared between the Klingons and falls off with
+        # distance. Every Klingon takes its share, and any that survive
+        # hit the shields unless we're docked
+        power = power // self.ksec[indices]
+        # Only the Klingons' cells, row by row
+        rows, cells = numpy.nonzero(self.current_sector[indices] < 0)
+        games = indices[rows]
+        damage = power[rows] // DISTANCES[self.ent_position[games], cells]
+        hit = self.current_sector[games, cells] + damage
+        destroyed = hit >= 0
+        self.current_sector[games, cells] = numpy.where(destroyed, 0, hit)
+        # Add up each game's hits on the shields and Klingons destroyed
+        counts = numpy.bincount(rows, minlength=len(indices))
+        ends = counts.cumsum()
+        starts = ends - counts
+        shots = numpy.concatenate(([0], numpy.where(destroyed, 0,
+                                                    damage).cumsum()))
+        kills = numpy.concatenate(([0], destroyed.cumsum()))
+        exposed = self.condition[indices] != DOCKED
+        self.shields[indices] -= exposed * (shots[ends] - shots[starts])
+        self.klingons_destroyed(indices, kills[ends] - kills[starts])
+        # Do we still have shields left?
+        dead = self.shields[indices] < 0
+        self.energy[indices[dead]] = 0
+        self.scan_condition(indices[~dead])
+
+    def photontorpedoes(self, indices, args):
+        direction = args[:, 0]
+        ok = (VALID_DIRECTION[direction.clip(0, 9)]
+              & (direction >= 1) & (direction <= 9)
+              & (self.torpedoes[indices] >= 1))
+        firing = indices[ok]
+        self.torpedoes[firing] -= 1
+        epos = self.ent_position[firing]
+        hinc, vinc = VECTORS[direction[ok]].T
+        horiz, vert = epos // 8, epos % 8
+        destroyed = numpy.zeros(len(firing), numpy.int64)
+        flying = numpy.ones(len(firing), bool)
+        # A torpedo flies until it leaves the sector or hits something
+        for click in range(1, 9):
+            horiz, vert = horiz + hinc, vert + vinc
+            flying &= (vert >= 0) & (vert <= 7) & (horiz >= 0) & (horiz <= 7)
+            cell = (vert + 8 * horiz).clip(0, 63)
+            target = self.current_sector[firing, cell]
+            hit = flying & (target != 0)
+            # Starbases and Klingons are destroyed, stars absorb it
+            gone = hit & ((target == 2) | (target < 0))
+            self.current_sector[firing[gone], cell[gone]] = 0
+            destroyed += gone & (target < 0)
+            flying &= ~hit
+        self.klingons_destroyed(firing, destroyed)
+        self.scan_condition(indices)
+
+    def addshields(self, indices, args):
+        power = args[:, 0]
+        ok = (power > 0) & (self.energy[indices] >= power)
+        indices, power = indices[ok], power[ok]
+        self.energy[indices] -= power
+        self.shields[indices] += power
+
+    def klingons_destroyed(self, indices, destroyed):
+        self.galaxy[indices, self.sector[indices]] -= 100 * destroyed
+        self.klingons[indices] -= destroyed
+        self.ksec[indices] -= destroyed
+
+    def klingons_attack(self, indices):
+        # Each Klingon-occupied game is fired on with probability 5/9
+        attack = self.rng.randint(1, 10, len(indices)) < 6
+        damage = self.ksec[indices] * self.rng.randint(1, 51, len(indices))
+        indices, damage = indices[attack], damage[attack]
+        self.shields[indices] -= damage
+        self.energy[indices[self.shields[indices] < 0]] = 0
+
+    def dock(self, indices):
+        # Reset energy, torpedoes and shields
+        self.energy[indices] = 3000
+        self.torpedoes[indices] = 15
+        self.shields[indices] = 0
+
+    def enter_sector(self, indices, sectors):
+        # Set up the Enterprise at a random position in each new sector.
+        # Stars, then starbases, then Klingons go on distinct random cells
+        # other than the Enterprise's. Each row draws all its cells at once
+        # and draws them again if any two are the same, which keeps every
+        # layout equally likely
+        count = len(indices)
+        self.sector[indices] = sectors
+        packed = self.galaxy[indices, sectors]
+        klingons, bases, stars = packed // 100, packed // 10 % 10, packed % 10
+        self.ksec[indices] = klingons
+        epos = self.rng.randint(0, 64, count)
+        self.ent_position[indices] = epos
+        placed = stars + bases + klingons
+        columns = numpy.arange(placed.max() if count else 0)
+        used = columns < placed[:, None]
+        cells = numpy.empty((count, len(columns)), numpy.uint8)
+        unused = (64 + columns).astype(numpy.uint8)
+        redo = numpy.arange(count)
+        while len(redo):
+            draw = self.rng.randint(0, 63, (len(redo), len(columns)),
+                                    dtype=numpy.uint8)
+            # Step over the Enterprise
+            draw += draw >= epos[redo, None]
+            cells[redo] = draw
+            # Unused columns get cells of their own so they never clash
+            keys = numpy.where(used[redo], draw, unused)
+            keys.sort(axis=1)
+            redo = redo[(keys[:, 1:] == keys[:, :-1]).any(axis=1)]
+        kinds = KINDS[10 * stars + bases, :len(columns)]
+        sector = self.current_sector
+        sector[indices] = 0
+        # Place everything in one go through the flattened sectors
+        cells = cells + 64 * indices[:, None]
+        sector.reshape(-1)[cells[used]] = kinds[used]
+        sector[indices, epos] = 4
+
+    def scan_condition(self, indices):
+        # Red if there are Klingons about, going by the count kept in ksec
+        # rather than searching the map, but being docked next to a
+        # starbase overrides Red/Green
+        cells = self.current_sector
+        epos = self.ent_position[indices]
+        port = (epos >= 1) & (cells[indices, (epos - 1).clip(0, 63)] == 2)
+        starboard = (epos <= 62) & (cells[indices,
+                                          (epos + 1).clip(0, 63)] == 2)
+        self.condition[indices] = numpy.where(
+            port | starboard, DOCKED,
+            numpy.where(self.ksec[indices] > 0, RED, GREEN))
+
+    def get_state(self, i):
+        # Copy game i into a trek.GameState
+        return trek.GameState(
+            energy=int(self.energy[i]), torpedoes=int(self.torpedoes[i]),
+            shields=int(self.shields[i]), galaxy=self.galaxy[i].tolist(),
+            sector=int(self.sector[i]), ent_position=int(self.ent_position[i]),
+            current_sector=self.current_sector[i].tolist(),
+            stardate=float(self.stardate[i]), klingons=int(self.klingons[i]),
+            ksec=int(self.ksec[i]),
+            condition=CONDITIONS[self.condition[i]],
+            klingon_positions=numpy.flatnonzero(
+                self.current_sector[i] < 0).tolist())
+
+    def set_state(self, i, state):
+        # Copy a trek.GameState into game i
+        self.energy[i] = state.energy
+        self.torpedoes[i] = state.torpedoes
+        self.shields[i] = state.shields
+        self.galaxy[i] = state.galaxy
+        self.sector[i] = state.sector
+        self.ent_position[i] = state.ent_position
+        self.current_sector[i] = state.current_sector
+        self.stardate[i] = state.stardate
+        self.klingons[i] = state.klingons
+        self.ksec[i] = state.ksec
+        self.condition[i] = CONDITIONS.index(state.condition)
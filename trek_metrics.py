@@ -0,0 +1,273 @@
+import BaseHTTPServer
+from bisect import bisect_left
+from collections import OrderedDict
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows, see thread_time
+    resource = None
+
+import trek
+
+# Counts and timings for the commands captains give, for finding out which
+# ones are slow. Give a TrekGame metrics=Metrics() and every game it plays
+# through main is measured; trek_server measures all its games into one.
+# Nothing is measured, or costs anything, unless a Metrics is given
+#
+# A command is timed from the captain's last answer to the next command
+# prompt, so waiting for the captain to type never counts. wall is the
+# elapsed time and cpu the processor time the game's own thread used in
+# that span. Pauses are counted both as asked for (paced) and as actually
+# spent blocked (slept): a game paced by trek.Pacer asks for pauses but
+# never sleeps
+
+if resource is not None and sys.platform.startswith('linux'):
+    # Python 2 doesn't name RUSAGE_THREAD, which is 1 on Linux
+    RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+    def thread_time():
+        # Processor time used by the calling thread alone, so that other
+        # threads, such as a trek.StartPool topping itself up, are never
+        # charged to the command being timed
+        usage = resource.getrusage(RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+else:
+    # Elsewhere all we have is the time used by the whole process
+    thread_time = time.clock
+
+COMMANDS = {0: 'help', 1: 'helm', 2: 'lrs', 3: 'phasers', 4: 'torpedoes',
+            5: 'shields', 6: 'resign'}
+
+# Histogram bucket upper bounds in seconds, as Prometheus would have them
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Game counters, each bumped by the events named
+COUNTERS = OrderedDict([
+    ('klingons_destroyed', (trek.KlingonDestroyed,)),
+    ('shield_hits', (trek.ShieldsHit,)),
+    ('dockings', (trek.Docked,)),
+    ('starbases_destroyed', (trek.StarbaseDestroyed,)),
+    ('games_won', (trek.Promoted,)),
+    ('games_lost', (trek.Relieved,))])
+
+class Histogram(object):
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        # One count for each bucket, plus one for anything bigger
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total = self.total + value
+        self.count = self.count + 1
+
+    def snapshot(self):
+        return {'buckets': list(self.counts), 'sum': self.total,
+                'count': self.count}
+
+class CommandStats(object):
+    __slots__ = ('calls', 'wall', 'cpu', 'paced', 'slept')
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = Histogram()
+        self.cpu = Histogram()
+        self.paced = 0.0
+        self.slept = 0.0
+
+class TimedClock(object):
+    # Stands in for a game's clock, adding up its pauses
+    def __init__(self, clock):
+        self.clock = clock
+        self.paced = 0.0
+        self.slept = 0.0
+
+    def time(self):
+        return self.clock.time()
+
+    def pause(self, seconds):
+        started = time.time()
+        self.clock.pause(seconds)
+        self.slept = self.slept + time.time() - started
+        self.paced = self.paced + seconds
+
+class MeasuredPlay(object):
+    # Wraps TrekGame.play like trek_replay.RecordedPlay, timing each
+    # command from the answer that completes it to the next command prompt
+    def __init__(self, play, game, metrics):
+        self.play = play
+        self.metrics = metrics
+        self.clock = game.clock = TimedClock(game.clock)
+        self.prompt = None
+        self.command = None
+        self.wall = 0.0
+        self.cpu = 0.0
+        metrics.count('games_started')
+
+    def __iter__(self):
+        return self
+
+    def run(self, resume, *answer):
+        wall = time.time()
+        cpu = thread_time()
+        try:
+            self.prompt = resume(*answer)
+        except StopIteration:
+            self.add(wall, cpu)
+            self.finish()
+            raise
+        self.add(wall, cpu)
+        if self.prompt.startswith('Command'):
+            self.finish()
+        return self.prompt
+
+    def add(self, wall, cpu):
+        self.wall = self.wall + time.time() - wall
+        self.cpu = self.cpu + thread_time() - cpu
+
+    def finish(self):
+        if self.command is not None:
+            clock = self.clock
+            self.metrics.observe(self.command, self.wall, self.cpu,
+                                 clock.paced, clock.slept)
+        self.command = None
+        self.wall = self.cpu = self.clock.paced = self.clock.slept = 0.0
+
+    def next(self):
+        return self.run(self.play.next)
+
+    def send(self, answer):
+        if self.prompt is not None and self.prompt.startswith('Command'):
+            self.command = int(answer)
+        return self.run(self.play.send, answer)
+
+    def close(self):
+        self.play.close()
+
+class Metrics(object):
+    """Command timings and game counters, shared by any number of games.
+
+    snapshot() returns everything as plain data and prometheus() in the
+    Prometheus text format, which serve() offers over HTTP.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.counters = OrderedDict([('games_started', 0)] +
+                                    [(name, 0) for name in COUNTERS])
+
+    def measure(self, play, game):
+        # Measure a game being played through play, from game.play()
+        game.subscribe(self.event)
+        return MeasuredPlay(play, game, self)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters[name] + n
+
+    def event(self, event):
+        for name, kinds in COUNTERS.items():
+            if isinstance(event, kinds):
+                self.count(name)
+
+    def observe(self, command, wall, cpu, paced=0.0, slept=0.0):
+        name = COMMANDS.get(command, 'unknown')
+        with self.lock:
+            stats = self.commands.get(name)
+            if stats is None:
+                stats = self.commands[name] = CommandStats()
+            stats.calls = stats.calls + 1
+            stats.wall.observe(wall)
+            stats.cpu.observe(cpu)
+            stats.paced = stats.paced + paced
+            stats.slept = stats.slept + slept
+
+    def snapshot(self):
+        with self.lock:
+            commands = {}
+            for name, stats in self.commands.items():
+                commands[name] = {'calls': stats.calls,
+                                  'wall': stats.wall.snapshot(),
+                                  'cpu': stats.cpu.snapshot(),
+                                  'paced': stats.paced,
+                                  'slept': stats.slept,
+                                  # Time not spent blocked in a pause
+                                  'logic': stats.wall.total - stats.slept}
+            return {'buckets': list(BUCKETS), 'commands': commands,
+                    'counters': OrderedDict(self.counters)}
+
+    def prometheus(self):
+        snapshot = self.snapshot()
+        commands = sorted(snapshot['commands'].items())
+        lines = []
+        def metric(name, kind, text):
+            lines.append('# HELP trek_%s %s' % (name, text))
+            lines.append('# TYPE trek_%s %s' % (name, kind))
+        metric('commands_total', 'counter', 'Commands given.')
+        for name, stats in commands:
+            lines.append('trek_commands_total{command="%s"} %d'
+                         % (name, stats['calls']))
+        for kind, text in (('wall', 'Elapsed time running each command.'),
+                           ('cpu', 'Processor time running each command.')):
+            metric('command_%s_seconds' % kind, 'histogram', text)
+            for name, stats in commands:
+                histogram = stats[kind]
+                total = 0
+                bounds = ['%g' % bound for bound in BUCKETS] + ['+Inf']
+                for bound, count in zip(bounds, histogram['buckets']):
+                    total = total + count
+                    lines.append('trek_command_%s_seconds_bucket'
+                                 '{command="%s",le="%s"} %d'
+                                 % (kind, name, bound, total))
+                lines.append('trek_command_%s_seconds_sum{command="%s"} %r'
+                             % (kind, name, histogram['sum']))
+                lines.append('trek_command_%s_seconds_count{command="%s"} %d'
+                             % (kind, name, histogram['count']))
+        for kind, text in (
+                ('paced', 'Pauses asked for while running each command.'),
+                ('slept', 'Time blocked in pauses while running each command.'),
+                ('logic', 'Elapsed time running each command, less pauses.')):
+            metric('command_%s_seconds_total' % kind, 'counter', text)
+            for name, stats in commands:
+                lines.append('trek_command_%s_seconds_total{command="%s"} %r'
+                             % (kind, name, stats[kind]))
+        for name, value in snapshot['counters'].items():
+            metric('%s_total' % name, 'counter',
+                   name.capitalize().replace('_', ' ') + '.')
+            lines.append('trek_%s_total %d' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host='127.0.0.1', port=9464):
+        # Serve prometheus() at /metrics from a background thread. Returns
+        # the HTTP server, whose shutdown() stops it
+        metrics = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='trek metrics')
+        thread.daemon = True
+        thread.start()
+        return server
@@ -0,0 +1,307 @@
+import argparse
+from array import array
+import struct
+import sys
+
+import trek
+import trek_sim
+
+# A game is recorded as its seed, the version of the game that played it,
+# the shape of its galaxy, the commands given and a summary of how it
+# ended. Replaying the commands from the seed must reproduce that summary
+# exactly
+#
+# Each log is packed as
+#   header   magic, format, game version, seed, number of commands, galaxy
+#            rows and columns, sector rows and columns, whether the galaxy
+#            is a torus and how many sector layouts are kept
+#   final    energy, torpedoes, shields, klingons, sector, position,
+#            stardate and outcome at the end of the game
+#   commands one varint of command*4 + number of arguments for each
+#            command, followed by its arguments as varints
+# All varints are zigzag encoded so that negative numbers stay short
+
+MAGIC = 'TRKL'
+FORMAT = 2
+HEADER = struct.Struct('<4sBHQIHHHH?I')
+FINAL = struct.Struct('<iHiIIIdB')
+LENGTH = struct.Struct('<I')
+
+OUTCOMES = (None, trek.WON, trek.LOST)
+
+# The TrekGame arguments that change how a game plays out, as the classic
+# game has them
+CLASSIC = {'galaxy_size': (8, 8), 'sector_size': (8, 8), 'torus': False,
+           'sector_cache': 0}
+
+class LogError(ValueError):
+    pass
+
+def zigzag(n):
+    if n < 0:
+        return (-n << 1) - 1
+    return n << 1
+
+def unzigzag(n):
+    if n & 1:
+        return -((n + 1) >> 1)
+    return n >> 1
+
+def put_varint(out, n):
+    n = zigzag(n)
+    while n > 0x7f:
+        out.append(0x80 | (n & 0x7f))
+        n = n >> 7
+    out.append(n)
+
+def get_varint(data, i):
+    n = 0
+    shift = 0
+    while True:
+        if i >= len(data):
+            raise LogError('command log is truncated')
+        byte = data[i]
+        i = i + 1
+        n = n | ((byte & 0x7f) << shift)
+        if byte < 0x80:
+            return unzigzag(n), i
+        shift = shift + 7
+
+def options(game):
+    # The arguments game was made with that a log has to record
+    geometry = game.geometry
+    return {'galaxy_size': (geometry.galaxy_rows, geometry.galaxy_columns),
+            'sector_size': (geometry.sector_rows, geometry.sector_columns),
+            'torus': geometry.torus, 'sector_cache': game.sector_cache}
+
+def summary(state, outcome):
+    return (state.energy, state.torpedoes, state.shields, state.klingons,
+            state.sector, state.ent_position, state.stardate, outcome)
+
+class CommandLog(object):
+    __slots__ = ('seed', 'version', 'commands', 'final', 'options')
+
+    def __init__(self, seed, version=trek.VERSION, commands=None, final=None,
+                 options=None):
+        if seed is None:
+            raise LogError('games with an injected generator cannot be logged')
+        self.seed = seed
+        self.version = version
+        if commands is None:
+            commands = []
+        self.commands = commands
+        self.final = final
+        # The TrekGame arguments to replay with, see options()
+        if options is None:
+            options = CLASSIC
+        self.options = dict(options)
+
+    def add(self, command, args=()):
+        args = tuple(args)
+        if len(args) > 3:
+            raise LogError('commands take at most three arguments')
+        self.commands.append((command, args))
+
+    def finish(self, state, outcome):
+        self.final = summary(state, outcome)
+
+    def __eq__(self, other):
+        return (isinstance(other, CommandLog) and
+                (self.seed, self.version, self.commands, self.final,
+                 self.options) ==
+                (other.seed, other.version, other.commands, other.final,
+                 other.options))
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def pack(self):
+        if self.final is None:
+            raise LogError('the game has not been finished')
+        energy, torpedoes, shields, klingons, sector, position, stardate, \
+            outcome = self.final
+        body = array('B')
+        for command, args in self.commands:
+            put_varint(body, command * 4 + len(args))
+            for arg in args:
+                put_varint(body, arg)
+        options = self.options
+        try:
+            return (HEADER.pack(MAGIC, FORMAT, self.version, self.seed,
+                                len(self.commands),
+                                *(tuple(options['galaxy_size']) +
+                                  tuple(options['sector_size']) +
+                                  (options['torus'], options['sector_cache']))) +
+                    FINAL.pack(energy, torpedoes, shields, klingons, sector,
+                               position, stardate, OUTCOMES.index(outcome)) +
+                    body.tostring())
+        except struct.error:
+            raise LogError('the game has values too large to log')
+
+    @classmethod
+    def unpack(cls, data):
+        if len(data) < HEADER.size + FINAL.size:
+            raise LogError('command log is truncated')
+        magic, format, version, seed, count, galaxy_rows, galaxy_columns, \
+            sector_rows, sector_columns, torus, sector_cache = \
+            HEADER.unpack_from(data)
+        if magic != MAGIC or format != FORMAT:
+            raise LogError('not a trek command log')
+        options = {'galaxy_size': (galaxy_rows, galaxy_columns),
+                   'sector_size': (sector_rows, sector_columns),
+                   'torus': torus, 'sector_cache': sector_cache}
+        final = FINAL.unpack_from(data, HEADER.size)
+        final = final[:-1] + (OUTCOMES[final[-1]],)
+        body = array('B', data[HEADER.size + FINAL.size:])
+        commands = []
+        i = 0
+        for n in xrange(count):
+            code, i = get_varint(body, i)
+            args = []
+            for a in xrange(code & 3):
+                arg, i = get_varint(body, i)
+                args.append(arg)
+            commands.append((code >> 2, tuple(args)))
+        if i != len(body):
+            raise LogError('command log has trailing data')
+        return cls(seed, version, commands, final, options)
+
+class RecordedPlay(object):
+    # Wraps game.play(), logging the captain's answers as they are sent.
+    # An answer to the command prompt starts a new command, the rest are
+    # its arguments. When the game ends the log is finished with how it
+    # ended, ready to pack
+    def __init__(self, play, log, game):
+        if options(game) != log.options:
+            raise LogError('the log is for a different game')
+        self.play = play
+        self.log = log
+        self.game = game
+        self.prompt = None
+
+    def __iter__(self):
+        return self
+
+    def run(self, resume, *answer):
+        try:
+            self.prompt = resume(*answer)
+        except StopIteration:
+            game = self.game
+            self.log.finish(game.state, game.outcome(game.state))
+            raise
+        return self.prompt
+
+    def next(self):
+        first = self.prompt is None
+        prompt = self.run(self.play.next)
+        if first:
+            # A game from a StartPool plays from the pool's seed
+            self.log.seed = self.game.seed
+        return prompt
+
+    def send(self, answer):
+        if self.prompt.startswith('Command'):
+            self.log.add(int(answer))
+        else:
+            command, args = self.log.commands[-1]
+            self.log.commands[-1] = (command, args + (int(answer),))
+        return self.run(self.play.send, answer)
+
+    def close(self):
+        self.play.close()
+
+def record(seed, policy=trek_sim.random_policy, max_commands=1000,
+           options=None):
+    # Play one headless game like trek_sim.play, logging every command.
+    # The policy draws from a game of its own, seeded apart from the real
+    # game by trek.advisor_rng, so that its choices neither move the real
+    # game's generator on nor follow its draws; there is no policy when
+    # replaying.
+    # options are more TrekGame arguments, as in CLASSIC
+    if options is None:
+        options = CLASSIC
+    game = trek.TrekGame(max_speed=True, test_mode=True, seed=seed,
+                         sink=trek.NullSink(), **options)
+    advisor = trek.TrekGame(max_speed=True, test_mode=True,
+                            rng=trek.advisor_rng(seed), sink=trek.NullSink())
+    log = CommandLog(seed, options=options)
+    state = game.new_game()
+    outcome = None
+    while outcome is None and len(log.commands) < max_commands:
+        command, args = policy(advisor, state)
+        log.add(command, args)
+        state, outcome = game.step(state, command, args)
+    log.finish(state, outcome)
+    return log
+
+def replay(log):
+    # Re-run the commands from the seed as fast as we can, with nothing
+    # shown, and return how the game ended
+    game = trek.TrekGame(max_speed=True, test_mode=True, seed=log.seed,
+                         sink=trek.NullSink(), **log.options)
+    state = game.new_game()
+    outcome = None
+    for command, args in log.commands:
+        state, outcome = game.step(state, command, args)
+        if outcome is not None:
+            break
+    return summary(state, outcome)
+
+def verify(log):
+    # True if replaying the log ends the way it was recorded
+    if log.version != trek.VERSION:
+        raise LogError('log is from version %d of the game, this is version %d'
+                       % (log.version, trek.VERSION))
+    return replay(log) == log.final
+
+def write_logs(logs, out):
+    for log in logs:
+        data = log.pack()
+        out.write(LENGTH.pack(len(data)))
+        out.write(data)
+
+def read_logs(f):
+    while True:
+        length = f.read(LENGTH.size)
+        if not length:
+            return
+        if len(length) < LENGTH.size:
+            raise LogError('log file is truncated')
+        size = LENGTH.unpack(length)[0]
+        data = f.read(size)
+        if len(data) < size:
+            raise LogError('log file is truncated')
+        yield CommandLog.unpack(data)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay recorded trek games and check they end the same.')
+    parser.add_argument('logs', nargs='+', help='files of command logs')
+    parser.add_argument('--record', type=int, metavar='GAMES',
+                        help='instead, record this many games from '
+                             'trek_sim.random_policy into the file')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='seed of the first recorded game')
+    args = parser.parse_args(argv)
+    if args.record is not None:
+        with open(args.logs[0], 'wb') as out:
+            write_logs((record(seed) for seed in
+                        xrange(args.seed, args.seed + args.record)), out)
+        return 0
+    games = 0
+    failed = 0
+    for name in args.logs:
+        with open(name, 'rb') as f:
+            for log in read_logs(f):
+                games = games + 1
+                if not verify(log):
+                    failed = failed + 1
+                    sys.stdout.write('%s: game with seed %d replays differently\n'
+                                     % (name, log.seed))
+    sys.stdout.write('%d games replayed, %d differ\n' % (games, failed))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,386 @@
+import argparse
+import asynchat
+import asyncore
+import heapq
+import errno
+import itertools
+import random
+import select
+import socket
+import sys
+import time
+
+import trek
+import trek_metrics
+
+# Host many games on one thread. Each connection gets its own TrekGame,
+# played through TrekGame.play so that no game ever waits on its player,
+# and a Pacer so that the dramatic pauses delay that player's output
+# without holding up anyone else
+
+# Longest line we'll take from a player before giving up on them
+MAX_LINE = 256
+
+class EventLoop(object):
+    # asyncore.loop builds a fresh poll set from every channel on each pass,
+    # which costs O(connections) per event. This keeps one epoll set for the
+    # life of the server and only re-arms the channels something happened to
+    def __init__(self, map):
+        self.map = map
+        self.touched = set()
+        self.armed = {}
+        self.epoll = None
+        if hasattr(select, 'epoll'):
+            self.epoll = select.epoll()
+
+    def touch(self, channel):
+        self.touched.add(channel)
+
+    def arm(self, channel):
+        fd = channel._fileno
+        if fd is None or self.map.get(fd) is not channel:
+            # Closed, and the kernel has already forgotten it
+            return
+        mask = 0
+        if channel.readable():
+            mask = mask | select.EPOLLIN | select.EPOLLPRI
+        if channel.writable():
+            mask = mask | select.EPOLLOUT
+        armed = self.armed.get(fd)
+        if armed is not None and armed[0] is channel:
+            if armed[1] == mask:
+                return
+            self.epoll.modify(fd, mask)
+        else:
+            # The descriptor may be a new one or a closed one's reused
+            try:
+                self.epoll.register(fd, mask)
+            except IOError:
+                self.epoll.modify(fd, mask)
+        self.armed[fd] = (channel, mask)
+
+    def poll(self, timeout):
+        if self.epoll is None:
+            asyncore.loop(timeout, use_poll=True, map=self.map, count=1)
+            return
+        touched = self.touched
+        self.touched = set()
+        for channel in touched:
+            self.arm(channel)
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError, e:
+            if e.errno != errno.EINTR:
+                raise
+            return
+        for fd, flags in events:
+            channel = self.map.get(fd)
+            if channel is not None:
+                # The epoll and poll flags have the same values
+                asyncore.readwrite(channel, flags)
+                self.touched.add(channel)
+
+    def close(self):
+        if self.epoll is not None:
+            self.epoll.close()
+
+class ChannelSink(object):
+    # Output for one connection, buffered by asynchat until it can be sent
+    def __init__(self, channel):
+        self.channel = channel
+
+    def write(self, text):
+        self.channel.push(text)
+
+class TrekSession(asynchat.async_chat):
+    def __init__(self, server, sock):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.server = server
+        self.set_terminator('\n')
+        self.incoming = []
+        self.received = 0
+        self.finished = False
+        self.prompt = None
+        self.last_input = server.clock.time()
+        self.pacer = trek.Pacer(ChannelSink(self), server.clock)
+        self.game = trek.TrekGame(max_speed=server.max_speed, sink=self.pacer,
+                                  clock=self.pacer, pool=server.pool,
+                                  sector_cache=server.sector_cache)
+        self.play = self.game.play()
+        if server.metrics is not None:
+            self.play = server.metrics.measure(self.play, self.game)
+        self.advance(None)
+        server.loop.touch(self)
+
+    def collect_incoming_data(self, data):
+        self.received = self.received + len(data)
+        if self.received > MAX_LINE:
+            self.close()
+            return
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.incoming).strip()
+        self.incoming = []
+        self.received = 0
+        self.last_input = self.server.clock.time()
+        if self.finished:
+            return
+        try:
+            int(line)
+        except ValueError:
+            # Every prompt wants a number. The terminal game would stop
+            # with a traceback here; just ask again
+            self.pacer.write(self.prompt)
+            self.deliver(self.server.clock.time())
+            return
+        self.advance(line)
+
+    def advance(self, line):
+        # Run the game on to its next prompt
+        try:
+            if line is None:
+                prompt = next(self.play)
+            else:
+                prompt = self.play.send(line)
+        except StopIteration:
+            self.finished = True
+        else:
+            self.prompt = prompt
+            self.pacer.write(prompt)
+        self.deliver(self.server.clock.time())
+
+    def deliver(self, now):
+        self.server.loop.touch(self)
+        due = self.pacer.deliver(now)
+        if due is not None:
+            self.server.schedule(self, due)
+        elif self.finished:
+            self.close_when_done()
+
+    def timed_out(self):
+        self.pacer.flush()
+        self.push("\nIdle too long, captain. Goodbye.\n")
+        self.finished = True
+        self.close_when_done()
+        self.server.loop.touch(self)
+
+    def handle_close(self):
+        self.close()
+
+class TrekServer(asyncore.dispatcher):
+    def __init__(self, host='', port=2323, idle_timeout=600, max_speed=False,
+                 clock=None, backlog=4096, pool=None, metrics=None,
+                 sector_cache=0):
+        self.map = {}
+        self.loop = EventLoop(self.map)
+        asyncore.dispatcher.__init__(self, map=self.map)
+        if clock is None:
+            clock = trek.SleepClock()
+        self.clock = clock
+        self.idle_timeout = idle_timeout
+        self.max_speed = max_speed
+        # A trek.StartPool, so that players don't wait for their galaxy
+        self.pool = pool
+        # A trek_metrics.Metrics to time every player's commands into
+        self.metrics = metrics
+        # How many sector layouts each game remembers, see trek.TrekGame
+        self.sector_cache = sector_cache
+        # Pending output, as a heap of (due, order, session)
+        self.timers = []
+        self.order = itertools.count()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(backlog)
+        self.port = self.socket.getsockname()[1]
+        self.running = False
+        self.loop.touch(self)
+
+    def handle_accept(self):
+        # Take every connection that is waiting, not just the first
+        while True:
+            try:
+                pair = self.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EMFILE, errno.ENFILE):
+                    # Out of descriptors; the rest can wait in the backlog
+                    return
+                raise
+            if pair is None:
+                return
+            TrekSession(self, pair[0])
+
+    def sessions(self):
+        return [channel for channel in self.map.values()
+                if isinstance(channel, TrekSession)]
+
+    def schedule(self, session, due):
+        heapq.heappush(self.timers, (due, next(self.order), session))
+
+    def run_timers(self, now):
+        timers = self.timers
+        while timers and timers[0][0] <= now:
+            session = heapq.heappop(timers)[2]
+            if session.connected:
+                session.deliver(now)
+
+    def reap(self, now):
+        # Drop the players who have stopped typing
+        for session in self.sessions():
+            if now - session.last_input > self.idle_timeout:
+                session.timed_out()
+
+    def serve(self, poll=1.0):
+        self.running = True
+        next_reap = self.clock.time() + poll
+        while self.running:
+            now = self.clock.time()
+            timeout = poll
+            if self.timers:
+                timeout = min(timeout, max(0, self.timers[0][0] - now))
+            self.loop.poll(timeout)
+            now = self.clock.time()
+            self.run_timers(now)
+            if now >= next_reap:
+                self.reap(now)
+                next_reap = now + poll
+
+    def stop(self):
+        self.running = False
+
+    def shutdown(self):
+        self.stop()
+        asyncore.close_all(self.map)
+        self.loop.close()
+
+# A crowd of simulated players, for load testing a running server
+
+def random_answer(prompt, rng):
+    # Keep out of trouble: scan, top up the shields and wander about
+    if prompt.startswith('Command'):
+        return rng.choice('0125')
+    if prompt.startswith('Course'):
+        return str(rng.choice((1, 2, 3, 4, 6, 7, 8, 9)))
+    if prompt.startswith('Warp'):
+        return str(rng.randint(1, 8))
+    return str(rng.randint(1, 20))
+
+class TrekClient(asynchat.async_chat):
+    def __init__(self, crowd, host, port, commands, seed):
+        asynchat.async_chat.__init__(self, map=crowd.map)
+        self.crowd = crowd
+        self.commands = commands
+        self.rng = random.Random(seed)
+        self.set_terminator('? ')
+        self.incoming = []
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((host, port))
+        crowd.loop.touch(self)
+
+    def collect_incoming_data(self, data):
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        prompt = ''.join(self.incoming).rsplit('\n', 1)[-1]
+        self.incoming = []
+        if prompt.startswith('Command'):
+            if self.commands == 0:
+                self.push('6\n')
+                return
+            self.commands = self.commands - 1
+            self.crowd.commands = self.crowd.commands + 1
+        self.push(random_answer(prompt, self.rng) + '\n')
+
+    def handle_close(self):
+        if ''.join(self.incoming).endswith(('relieved of duty.\n',
+                                            'Admiral Kirk.\n')):
+            self.crowd.completed = self.crowd.completed + 1
+        self.close()
+
+    def handle_error(self):
+        self.crowd.errors = self.crowd.errors + 1
+        self.close()
+
+class Crowd(object):
+    def __init__(self):
+        self.map = {}
+        self.loop = EventLoop(self.map)
+        self.commands = 0
+        self.completed = 0
+        self.errors = 0
+
+def load_test(clients, host='127.0.0.1', port=2323, commands=10, seed=0,
+              ramp=100):
+    # Connect the players, ramp at a time, and wait for them all to resign
+    crowd = Crowd()
+    started = time.time()
+    for i in xrange(clients):
+        TrekClient(crowd, host, port, commands, seed + i)
+        if i % ramp == ramp - 1:
+            crowd.loop.poll(0)
+    while crowd.map:
+        crowd.loop.poll(1.0)
+    crowd.loop.close()
+    elapsed = time.time() - started
+    return {'clients': clients,
+            'completed': crowd.completed,
+            'errors': crowd.errors,
+            'commands': crowd.commands,
+            'seconds': round(elapsed, 3),
+            'commands_per_second': round(crowd.commands / elapsed, 1)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Host trek games for many players over TCP (telnet).')
+    parser.add_argument('--host', default='',
+                        help='address to listen on (default: all)')
+    parser.add_argument('-p', '--port', type=int, default=2323)
+    parser.add_argument('-t', '--idle-timeout', type=float, default=600,
+                        help='seconds before a silent player is dropped')
+    parser.add_argument('--max-speed', action='store_true',
+                        help='no dramatic pauses')
+    parser.add_argument('--pool', type=int, default=64, metavar='GAMES',
+                        help='games to keep started ahead of time, 0 for none')
+    parser.add_argument('--sector-cache', type=int, default=0,
+                        metavar='SECTORS',
+                        help='remember how the last SECTORS sectors each '
+                             'player left were laid out')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='time commands and serve the figures for '
+                             'Prometheus at http://localhost:PORT/metrics')
+    parser.add_argument('--simulate', type=int, metavar='CLIENTS',
+                        help='instead of serving, connect this many simulated '
+                             'players to a running server and report')
+    parser.add_argument('-c', '--commands', type=int, default=10,
+                        help='commands each simulated player gives')
+    args = parser.parse_args(argv)
+    if args.simulate:
+        result = load_test(args.simulate, args.host or '127.0.0.1', args.port,
+                           args.commands)
+        for key in sorted(result):
+            sys.stdout.write('%-20s %s\n' % (key + ':', result[key]))
+        return
+    pool = None
+    if args.pool > 0:
+        pool = trek.StartPool(args.pool)
+    metrics = None
+    if args.metrics_port:
+        metrics = trek_metrics.Metrics()
+        metrics.serve(port=args.metrics_port)
+    server = TrekServer(args.host, args.port, args.idle_timeout,
+                        args.max_speed, pool=pool, metrics=metrics,
+                        sector_cache=args.sector_cache)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        if pool is not None:
+            pool.stop()
+            sys.stderr.write('start pool: %(hits)d hits, %(misses)d misses\n'
+                             % pool.stats())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+import argparse
+from collections import deque
+import csv
+import json
+import multiprocessing
+import sys
+
+import trek
+
+# Every record written by the simulator has these fields, in this order
+FIELDS = ('seed', 'result', 'stardate', 'commands', 'energy')
+
+# Numeric keypad directions the Enterprise can move or fire in
+DIRECTIONS = (1, 2, 3, 4, 6, 7, 8, 9)
+
+def random_policy(game, state):
+    # Keep some energy in the shields, shoot at anything in the sector and
+    # otherwise fly about at random. Uses the game's own generator so that
+    # the whole game is reproducible from its seed
+    rng = game.rng
+    if state.shields < 100 and state.energy > 200:
+        return (5, (state.energy / 4,))
+    if state.ksec > 0:
+        if state.torpedoes > 0 and rng.randint(1, 2) == 1:
+            return (4, (rng.choice(DIRECTIONS),))
+        return (3, (rng.randint(1, max(1, state.energy / 4)),))
+    return (1, (rng.choice(DIRECTIONS), rng.randint(1, 8)))
+
+class Autopilot(object):
+    """A policy that plays to win, for bots that should play like captains.
+
+    It only knows the sectors it has seen on long range scans, keeping
+    what each scan showed, and plans routes from sector to sector over
+    game.neighbours, so the galaxy wraps round just as the helm does. A
+    route is worked out once and reused until something new is learned
+    about the galaxy. Inside a sector it reads the same RAYS and DISTANCES
+    tables the helm, torpedoes and phasers use, to find a clear course out,
+    a torpedo with a Klingon at the end of it or just enough phaser energy
+    to finish every Klingon off.
+
+    One Autopilot can play any number of games one after another; it
+    starts afresh whenever it is shown a new galaxy.
+    """
+
+    # The most the Klingons in a sector can do to the shields in one attack
+    MAX_ATTACK = 150
+    # Make for a starbase once energy falls this low
+    LOW_ENERGY = 1500
+    # Energy never spent on weapons, so that there is always some to move
+    RESERVE = 100
+
+    def __init__(self):
+        self.reset(None)
+
+    def reset(self, galaxy):
+        self.galaxy = galaxy
+        # What each sector held when last seen, and where we have scanned
+        self.known = {}
+        self.scanned = set()
+        # Starbases we couldn't get alongside
+        self.blocked = set()
+        # Routes already planned, by (sector, goal)
+        self.plans = {}
+
+    def learn(self, sector, value):
+        if self.known.get(sector) != value:
+            self.known[sector] = value
+            self.plans.clear()
+
+    def __call__(self, game, state):
+        if state.galaxy is not self.galaxy:
+            self.reset(state.galaxy)
+        # The short range scan keeps us up to date with this sector
+        self.learn(state.sector, state.galaxy[state.sector])
+        # Klingons may attack after any command, so the shields come first
+        wanted = self.MAX_ATTACK - state.shields
+        if wanted > 0 and state.energy > wanted + self.RESERVE:
+            return (5, (wanted,))
+        if state.ksec > 0:
+            move = self.fight(game, state)
+            if move is not None:
+                return move
+            # Not enough left to win here; go and refuel
+            return self.head_for(game, state, 'starbase')
+        if state.sector not in self.scanned:
+            return self.scan(game, state)
+        if state.energy < self.LOW_ENERGY or state.torpedoes == 0:
+            return self.head_for(game, state, 'starbase')
+        return self.head_for(game, state, 'klingons')
+
+    def scan(self, game, state):
+        # Long range scan, noting the nine sectors it shows
+        self.scanned.add(state.sector)
+        self.plans.clear()
+        for sector in game.neighbours[state.sector]:
+            self.learn(sector, state.galaxy[sector])
+        return (2, ())
+
+    def is_goal(self, sector, goal):
+        value = self.known.get(sector)
+        if goal == 'klingons':
+            return value >= 100
+        if goal == 'starbase':
+            return (value is not None and value / 10 % 10 > 0 and
+                    sector not in self.blocked)
+        # Somewhere not yet scanned from, to find out more
+        return sector not in self.scanned
+
+    def plan(self, game, start, goal):
+        # The shortest route from start to the nearest sector meeting goal,
+        # as a list of sectors from start on, or None. Only sectors we know
+        # of are searched, so the search stays small however big the
+        # galaxy is
+        key = (start, goal)
+        if key in self.plans:
+            return self.plans[key]
+        came_from = {start: None}
+        queue = deque([start])
+        route = None
+        while queue:
+            sector = queue.popleft()
+            if self.is_goal(sector, goal):
+                route = []
+                while sector is not None:
+                    route.append(sector)
+                    sector = came_from[sector]
+                route.reverse()
+                break
+            for next_sector in game.neighbours[sector]:
+                if next_sector not in came_from and next_sector in self.known:
+                    came_from[next_sector] = sector
+                    queue.append(next_sector)
+        self.plans[key] = route
+        return route
+
+    def moves(self, game, state, epos):
+        # Every helm command from epos, as (direction, warp, where), where
+        # is a position in the sector or ('sector', n) on flying out into
+        # sector n
+        sector = state.current_sector
+        for direction in DIRECTIONS:
+            cells, offset = game.geometry.rays[epos][direction]
+            for warp in range(1, len(cells) + 1):
+                if sector[cells[warp - 1]] != 0:
+                    break
+                yield direction, warp, cells[warp - 1]
+            else:
+                out = game.neighbours[state.sector][trek.EXITS[offset]]
+                yield direction, len(cells) + 1, ('sector', out)
+
+    def manoeuvre(self, game, state, arrived):
+        # The first helm command of the fewest that take us somewhere
+        # arrived(where) accepts, or None
+        first = {state.ent_position: None}
+        queue = deque([state.ent_position])
+        while queue:
+            epos = queue.popleft()
+            for direction, warp, where in self.moves(game, state, epos):
+                move = first[epos] or (1, (direction, warp))
+                if arrived(where):
+                    return move
+                if where not in first and not isinstance(where, tuple):
+                    first[where] = move
+                    queue.append(where)
+        return None
+
+    def head_for(self, game, state, goal):
+        route = self.plan(game, state.sector, goal)
+        if route is None and goal != 'explore':
+            route = self.plan(game, state.sector, 'explore')
+        if route is None:
+            # Nowhere left to go that we know of; fly off anywhere
+            move = self.manoeuvre(game, state, lambda where:
+                                  isinstance(where, tuple))
+            return move or (2, ())
+        if len(route) == 1:
+            if goal == 'starbase':
+                return self.dock(game, state)
+            return self.scan(game, state)
+        move = self.manoeuvre(game, state,
+                              lambda where: where == ('sector', route[1]))
+        if move is None:
+            # Boxed in on that side; any way out will do for now
+            move = self.manoeuvre(game, state, lambda where:
+                                  isinstance(where, tuple))
+        return move or (2, ())
+
+    def dock(self, game, state):
+        # Fly alongside the starbase in this sector
+        sector = state.current_sector
+        positions = game.geometry.positions
+        def alongside(where):
+            return (not isinstance(where, tuple) and
+                    ((where > 0 and sector[where - 1] == 2) or
+                     (where < positions - 1 and sector[where + 1] == 2)))
+        move = self.manoeuvre(game, state, alongside)
+        if move is None:
+            # Stars in the way. Try another starbase, or do without
+            self.blocked.add(state.sector)
+            self.plans.clear()
+            return self.head_for(game, state, 'klingons')
+        return move
+
+    def fight(self, game, state):
+        # Fire a torpedo at the first Klingon in line, else enough phaser
+        # energy to destroy every Klingon in the sector at once, else move
+        # closer. None if we can't afford to win here
+        sector = state.current_sector
+        epos = state.ent_position
+        if state.torpedoes > 0:
+            for direction in DIRECTIONS:
+                for i in game.geometry.rays[epos][direction][0]:
+                    if sector[i] != 0:
+                        if sector[i] < 0:
+                            return (4, (direction,))
+                        break
+        klingons = game.find_klingons(sector)
+        spare = state.energy - self.RESERVE
+        power = self.phaser_power(game, sector, epos, klingons)
+        if power <= spare:
+            return (3, (power,))
+        # Somewhere within one move that needs less
+        best = None
+        for direction, warp, where in self.moves(game, state, epos):
+            if not isinstance(where, tuple):
+                power = self.phaser_power(game, sector, where, klingons)
+                if power + warp <= spare and (best is None or power < best[0]):
+                    best = (power, (1, (direction, warp)))
+        if best is not None:
+            return best[1]
+        return None
+
+    def phaser_power(self, game, sector, epos, klingons):
+        # Phasers split their energy between the Klingons and lose it with
+        # distance; each must get at least its own remaining energy
+        distances = game.geometry.distances[epos]
+        each = max(-sector[i] * distances[i] for i in klingons)
+        return each * len(klingons)
+
+def load_policy(name):
+    # Policies are named as module:function, e.g. trek_sim:random_policy
+    # or module:Class for a class such as Autopilot, made afresh here
+    module, _, function = name.partition(':')
+    policy = getattr(__import__(module, fromlist=[function]), function)
+    if isinstance(policy, type):
+        policy = policy()
+    return policy
+
+def play(seed, policy=random_policy, max_commands=1000):
+    # Play one complete headless game and summarise how it went
+    game = trek.TrekGame(max_speed=True, test_mode=True, seed=seed)
+    state = game.new_game()
+    result = None
+    commands = 0
+    while result is None and commands < max_commands:
+        command, args = policy(game, state)
+        state, result = game.step(state, command, args)
+        commands = commands + 1
+    return {'seed': seed,
+            'result': result or 'unfinished',
+            'stardate': round(state.stardate, 1),
+            'commands': commands,
+            'energy': state.energy}
+
+def play_job(job):
+    # Pool workers receive the policy by name as functions may not pickle
+    seed, policy, max_commands = job
+    return play(seed, load_policy(policy), max_commands)
+
+def simulate(games, first_seed=0, policy='trek_sim:random_policy',
+             processes=None, max_commands=1000, chunksize=64):
+    # Yield one record per game, in whatever order the games finish
+    jobs = ((seed, policy, max_commands)
+            for seed in xrange(first_seed, first_seed + games))
+    if processes == 1:
+        for job in jobs:
+            yield play_job(job)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for record in pool.imap_unordered(play_job, jobs, chunksize):
+            yield record
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def write_jsonl(records, out):
+    for record in records:
+        out.write(json.dumps(record, sort_keys=True) + '\n')
+
+def write_csv(records, out):
+    writer = csv.DictWriter(out, FIELDS)
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+
+SINKS = {'jsonl': write_jsonl, 'csv': write_csv}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run many seeded trek games and record how each one went.')
+    parser.add_argument('-n', '--games', type=int, default=1000,
+                        help='number of games to play')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='seed of the first game; the rest count up')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('-p', '--policy', default='trek_sim:random_policy',
+                        help='module:function choosing each command, or '
+                             'module:Class such as trek_sim:Autopilot')
+    parser.add_argument('-m', '--max-commands', type=int, default=1000,
+                        help='give up on a game after this many commands')
+    parser.add_argument('-f', '--format', choices=sorted(SINKS),
+                        default='jsonl')
+    parser.add_argument('-o', '--output', default='-',
+                        help='file to write records to (default: stdout)')
+    args = parser.parse_args(argv)
+    # Fail early on a bad policy name rather than in every worker
+    load_policy(args.policy)
+    records = simulate(args.games, args.seed, args.policy, args.processes,
+                       args.max_commands)
+    if args.output == '-':
+        SINKS[args.format](records, sys.stdout)
+    else:
+        with open(args.output, 'wb') as out:
+            SINKS[args.format](records, out)
+
+if __name__ == '__main__':
+    main()